@@ -6,7 +6,6 @@ multiple SIP accounts and their properties.
 
 __all__ = ['Account', 'BonjourAccount', 'AccountManager']
 
-from itertools import chain
 from threading import Lock
 
 from application.notification import IObserver, NotificationCenter, NotificationData
@@ -781,6 +780,15 @@ class AccountManager(object, metaclass=Singleton):
     def __init__(self):
         self._lock = Lock()
         self.accounts = {}
+        # Indexes used by find_account, which runs for every incoming session. They map the contact username,
+        # the (username, domain) pair of the account id and the id username to the accounts having them, while
+        # _account_order records the position of each account in self.accounts so that find_account returns
+        # the same account as a scan over self.accounts would.
+        self._contact_index = {}
+        self._address_index = {}
+        self._username_index = {}
+        self._account_order = {}
+        self._account_sequence = 0
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='CFGSettingsObjectWasActivated')
         notification_center.add_observer(self, name='CFGSettingsObjectWasCreated')
@@ -839,11 +847,32 @@ class AccountManager(object, metaclass=Singleton):
 
     def find_account(self, contact_uri):
         # compare contact_address with account contact
-        exact_matches = (account for account in list(self.accounts.values()) if account.enabled and account.contact.username==contact_uri.user or (account.id.username==contact_uri.user and account.id.domain==contact_uri.host))
+        exact_matches = [account for account in self._contact_index.get(contact_uri.user, ()) if account.enabled]
+        exact_matches.extend(self._address_index.get((contact_uri.user, contact_uri.host), ()))
+        if exact_matches:
+            return min(exact_matches, key=self._account_order.__getitem__)
 
         # compare username in contact URI with account username
-        loose_matches = (account for account in list(self.accounts.values()) if account.enabled and account.id.username==contact_uri.user)
-        return next(chain(exact_matches, loose_matches, [None]))
+        loose_matches = [account for account in self._username_index.get(contact_uri.user, ()) if account.enabled]
+        if loose_matches:
+            return min(loose_matches, key=self._account_order.__getitem__)
+        return None
+
+    def _add_to_index(self, account):
+        self._account_sequence += 1
+        self._account_order[account] = self._account_sequence
+        self._contact_index.setdefault(account.contact.username, set()).add(account)
+        self._address_index.setdefault((account.id.username, account.id.domain), set()).add(account)
+        self._username_index.setdefault(account.id.username, set()).add(account)
+
+    def _remove_from_index(self, account, id):
+        self._account_order.pop(account, None)
+        for index, key in ((self._contact_index, account.contact.username), (self._address_index, (id.username, id.domain)), (self._username_index, id.username)):
+            accounts = index.get(key)
+            if accounts is not None:
+                accounts.discard(account)
+                if not accounts:
+                    del index[key]
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -853,6 +882,7 @@ class AccountManager(object, metaclass=Singleton):
         if isinstance(notification.sender, Account) or (isinstance(notification.sender, BonjourAccount) and _bonjour.available):
             account = notification.sender
             self.accounts[account.id] = account
+            self._add_to_index(account)
             notification.center.add_observer(self, sender=account, name='CFGSettingsObjectDidChange')
             notification.center.add_observer(self, sender=account, name='CFGSettingsObjectWasDeleted')
             notification.center.post_notification('SIPAccountManagerDidAddAccount', sender=self, data=NotificationData(account=account))
@@ -869,6 +899,7 @@ class AccountManager(object, metaclass=Singleton):
     def _NH_CFGSettingsObjectWasDeleted(self, notification):
         account = notification.sender
         del self.accounts[account.id]
+        self._remove_from_index(account, account.id)
         notification.center.remove_observer(self, sender=account, name='CFGSettingsObjectDidChange')
         notification.center.remove_observer(self, sender=account, name='CFGSettingsObjectWasDeleted')
         notification.center.post_notification('SIPAccountManagerDidRemoveAccount', sender=self, data=NotificationData(account=account))
@@ -878,6 +909,8 @@ class AccountManager(object, metaclass=Singleton):
         if '__id__' in notification.data.modified:
             modified_id = notification.data.modified['__id__']
             self.accounts[modified_id.new] = self.accounts.pop(modified_id.old)
+            self._remove_from_index(account, modified_id.old)
+            self._add_to_index(account)
         if 'enabled' in notification.data.modified:
             if account.enabled and self.default_account is None:
                 self.default_account = account
@@ -1,14 +1,16 @@
 
 """Implements the registration handler"""
 
-__all__ = ['Registrar']
+__all__ = ['Registrar', 'RegistrationScheduler']
 
 import random
 
+from contextlib import contextmanager
 from time import time
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null, limit
+from application.python.types import Singleton
 from application.system import host as Host
 from eventlib import coros, proc
 from twisted.internet import reactor
@@ -22,7 +24,7 @@ from sipsimple.threading.green import Command, run_in_green_thread
 
 
 
-Command.register_defaults('register', refresh_interval=None)
+Command.register_defaults('register', refresh_interval=None, delay=0)
 
 
 class SIPRegistrationDidFail(Exception):
@@ -40,6 +42,128 @@ class RegistrationError(Exception):
         self.refresh_interval = refresh_interval
 
 
+class RegistrationScheduler(object, metaclass=Singleton):
+    """
+    Coordinates the registrations of all the accounts, so that having many
+    of them registering with the same registrar does not result in bursts
+    of REGISTER requests and DNS lookups:
+
+     * registrations started at once (when the accounts start or when the
+       network conditions change) are spread over a window that grows with
+       the number of registrars, which also spreads their later refreshes;
+     * at most max_transactions_per_destination registration attempts or
+       unregistrations are in progress towards a destination at any time;
+     * the route lookups for the same destination are shared and their
+       result is reused for route_cache_time seconds, or until the network
+       conditions change.
+
+    It is only used from the green threads of the registrars.
+    """
+
+    register_rate = 50              # registrations per second the jitter window is sized for
+    max_jitter = 60
+    max_transactions_per_destination = 50
+    route_cache_time = 30
+
+    def __init__(self):
+        self.registrars = set()
+        self._destinations = {}     # destination -> [semaphore, users]
+        self._lookups = {}          # lookup key -> event for the lookup in progress
+        self._routes = {}           # lookup key -> (expires, routes)
+        self._routes_generation = 0
+        self._queued = 0
+        self._outstanding = 0
+        self._stats = dict(transactions=0, queue_time=0.0, max_queue_time=0.0, transaction_time=0.0, max_transaction_time=0.0, lookups=0, shared_lookups=0)
+
+    @property
+    def statistics(self):
+        stats = dict(self._stats, registrars=len(self.registrars), destinations=len(self._destinations), queued=self._queued, outstanding=self._outstanding)
+        transactions = stats['transactions']
+        stats['average_queue_time'] = stats['queue_time'] / transactions if transactions else 0.0
+        stats['average_transaction_time'] = stats['transaction_time'] / transactions if transactions else 0.0
+        return stats
+
+    def add(self, registrar):
+        self.registrars.add(registrar)
+
+    def remove(self, registrar):
+        self.registrars.discard(registrar)
+
+    def get_delay(self):
+        """Return a random delay for starting a registration"""
+        return random.uniform(0, min(self.max_jitter, len(self.registrars) / self.register_rate))
+
+    def clear_routes(self):
+        """Forget the cached routes, including the ones of the lookups in progress"""
+        self._routes.clear()
+        self._routes_generation += 1
+
+    def lookup_routes(self, uri, transport_list, tls_name=None):
+        key = (str(uri), tuple(transport_list), tls_name)
+        generation = self._routes_generation
+        now = time()
+        try:
+            expires, routes = self._routes[key]
+        except KeyError:
+            pass
+        else:
+            if expires > now:
+                self._stats['shared_lookups'] += 1
+                return routes
+            del self._routes[key]
+        if key in self._lookups:
+            self._stats['shared_lookups'] += 1
+            return self._lookups[key].wait()
+        self._stats['lookups'] += 1
+        event = self._lookups[key] = coros.event()
+        try:
+            routes = DNSLookup().lookup_sip_proxy(uri, transport_list, tls_name=tls_name).wait()
+        except DNSLookupError as e:
+            del self._lookups[key]
+            event.send_exception(e)
+            raise
+        except BaseException:
+            del self._lookups[key]
+            event.send_exception(DNSLookupError('route lookup was interrupted'))
+            raise
+        del self._lookups[key]
+        if generation == self._routes_generation:
+            self._routes = {key: value for key, value in self._routes.items() if value[0] > now}
+            self._routes[key] = (now + self.route_cache_time, routes)
+        event.send(routes)
+        return routes
+
+    @contextmanager
+    def transaction(self, destination):
+        """Wait until a registration attempt towards destination is allowed and hold the slot until it finishes"""
+        entry = self._destinations.setdefault(destination, [coros.Semaphore(self.max_transactions_per_destination), 0])
+        entry[1] += 1
+        try:
+            start_time = time()
+            self._queued += 1
+            try:
+                entry[0].acquire()
+            finally:
+                self._queued -= 1
+            queue_time = time() - start_time
+            self._outstanding += 1
+            try:
+                yield
+            finally:
+                transaction_time = time() - start_time - queue_time
+                self._outstanding -= 1
+                entry[0].release()
+                self._stats['transactions'] += 1
+                self._stats['queue_time'] += queue_time
+                self._stats['max_queue_time'] = max(self._stats['max_queue_time'], queue_time)
+                self._stats['transaction_time'] += transaction_time
+                self._stats['max_transaction_time'] = max(self._stats['max_transaction_time'], transaction_time)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._destinations[destination]
+
+
 @implementer(IObserver)
 class Registrar(object):
 
@@ -52,6 +176,7 @@ class Registrar(object):
         self._command_channel = coros.queue()
         self._data_channel = coros.queue()
         self._registration = None
+        self._registration_destination = None
         self._dns_wait = 1
         self._register_wait = 1
         self._registration_timer = None
@@ -64,6 +189,7 @@ class Registrar(object):
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
         notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        RegistrationScheduler().add(self)
         self._command_proc = proc.spawn(self._run)
         if self.account.sip.register:
             self.activate()
@@ -77,6 +203,7 @@ class Registrar(object):
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
         notification_center.remove_observer(self, name='NetworkConditionsDidChange')
+        RegistrationScheduler().remove(self)
         command = Command('terminate')
         self._command_channel.send(command)
         command.wait()
@@ -86,7 +213,7 @@ class Registrar(object):
         if not self.started:
             raise RuntimeError("not started")
         self.active = True
-        self._command_channel.send(Command('register'))
+        self._command_channel.send(Command('register', delay=RegistrationScheduler().get_delay()))
 
     def deactivate(self):
         if not self.started:
@@ -97,7 +224,7 @@ class Registrar(object):
     def reregister(self):
         if self.active:
             self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+            self._command_channel.send(Command('register', delay=RegistrationScheduler().get_delay()))
 
     def _run(self):
         while True:
@@ -114,6 +241,16 @@ class Registrar(object):
             self._registration_timer.cancel()
         self._registration_timer = None
 
+        if command.delay > 0:
+            def register():
+                if self.active:
+                    self._command_channel.send(Command('register', command.event, refresh_interval=command.refresh_interval))
+                self._registration_timer = None
+            self._registration_timer = reactor.callLater(command.delay, register)
+            return
+
+        scheduler = RegistrationScheduler()
+
         try:
             if Host.default_ip is None:
                 raise RegistrationError('No IP address', retry_after=60)
@@ -139,9 +276,8 @@ class Registrar(object):
                 uri = SIPURI(host=self.account.sip.outbound_proxy.host, port=self.account.sip.outbound_proxy.port, parameters={'transport': self.account.sip.outbound_proxy.transport})
             else:
                 uri = SIPURI(host=self.account.id.domain)
-            lookup = DNSLookup()
             try:
-                routes = lookup.lookup_sip_proxy(uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name).wait()
+                routes = scheduler.lookup_routes(uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name)
             except DNSLookupError as e:
                 retry_after = int(random.uniform(self._dns_wait, 2*self._dns_wait))
                 self._dns_wait = limit(2*self._dns_wait, max=30)
@@ -150,89 +286,91 @@ class Registrar(object):
                 self._dns_wait = 1
 
             # Register by trying each route in turn
-            register_timeout = time() + 30
-            i = 0
-            for route in routes:
-                i += 1
-                remaining_time = register_timeout-time()
-                if remaining_time > 0:
-                    try:
-                        contact_uri = self.account.contact[NoGRUU, route]
-                    except KeyError:
-                        continue
-                    contact_header = ContactHeader(contact_uri)
-                    instance_id = '"<%s>"' % settings.instance_id
+            self._registration_destination = uri.host
+            with scheduler.transaction(uri.host):
+                register_timeout = time() + 30
+                i = 0
+                for route in routes:
+                    i += 1
+                    remaining_time = register_timeout-time()
+                    if remaining_time > 0:
+                        try:
+                            contact_uri = self.account.contact[NoGRUU, route]
+                        except KeyError:
+                            continue
+                        contact_header = ContactHeader(contact_uri)
+                        instance_id = '"<%s>"' % settings.instance_id
                     
-                    contact_header.parameters[b"+sip.instance"] = instance_id.encode()
-                    if self.account.nat_traversal.use_ice:
-                        contact_header.parameters[b"+sip.ice"] = None
-                    route_header = RouteHeader(route.uri)
-                    try:
-                        self._registration.register(contact_header, route_header, timeout=limit(remaining_time, min=1, max=10))
-                    except SIPCoreError:
-                        raise RegistrationError('Internal error', retry_after=5)
-                    try:
-                        while True:
-                            notification = self._data_channel.wait()
-                            if notification.name == 'SIPRegistrationDidSucceed':
-                                break
-                            if notification.name == 'SIPRegistrationDidEnd':
-                                raise RegistrationError('Registration expired', retry_after=int(random.uniform(60, 120)))  # registration expired while we were trying to re-register
-                    except SIPRegistrationDidFail as e:
-                        notification_data = NotificationData(code=e.data.code, reason=e.data.reason, registration=self._registration, registrar=route)
-                        notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
-                        if e.data.code == 401:
-                            # Authentication failed, so retry the registration in some time
-                            raise RegistrationError('Authentication failed', retry_after=int(random.uniform(60, 120)))
-                        elif e.data.code == 408:
-                            # Timeout
-                            raise RegistrationError('Request timeout', retry_after=int(random.uniform(15, 40)))
-                        elif e.data.code == 423:
-                            # Get the value of the Min-Expires header
-                            if e.data.min_expires is not None and e.data.min_expires > self.account.sip.register_interval:
-                                refresh_interval = e.data.min_expires
-                            else:
-                                refresh_interval = None
-                            raise RegistrationError('Interval too short', retry_after=int(random.uniform(60, 120)), refresh_interval=refresh_interval)
-                        else:
-                            if i == len(routes):
-                                raise RegistrationError(e.data.reason, retry_after=int(random.uniform(15, 40)))
-                            else:
-                                # Otherwise just try the next route
-                                continue
-                    else:
-                        notification_data = NotificationData(code=notification.data.code, reason=notification.data.reason, registration=self._registration, registrar=route)
-                        notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
-                        self.registered = True
-                        # Save GRUU
+                        contact_header.parameters[b"+sip.instance"] = instance_id.encode()
+                        if self.account.nat_traversal.use_ice:
+                            contact_header.parameters[b"+sip.ice"] = None
+                        route_header = RouteHeader(route.uri)
+                        try:
+                            self._registration.register(contact_header, route_header, timeout=limit(remaining_time, min=1, max=10))
+                        except SIPCoreError:
+                            raise RegistrationError('Internal error', retry_after=5)
                         try:
-                            header = next(header for header in notification.data.contact_header_list if header.parameters.get('+sip.instance', '').strip('"<>') == settings.instance_id)
-                        except StopIteration:
-                            self.account.contact.public_gruu = None
-                            self.account.contact.temporary_gruu = None
+                            while True:
+                                notification = self._data_channel.wait()
+                                if notification.name == 'SIPRegistrationDidSucceed':
+                                    break
+                                if notification.name == 'SIPRegistrationDidEnd':
+                                    raise RegistrationError('Registration expired', retry_after=int(random.uniform(60, 120)))  # registration expired while we were trying to re-register
+                        except SIPRegistrationDidFail as e:
+                            notification_data = NotificationData(code=e.data.code, reason=e.data.reason, registration=self._registration, registrar=route)
+                            notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
+                            if e.data.code == 401:
+                                # Authentication failed, so retry the registration in some time
+                                raise RegistrationError('Authentication failed', retry_after=int(random.uniform(60, 120)))
+                            elif e.data.code == 408:
+                                # Timeout
+                                raise RegistrationError('Request timeout', retry_after=int(random.uniform(15, 40)))
+                            elif e.data.code == 423:
+                                # Get the value of the Min-Expires header
+                                if e.data.min_expires is not None and e.data.min_expires > self.account.sip.register_interval:
+                                    refresh_interval = e.data.min_expires
+                                else:
+                                    refresh_interval = None
+                                raise RegistrationError('Interval too short', retry_after=int(random.uniform(60, 120)), refresh_interval=refresh_interval)
+                            else:
+                                if i == len(routes):
+                                    raise RegistrationError(e.data.reason, retry_after=int(random.uniform(15, 40)))
+                                else:
+                                    # Otherwise just try the next route
+                                    continue
                         else:
-                            public_gruu = header.parameters.get('pub-gruu', None)
-                            temporary_gruu = header.parameters.get('temp-gruu', None)
+                            notification_data = NotificationData(code=notification.data.code, reason=notification.data.reason, registration=self._registration, registrar=route)
+                            notification_center.post_notification('SIPAccountRegistrationGotAnswer', sender=self.account, data=notification_data)
+                            self.registered = True
+                            # Save GRUU
                             try:
-                                self.account.contact.public_gruu = SIPURI.parse(public_gruu.strip('"'))
-                            except (AttributeError, SIPCoreError):
+                                header = next(header for header in notification.data.contact_header_list if header.parameters.get('+sip.instance', '').strip('"<>') == settings.instance_id)
+                            except StopIteration:
                                 self.account.contact.public_gruu = None
-                            try:
-                                self.account.contact.temporary_gruu = SIPURI.parse(temporary_gruu.strip('"'))
-                            except (AttributeError, SIPCoreError):
                                 self.account.contact.temporary_gruu = None
-                        notification_data = NotificationData(contact_header=notification.data.contact_header,
-                                                             contact_header_list=notification.data.contact_header_list,
-                                                             expires=notification.data.expires_in, registrar=route)
-                        notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
-                        self._register_wait = 1
-                        command.signal()
-                        break
-            else:
-                # There are no more routes to try, reschedule the registration
-                retry_after = int(random.uniform(self._register_wait, 2*self._register_wait))
-                self._register_wait = limit(self._register_wait*2, max=30)
-                raise RegistrationError('No more routes to try', retry_after=retry_after)
+                            else:
+                                public_gruu = header.parameters.get('pub-gruu', None)
+                                temporary_gruu = header.parameters.get('temp-gruu', None)
+                                try:
+                                    self.account.contact.public_gruu = SIPURI.parse(public_gruu.strip('"'))
+                                except (AttributeError, SIPCoreError):
+                                    self.account.contact.public_gruu = None
+                                try:
+                                    self.account.contact.temporary_gruu = SIPURI.parse(temporary_gruu.strip('"'))
+                                except (AttributeError, SIPCoreError):
+                                    self.account.contact.temporary_gruu = None
+                            notification_data = NotificationData(contact_header=notification.data.contact_header,
+                                                                 contact_header_list=notification.data.contact_header_list,
+                                                                 expires=notification.data.expires_in, registrar=route)
+                            notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
+                            self._register_wait = 1
+                            command.signal()
+                            break
+                else:
+                    # There are no more routes to try, reschedule the registration
+                    retry_after = int(random.uniform(self._register_wait, 2*self._register_wait))
+                    self._register_wait = limit(self._register_wait*2, max=30)
+                    raise RegistrationError('No more routes to try', retry_after=retry_after)
         except RegistrationError as e:
             self.registered = False
             notification_center.discard_observer(self, sender=self._registration)
@@ -256,17 +394,18 @@ class Registrar(object):
         if self._registration is not None:
             notification_center = NotificationCenter()
             if registered:
-                self._registration.end(timeout=2)
-                try:
-                    while True:
-                        notification = self._data_channel.wait()
-                        if notification.name == 'SIPRegistrationDidEnd':
-                            break
-                except (SIPRegistrationDidFail, SIPRegistrationDidNotEnd) as e:
-                    notification_center.post_notification('SIPAccountRegistrationDidNotEnd', sender=self.account, data=NotificationData(code=e.data.code, reason=e.data.reason,
-                                                                                                                                        registration=self._registration))
-                else:
-                    notification_center.post_notification('SIPAccountRegistrationDidEnd', sender=self.account, data=NotificationData(registration=self._registration))
+                with RegistrationScheduler().transaction(self._registration_destination):
+                    self._registration.end(timeout=2)
+                    try:
+                        while True:
+                            notification = self._data_channel.wait()
+                            if notification.name == 'SIPRegistrationDidEnd':
+                                break
+                    except (SIPRegistrationDidFail, SIPRegistrationDidNotEnd) as e:
+                        notification_center.post_notification('SIPAccountRegistrationDidNotEnd', sender=self.account, data=NotificationData(code=e.data.code, reason=e.data.reason,
+                                                                                                                                            registration=self._registration))
+                    else:
+                        notification_center.post_notification('SIPAccountRegistrationDidEnd', sender=self.account, data=NotificationData(registration=self._registration))
             notification_center.remove_observer(self, sender=self._registration)
             self._registration = None
             self.account.contact.public_gruu = None
@@ -313,12 +452,10 @@ class Registrar(object):
                 self.activate()
             else:
                 self.deactivate()
-        elif self.active and {'__id__', 'auth.password', 'auth.username', 'nat_traversal.use_ice', 'sip.outbound_proxy', 'sip.transport_list', 'sip.register_interval'}.intersection(notification.data.modified):
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+        elif {'__id__', 'auth.password', 'auth.username', 'nat_traversal.use_ice', 'sip.outbound_proxy', 'sip.transport_list', 'sip.register_interval'}.intersection(notification.data.modified):
+            self.reregister()
 
     def _NH_NetworkConditionsDidChange(self, notification):
-        if self.active:
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+        RegistrationScheduler().clear_routes()
+        self.reregister()
 
@@ -30,6 +30,7 @@ from application.notification import IObserver, NotificationCenter, Notification
 from application.python import Null
 from eventlib import api, coros, proc
 from eventlib.green.httplib import BadStatusLine
+from lxml import etree
 from twisted.internet.error import ConnectionLost
 from xcaplib.error import HTTPError
 from zope.interface import implementer
@@ -61,10 +62,17 @@ class Document(object):
     filename           = None
     cached             = True
 
+    # Changes are sent as element level PUT/DELETE requests when there are at most max_element_updates
+    # of them, otherwise (or when the server does not accept them) the whole document is replaced.
+    element_updates     = True
+    max_element_updates = 10
+
     def __init__(self, manager):
         self.manager = weakref.proxy(manager)
         self.content = None
         self.etag = None
+        self.server_data = None  # the document as it is on the server, for the current etag
+        self.server_namespaces = set()
         self.fetch_time = datetime.fromtimestamp(0)
         self.update_time = datetime.fromtimestamp(0)
         self.dirty = False
@@ -98,16 +106,20 @@ class Document(object):
             doc_io = self.manager.storage.load(self.name)
             document = StringIO(doc_io.decode())
             self.etag = document.readline().strip() or None
+            position = document.tell()
             self.content = self.payload_type.parse(document)
+            self.server_data = document.getvalue()[position:].encode()
             self.__dict__['dirty'] = False
         except (XCAPStorageError, ParserError):
             self.etag = None
             self.content = None
+            self.server_data = None
             self.dirty = False
         self.fetch_time = datetime.utcnow()
 
     def initialize(self, server_caps):
         self.supported = self.application in server_caps.auids
+        self.server_namespaces = set(server_caps.namespaces)
         if not self.supported:
             self.reset()
 
@@ -119,6 +131,7 @@ class Document(object):
                 pass
         self.content = None
         self.etag = None
+        self.server_data = None
         self.dirty = False
 
     def fetch(self):
@@ -130,6 +143,7 @@ class Document(object):
             document = self.manager.client.get(self.application, etagnot=self.etag, globaltree=self.global_tree, headers={'Accept': self.payload_type.content_type}, filename=self.filename)
             self.content = self.payload_type.parse(document)
             self.etag = document.etag
+            self.server_data = document if isinstance(document, bytes) else document.encode()
             self.__dict__['dirty'] = False
         except (BadStatusLine, ConnectionLost, URLError, TimeoutError, socket.error) as e:
             notification_data = NotificationData(method='GET', url=self.url, application=self.application, result='failure', reason=str(e), code=408, etag=self.etag)
@@ -177,6 +191,10 @@ class Document(object):
         data = self.content.toxml() if self.content is not None else None
         method = 'PUT' if data is not None else 'DELETE'
 
+        if data is not None and self._update_elements(data):
+            self._finish_update(method, data)
+            return
+
         try:
             kw = dict(etag=self.etag) if self.etag is not None else dict(etagnot='*')
             if data is not None:
@@ -203,7 +221,11 @@ class Document(object):
         self.etag = response.etag if data is not None else None
         notification_data = NotificationData(method=method, url=self.url, application=self.application, result='success', reason='changed', code=200, etag=self.etag, size=len(data) if data else 0)
         notification_center.post_notification('XCAPTrace', sender=self, data=notification_data)
+        self._finish_update(method, data)
 
+    def _finish_update(self, method, data):
+        notification_center = NotificationCenter()
+        self.server_data = data
         self.dirty = False
         self.update_time = datetime.utcnow()
         if self.cached:
@@ -218,6 +240,133 @@ class Document(object):
                 notification_data = NotificationData(method=method, url=self.url, application=self.application, result='failed', reason='storage failure: %s' % str(e), code=500, etag=self.etag, size=len(data))
                 notification_center.post_notification('XCAPTrace', sender=self, data=notification_data)
 
+    def _update_elements(self, data):
+        """
+        Send the changes between the document on the server and data as element level PUT/DELETE requests.
+        Returns False if the whole document needs to be replaced instead.
+        """
+        if not self.element_updates or self.etag is None or self.server_data is None:
+            return False
+        changes = self._get_element_changes(self.server_data, data)
+        if changes is None:
+            return False
+        notification_center = NotificationCenter()
+        for method, node, element in changes:
+            element_data = etree.tostring(element, encoding='UTF-8', with_tail=False) if element is not None else None
+            try:
+                if method == 'PUT':
+                    response = self.manager.client.put(self.application, element_data, node=node, globaltree=self.global_tree, filename=self.filename, headers={'Content-Type': 'application/xcap-el+xml'}, etag=self.etag)
+                else:
+                    response = self.manager.client.delete(self.application, node=node, globaltree=self.global_tree, filename=self.filename, etag=self.etag)
+            except (BadStatusLine, ConnectionLost, URLError) as e:
+                notification_data = NotificationData(method=method, url=self.url, node=node, application=self.application, result='failure', reason=str(e), code=408, etag=self.etag)
+                notification_center.post_notification('XCAPTrace', sender=self, data=notification_data)
+                raise XCAPError("failed to update %s document: %s" % (self.name, e))
+            except HTTPError as e:
+                notification_data = NotificationData(method=method, url=self.url, node=node, application=self.application, result='failure', reason=str(e), code=e.status, etag=self.etag)
+                notification_center.post_notification('XCAPTrace', sender=self, data=notification_data)
+                if e.status == 412: # Precondition Failed
+                    raise FetchRequiredError("document %s was modified externally" % self.name)
+                elif e.status == 401:
+                    raise XCAPError("failed to update %s document: auth failed (401)" % self.name)
+                # The server did not accept the change at the element level (or does not support that), replace the document
+                return False
+            if getattr(response, 'etag', None) is None:
+                # Without the new etag the document cannot be updated any further without fetching it again
+                raise FetchRequiredError("missing etag for %s document after updating an element" % self.name)
+            self.etag = response.etag
+            notification_data = NotificationData(method=method, url=self.url, node=node, application=self.application, result='success', reason='changed', code=200, etag=self.etag, size=len(element_data) if element_data else 0)
+            notification_center.post_notification('XCAPTrace', sender=self, data=notification_data)
+        return True
+
+    def _get_element_changes(self, old_data, new_data):
+        # Returns a list of (method, node selector, element) tuples, or None if the whole document needs to be replaced
+        try:
+            old_root = etree.fromstring(old_data)
+            new_root = etree.fromstring(new_data)
+        except (etree.XMLSyntaxError, ValueError):
+            return None
+        root_key = (new_root.tag, None, None)
+        changes = []
+        if old_root.tag != new_root.tag or not self._compare_elements(old_root, new_root, [root_key], changes):
+            return None
+        if len(changes) > self.max_element_updates:
+            return None
+        namespaces = {}
+        result = []
+        for method, path, element in changes:
+            node = self._get_node_selector(path, namespaces)
+            if node is None:
+                return None
+            result.append((method, node, element))
+        if not self.server_namespaces.issuperset(namespaces):
+            return None
+        if namespaces:
+            query = '?' + ''.join('xmlns(%s=%s)' % (prefix, namespace) for namespace, prefix in namespaces.items())
+            result = [(method, node + query, element) for method, node, element in result]
+        return result
+
+    @classmethod
+    def _compare_elements(cls, old, new, path, changes):
+        # Adds the changes needed to turn old into new to changes. Returns False if the element itself changed and
+        # needs to be replaced.
+        if dict(old.attrib) != dict(new.attrib) or (old.text or '').strip() != (new.text or '').strip():
+            return False
+        old_children = cls._get_element_children(old)
+        new_children = cls._get_element_children(new)
+        if old_children is None or new_children is None:
+            return etree.tostring(old, method='c14n', with_tail=False) == etree.tostring(new, method='c14n', with_tail=False)
+        for key in old_children:
+            if key not in new_children:
+                changes.append(('DELETE', path + [key], None))
+        for key, child in new_children.items():
+            old_child = old_children.get(key)
+            child_changes = []
+            if old_child is not None and cls._compare_elements(old_child, child, path + [key], child_changes):
+                changes.extend(child_changes)
+            else:
+                changes.append(('PUT', path + [key], child))
+        return True
+
+    @staticmethod
+    def _get_element_children(element):
+        # Maps the children to the node selector step that identifies them, or returns None if not all can be identified
+        children = OrderedDict()
+        tags = [child.tag for child in element if isinstance(child.tag, str)]
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            for attribute in ('id', 'name', 'uri'):
+                value = child.get(attribute)
+                if value is not None:
+                    if '"' in value and "'" in value:
+                        return None
+                    key = (child.tag, attribute, value)
+                    break
+            else:
+                if tags.count(child.tag) > 1:
+                    return None
+                key = (child.tag, None, None)
+            if key in children:
+                return None
+            children[key] = child
+        return children
+
+    def _get_node_selector(self, path, namespaces):
+        steps = []
+        for tag, attribute, value in path:
+            if not tag.startswith('{'):
+                return None
+            namespace, name = tag[1:].split('}', 1)
+            if namespace != self.default_namespace:
+                prefix = namespaces.setdefault(namespace, 'ns%d' % (len(namespaces) + 1))
+                name = '%s:%s' % (prefix, name)
+            if attribute is not None:
+                quote = "'" if '"' in value else '"'
+                name = '%s[@%s=%s%s%s]' % (name, attribute, quote, value, quote)
+            steps.append(name)
+        return '/'.join(steps)
+
 
 class DialogRulesDocument(Document):
     name               = 'dialog-rules'
@@ -760,18 +909,8 @@ class XCAPManager(object):
             for document in self.documents:
                 document.load_from_cache()
 
-        try:
-            journal = self.storage.load('journal')
-        except XCAPStorageError:
-            self.journal = []
-        else:
-            try:
-                self.journal = pickle.loads(journal)
-            except Exception:
-                self.journal = []
-
-        for operation in self.journal:
-            operation.applied = False
+        self.journal = self._load_journal()
+        self._unsaved_operations = []
 
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=account, name='CFGSettingsObjectDidChange')
@@ -926,6 +1065,7 @@ class XCAPManager(object):
     @run_in_twisted_thread
     def _schedule_operation(self, operation):
         self.journal.append(operation)
+        self._unsaved_operations.append(operation)
         if self.transaction_level == 0:
             self._save_journal()
             self.command_channel.send(Command('update'))
@@ -987,6 +1127,7 @@ class XCAPManager(object):
         except XCAPStorageError:
             pass
         self.journal = []
+        self._unsaved_operations = []
         self.state = 'terminated'
         command.signal()
         raise proc.ProcExit
@@ -1053,7 +1194,7 @@ class XCAPManager(object):
                 pass
             self.storage = self.storage_factory(self.account.id)
             self.journal = []
-            self._save_journal()
+            self._compact_journal()
         if {'__id__', 'xcap.xcap_root'}.intersection(command.modified):
             for document in self.documents:
                 document.reset()
@@ -1143,7 +1284,7 @@ class XCAPManager(object):
             if self.not_executed_fetch is not None:
                 self.command_channel.send(self.not_executed_fetch)
                 self.not_executed_fetch = None
-            self._save_journal()
+            self._compact_journal()
 
     # Operation handlers
     #
@@ -1863,9 +2004,58 @@ class XCAPManager(object):
                 for worker in workers:
                     worker.wait_ex()
 
+    def _load_journal(self):
+        # The journal is stored as a log with one pickled operation per record. Older versions pickled the whole
+        # journal as a list in the 'journal' file, which is converted if present.
+        try:
+            records = self.storage.load_log('journal.log')
+        except XCAPStorageError:
+            records = []
+        journal = []
+        for record in records:
+            try:
+                journal.append(pickle.loads(record))
+            except Exception:
+                pass
+        try:
+            legacy_journal = pickle.loads(self.storage.load('journal'))
+        except XCAPStorageError:
+            pass
+        except Exception:
+            try:
+                self.storage.delete('journal')
+            except XCAPStorageError:
+                pass
+        else:
+            journal = legacy_journal + journal
+            try:
+                self.storage.save_log('journal.log', [pickle.dumps(operation) for operation in journal])
+                self.storage.delete('journal')
+            except XCAPStorageError:
+                pass
+        for operation in journal:
+            operation.applied = False
+        return journal
+
     def _save_journal(self):
+        # Append the operations scheduled since the journal was last saved
+        if not self._unsaved_operations:
+            return
         try:
-            self.storage.save('journal', pickle.dumps(self.journal))
+            self.storage.append_log('journal.log', [pickle.dumps(operation) for operation in self._unsaved_operations])
+        except XCAPStorageError:
+            pass
+        else:
+            self._unsaved_operations = []
+
+    def _compact_journal(self):
+        # Rewrite the journal log so that it only contains the operations that were not yet applied on the server
+        self._unsaved_operations = []
+        try:
+            if self.journal:
+                self.storage.save_log('journal.log', [pickle.dumps(operation) for operation in self.journal])
+            else:
+                self.storage.delete('journal.log')
         except XCAPStorageError:
             pass
 
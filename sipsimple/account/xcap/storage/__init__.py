@@ -29,6 +29,19 @@ class IXCAPStorage(Interface):
     def delete(name):
         """Delete the data associated with name."""
 
+    def load_log(name):
+        """
+        Return the list of records appended to the log identified by name.
+        Replay stops at the first incomplete or damaged record, which can be
+        left behind by a crash while appending.
+        """
+
+    def append_log(name, records):
+        """Append the records (bytes) to the log identified by name."""
+
+    def save_log(name, records):
+        """Replace the content of the log identified by name with records."""
+
     def purge():
         """Delete all the data stored by the backend."""
 
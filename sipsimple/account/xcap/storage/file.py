@@ -7,6 +7,8 @@ import errno
 import os
 import platform
 import random
+import struct
+import zlib
 
 from application.system import makedirs, openfile, unlink
 from zope.interface import implementer
@@ -16,8 +18,15 @@ from sipsimple.account.xcap.storage import IXCAPStorage, XCAPStorageError
 
 @implementer(IXCAPStorage)
 class FileStorage(object):
-    """Implementation of an XCAP backend that stores data in files."""
+    """
+    Implementation of an XCAP backend that stores data in files.
 
+    Logs are stored as a sequence of records, each preceded by its length
+    and its CRC32 as 32 bit numbers in network byte order, so that records
+    can be appended without rewriting the file.
+    """
+
+    _log_header = struct.Struct('!II')
 
     def __init__(self, directory, account_id):
         """Initialize the storage for the specified directory and account ID"""
@@ -69,6 +78,52 @@ class FileStorage(object):
             except KeyError:
                 pass
 
+    def load_log(self, name):
+        """Read the records in the log file given by name, dropping a damaged or incomplete tail."""
+        filename = os.path.join(self.directory, self.account_id, name)
+        try:
+            with open(filename, 'rb') as file:
+                data = file.read()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise XCAPStorageError("failed to load XCAP log for %s/%s: %s" % (self.account_id, name, str(e)))
+        self.names.add(name)
+        records = []
+        offset = 0
+        header_size = self._log_header.size
+        while offset + header_size <= len(data):
+            length, checksum = self._log_header.unpack_from(data, offset)
+            record = data[offset+header_size:offset+header_size+length]
+            if len(record) != length or zlib.crc32(record) != checksum:
+                break
+            records.append(record)
+            offset += header_size + length
+        if offset != len(data):
+            # Left behind by a crash while appending, remove it so that new records are not appended after it
+            try:
+                os.truncate(filename, offset)
+            except (IOError, OSError) as e:
+                raise XCAPStorageError("failed to repair XCAP log for %s/%s: %s" % (self.account_id, name, str(e)))
+        return records
+
+    def append_log(self, name, records):
+        """Append the records to the log file given by name."""
+        filename = os.path.join(self.directory, self.account_id, name)
+        data = b''.join(self._log_header.pack(len(record), zlib.crc32(record)) + record for record in records)
+        try:
+            makedirs(os.path.join(self.directory, self.account_id))
+            with os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), 'ab') as file:
+                file.write(data)
+        except (IOError, OSError) as e:
+            raise XCAPStorageError("failed to append to XCAP log for %s/%s: %s" % (self.account_id, name, str(e)))
+        else:
+            self.names.add(name)
+
+    def save_log(self, name, records):
+        """Replace the log file given by name with one containing the records."""
+        self.save(name, b''.join(self._log_header.pack(len(record), zlib.crc32(record)) + record for record in records))
+
     def purge(self):
         """Delete all the files stored by the backend"""
         failed = []
@@ -32,6 +32,18 @@ class MemoryStorage(object):
         """Delete the data identified by name"""
         self.data.pop(name, None)
 
+    def load_log(self, name):
+        """Return the records of the log given by name"""
+        return list(self.data.get(name, []))
+
+    def append_log(self, name, records):
+        """Append the records to the log given by name"""
+        self.data.setdefault(name, []).extend(records)
+
+    def save_log(self, name, records):
+        """Replace the records of the log given by name"""
+        self.data[name] = list(records)
+
     def purge(self):
         """Delete all the data that is stored in the backend"""
         self.data.clear()
@@ -1245,7 +1245,8 @@ class AddressbookManager(object, metaclass=Singleton):
                 self.__migrate_contacts(old_data)
                 return
 
-        with MultiAccountTransaction(xcap_accounts):
+        # the contacts, groups and policies are written to the configuration all at once, when the transaction commits
+        with ConfigurationManager().transaction(), MultiAccountTransaction(xcap_accounts):
             # because groups depend on contacts, operation order is add/update contacts, add/update/remove groups & policies, remove contacts -Dan
 
             for xcap_contact in xcap_contacts:
@@ -1337,7 +1338,7 @@ class AddressbookManager(object, metaclass=Singleton):
     def __migrate_contacts(self, old_data):
         account_manager = AccountManager()
         xcap_accounts = [account for account in account_manager.get_accounts() if account.xcap.discovered]
-        with MultiAccountTransaction(xcap_accounts):
+        with ConfigurationManager().transaction(), MultiAccountTransaction(xcap_accounts):
             # restore the old contacts and groups
             old_groups = old_data['groups']
             old_contacts = old_data['contacts']
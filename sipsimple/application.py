@@ -34,7 +34,7 @@ from sipsimple.core import AudioMixer, Engine, SIPCoreError, PJSIPError
 from sipsimple.lookup import DNSManager
 from sipsimple.session import SessionManager, TerminateSubscription
 from sipsimple.storage import ISIPSimpleStorage, ISIPSimpleApplicationDataStorage
-from sipsimple.threading import ThreadManager, run_in_thread, run_in_twisted_thread
+from sipsimple.threading import ThreadManager, call_in_thread, run_in_thread, run_in_twisted_thread
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.video import VideoDevice
 
@@ -317,6 +317,10 @@ class SIPApplication(object, metaclass=Singleton):
         procs = [proc.spawn(dns_manager.stop), proc.spawn(account_manager.stop), proc.spawn(addressbook_manager.stop), proc.spawn(session_manager.stop)]
         proc.waitall(procs)
 
+        # write out the Sylk-ZRTP retained secrets updated by the sessions
+        from sipsimple.streams.rtp.sylk_zrtp import close_secret_store
+        close_secret_store(timeout=5)
+
         # stop video device
         self.video_device.producer.close()
 
@@ -324,6 +328,9 @@ class SIPApplication(object, metaclass=Singleton):
         self.engine.stop()
         self.engine.join(timeout=5)
 
+        # write the configuration changes that are still pending, before the file-io thread is stopped
+        call_in_thread('file-io', ConfigurationManager().flush)
+
         # stop threads
         thread_manager = ThreadManager()
         thread_manager.stop()
@@ -3,10 +3,11 @@
 
 
 
-__all__ = ['IAudioPort', 'AudioDevice', 'AudioBridge', 'RootAudioBridge', 'AudioConference', 'WavePlayer', 'WavePlayerError', 'WaveRecorder']
+__all__ = ['IAudioPort', 'AudioDevice', 'AudioBridge', 'RootAudioBridge', 'AudioConference', 'AudioMixerPool', 'AudioMixerLinkPort', 'WavePlayer', 'WavePlayerError', 'WaveRecorder']
 
 import os
 import weakref
+from collections import OrderedDict
 from functools import partial
 from itertools import combinations
 from threading import RLock
@@ -17,7 +18,7 @@ from eventlib import coros
 from twisted.internet import reactor
 from zope.interface import Attribute, Interface, implementer
 
-from sipsimple.core import MixerPort, RecordingWaveFile, SIPCoreError, WaveFile
+from sipsimple.core import AudioMixer, AudioMixerLink, MixerPort, RecordingWaveFile, SIPCoreError, WaveFile
 from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import Command, run_in_green_thread, run_in_waitable_green_thread
 
@@ -389,6 +390,136 @@ class AudioConference(object):
             self.on_hold = False
 
 
+class AudioMixerPool(object):
+    """
+    A pool of audio mixers that are not connected to any audio device. Every
+    mixer has its own conference bridge and clock thread, so the mixing for
+    independent calls is spread over several threads and the number of calls
+    is not limited by the slots of a single bridge.
+
+    A mixer is chosen for every new stream by get_mixer(): requests with the
+    same key (for example the URI of a conference room) are placed on the
+    same mixer for as long as it has enough free slots, otherwise the least
+    used mixer is chosen. The pool can be used as RTPStream.mixer_factory.
+    Ports on different mixers can be connected using an AudioMixerLinkPort.
+    """
+
+    reserved_slots = 8           # free slots a mixer must have to receive more streams for a key placed on it
+    reserved_mixers = 4          # mixers left for SIPApplication, which replaces its 2 mixers when the audio devices change
+    max_affinity_entries = 10000
+
+    def __init__(self, sample_rate, size, slot_count=254):
+        max_size = AudioMixer.max_instances - self.reserved_mixers
+        if not 1 <= size <= max_size:
+            raise ValueError('the pool must contain between 1 and %d mixers' % max_size)
+        self._lock = RLock()
+        self._affinity = OrderedDict()
+        self.mixers = [AudioMixer(None, None, sample_rate, 0, slot_count) for _ in range(size)]
+
+    def __call__(self, request_uri):
+        return self.get_mixer(str(request_uri) if request_uri is not None else None)
+
+    def get_mixer(self, key=None):
+        with self._lock:
+            if key is not None:
+                mixer = self._affinity.get(key)
+                if mixer is not None and mixer.slot_count - mixer.used_slot_count >= self.reserved_slots:
+                    self._affinity.move_to_end(key)
+                    return mixer
+            mixer = min(self.mixers, key=lambda mixer: mixer.used_slot_count)
+            if key is not None:
+                self._affinity[key] = mixer
+                self._affinity.move_to_end(key)
+                while len(self._affinity) > self.max_affinity_entries:
+                    self._affinity.popitem(last=False)
+            return mixer
+
+    def link(self, port, mixer):
+        """Return an audio port through which the given port can be used on the given mixer"""
+        return port if port.mixer is mixer else AudioMixerLinkPort(port, mixer)
+
+    @property
+    def statistics(self):
+        return [mixer.statistics for mixer in self.mixers]
+
+
+@implementer(IAudioPort, IObserver)
+class AudioMixerLinkPort(object):
+    """
+    Makes an audio port that lives on one mixer usable on another mixer, for
+    example to add it to a bridge built on that mixer. The audio is carried
+    between the two mixers by a pair of AudioMixerLink objects, one for each
+    direction, which are connected to the slots of the original port.
+    """
+
+    def __init__(self, port, mixer):
+        if not IAudioPort.providedBy(port):
+            raise TypeError("expected object implementing IAudioPort, got %s" % port.__class__.__name__)
+        if port.mixer is mixer:
+            raise ValueError("the port already uses Mixer %r" % mixer)
+        self._lock = RLock()
+        self.mixer = mixer
+        self.port = port
+        self._outgoing_link = AudioMixerLink(port.mixer, mixer)
+        self._incoming_link = AudioMixerLink(mixer, port.mixer)
+        self._outgoing_link.start()
+        try:
+            self._incoming_link.start()
+        except:
+            self._outgoing_link.stop()
+            raise
+        if port.producer_slot is not None:
+            port.mixer.connect_slots(port.producer_slot, self._outgoing_link.source_slot)
+        if port.consumer_slot is not None:
+            port.mixer.connect_slots(self._incoming_link.destination_slot, port.consumer_slot)
+        notification_center = NotificationCenter()
+        notification_center.add_observer(ObserverWeakrefProxy(self), sender=port, name='AudioPortDidChangeSlots')
+
+    def __del__(self):
+        # __init__ may have failed before creating the links
+        for link in (self.__dict__.get('_outgoing_link'), self.__dict__.get('_incoming_link')):
+            if link is not None:
+                link.stop()
+
+    @property
+    def consumer_slot(self):
+        return self._incoming_link.source_slot
+
+    @property
+    def producer_slot(self):
+        return self._outgoing_link.destination_slot
+
+    def stop(self):
+        with self._lock:
+            old_consumer_slot = self.consumer_slot
+            old_producer_slot = self.producer_slot
+            if old_consumer_slot is None and old_producer_slot is None:
+                return
+            notification_center = NotificationCenter()
+            notification_center.discard_observer(ObserverWeakrefProxy(self), sender=self.port, name='AudioPortDidChangeSlots')
+            self._outgoing_link.stop()
+            self._incoming_link.stop()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=True, producer_slot_changed=True,
+                                                                                                            old_consumer_slot=old_consumer_slot, new_consumer_slot=None,
+                                                                                                            old_producer_slot=old_producer_slot, new_producer_slot=None))
+
+    def handle_notification(self, notification):
+        with self._lock:
+            if notification.sender is not self.port or not self._outgoing_link.is_active:
+                return
+            mixer = self.port.mixer
+            if notification.data.consumer_slot_changed:
+                if notification.data.old_consumer_slot is not None:
+                    mixer.disconnect_slots(self._incoming_link.destination_slot, notification.data.old_consumer_slot)
+                if notification.data.new_consumer_slot is not None:
+                    mixer.connect_slots(self._incoming_link.destination_slot, notification.data.new_consumer_slot)
+            if notification.data.producer_slot_changed:
+                if notification.data.old_producer_slot is not None:
+                    mixer.disconnect_slots(notification.data.old_producer_slot, self._outgoing_link.source_slot)
+                if notification.data.new_producer_slot is not None:
+                    mixer.connect_slots(notification.data.new_producer_slot, self._outgoing_link.source_slot)
+
+
 @implementer(IAudioPort, IObserver)
 class WavePlayer(object):
     """
@@ -9,7 +9,8 @@ __all__ = ['ConfigurationManager', 'ConfigurationError', 'ObjectNotFoundError',
 from abc import ABCMeta, abstractmethod
 from itertools import chain
 from operator import attrgetter
-from threading import Lock
+from threading import Lock, Timer
+from time import time
 from weakref import WeakSet
 
 from application.notification import NotificationCenter, NotificationData
@@ -18,7 +19,7 @@ from application.python.types import Singleton
 from application.python.weakref import weakobjectmap
 
 from sipsimple import log
-from sipsimple.threading import run_in_thread
+from sipsimple.threading import call_in_thread, run_in_thread
 from functools import reduce
 
 
@@ -49,11 +50,32 @@ class ConfigurationManager(object, metaclass=Singleton):
     Singleton class used for storing and retrieving options, organized in
     sections. A section contains a list of objects, each with an assigned name
     which allows access to the object.
+
+    Saving rewrites the whole configuration, so changes made in bulk should
+    be grouped in a transaction, which defers the saves made while it is open
+    to a single write when it is committed:
+
+    with ConfigurationManager().transaction():
+        ...
+
+    Transactions are started and committed in the file-io thread, where the
+    settings objects are saved. Outside of a transaction the settings objects
+    use save_later(), which writes the configuration once a burst of changes
+    is over. flush() writes the deferred changes right away.
     """
 
+    save_delay = 0.5
+    max_save_delay = 5
+
     def __init__(self):
         self.backend = None
         self.data = None
+        self.transaction_level = 0
+        self._dirty = False
+        self._lock = Lock()
+        self._save_timer = None
+        self._save_time = None
+        self._save_deadline = None
 
     def start(self):
         """
@@ -144,14 +166,105 @@ class ConfigurationManager(object, metaclass=Singleton):
         except KeyError:
             return []
 
+    def transaction(self):
+        return ConfigurationTransaction(self)
+
+    @run_in_thread('file-io')
+    def start_transaction(self):
+        self.transaction_level += 1
+
+    @run_in_thread('file-io')
+    def commit_transaction(self):
+        if self.transaction_level == 0:
+            return
+        self.transaction_level -= 1
+        if self.transaction_level == 0:
+            self._save_pending()
+
     def save(self):
         """
-        Flush the modified objects. Cannot be called before start().
+        Flush the modified objects. While a transaction is in progress the
+        write is deferred until it is committed. Cannot be called before
+        start().
         """
         if self.backend is None:
             raise RuntimeError("ConfigurationManager cannot be used unless started")
+        if self.transaction_level > 0:
+            self._dirty = True
+            return
+        with self._lock:
+            self._cancel_save_timer()
+            self._dirty = False
         self.backend.save(self.data)
 
+    def save_later(self):
+        """
+        Flush the modified objects after save_delay seconds. Every call
+        restarts the delay, but the objects are flushed at most
+        max_save_delay seconds after the first call. Cannot be called before
+        start().
+        """
+        if self.backend is None:
+            raise RuntimeError("ConfigurationManager cannot be used unless started")
+        with self._lock:
+            self._dirty = True
+            now = time()
+            if self._save_deadline is None:
+                self._save_deadline = now + self.max_save_delay
+            self._save_time = min(now + self.save_delay, self._save_deadline)
+            if self._save_timer is None:
+                self._start_save_timer(self._save_time - now)
+
+    def flush(self):
+        """
+        Write the modifications whose saving was deferred, if there are any.
+        """
+        with self._lock:
+            self._cancel_save_timer()
+            if not self._dirty or self.backend is None:
+                return
+            self._dirty = False
+        try:
+            self.backend.save(self.data)
+        except Exception:
+            self._dirty = True
+            raise
+
+    def _start_save_timer(self, delay):
+        # Must be called with the lock held
+        self._save_timer = Timer(max(delay, 0), self._cb_save_timer)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def _cancel_save_timer(self):
+        # Must be called with the lock held
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+        self._save_timer = None
+        self._save_time = None
+        self._save_deadline = None
+
+    def _cb_save_timer(self):
+        with self._lock:
+            if self._save_timer is None:
+                return
+            remaining = self._save_time - time()
+            if remaining > 0:
+                self._start_save_timer(remaining)
+                return
+            self._save_timer = None
+        call_in_thread('file-io', self._save_pending)
+
+    def _save_pending(self):
+        if self.transaction_level > 0:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            log.exception()
+            notification_center = NotificationCenter()
+            notification_center.post_notification('CFGManagerSaveFailed', sender=self, data=NotificationData(object=None, operation='save', modified=None, exception=e))
+
     def _get(self, data_tree, key):
         subtree_key = key.pop(0)
         data_subtree = data_tree[subtree_key]
@@ -212,6 +325,18 @@ class ConfigurationManager(object, metaclass=Singleton):
                 old_data[key] = value
 
 
+class ConfigurationTransaction(object):
+    def __init__(self, configuration_manager):
+        self.configuration_manager = configuration_manager
+
+    def __enter__(self):
+        self.configuration_manager.start_transaction()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.configuration_manager.commit_transaction()
+
+
 # Descriptors and base classes used for representing configuration settings
 
 class DefaultValue(object):
@@ -900,8 +1025,10 @@ class SettingsObject(SettingsState, metaclass=SettingsObjectMeta):
 
         This method will also post a CFGSettingsObjectDidChange notification,
         regardless of whether the settings have been saved to persistent storage
-        or not. If the save does fail, a CFGManagerSaveFailed notification is
-        posted as well.
+        or not. The object is written to persistent storage with the other
+        changes made in a short interval, or once the ConfigurationManager
+        transaction commits when saved inside one. If the write does fail, a
+        CFGManagerSaveFailed notification is posted as well.
         """
 
         if self.__state__ == 'deleted':
@@ -938,7 +1065,7 @@ class SettingsObject(SettingsState, metaclass=SettingsObjectMeta):
             notification_center.post_notification('CFGSettingsObjectDidChange', sender=self, data=NotificationData(modified=modified_data))
 
         try:
-            configuration.save()
+            configuration.save_later()
         except Exception as e:
             log.exception()
             notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='save', modified=modified_data, exception=e))
@@ -959,7 +1086,7 @@ class SettingsObject(SettingsState, metaclass=SettingsObjectMeta):
         configuration.delete(self.__oldkey__) # we need the key that wasn't yet saved
         notification_center.post_notification('CFGSettingsObjectWasDeleted', sender=self)
         try:
-            configuration.save()
+            configuration.save_later()
         except Exception as e:
             log.exception()
             notification_center.post_notification('CFGManagerSaveFailed', sender=configuration, data=NotificationData(object=self, operation='delete', exception=e))
@@ -1,14 +1,39 @@
 
 # C types
 
+cdef extern from *:
+    """
+    #define _event_ring_load(ptr) __atomic_load_n((ptr), __ATOMIC_ACQUIRE)
+    #define _event_ring_store(ptr, value) __atomic_store_n((ptr), (value), __ATOMIC_RELEASE)
+    #define _event_ring_cas(ptr, expected, desired) __atomic_compare_exchange_n((ptr), (expected), (desired), 0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)
+    #define _event_ring_inc(ptr) __atomic_add_fetch((ptr), 1, __ATOMIC_RELAXED)
+    """
+    size_t _event_ring_load(size_t *ptr) nogil
+    void _event_ring_store(size_t *ptr, size_t value) nogil
+    bint _event_ring_cas(size_t *ptr, size_t *expected, size_t desired) nogil
+    size_t _event_ring_inc(size_t *ptr) nogil
+
 cdef struct _core_event:
-    _core_event *prev
     _core_event *next
+    size_t sequence
     int is_log
     int level
     void *data
     int len
 
+# Bounded multi-producer/single-consumer queue of preallocated events. Every slot carries a sequence number
+# which tells producers whether it is free and the consumer whether it was published, so neither side needs
+# a lock. Events which do not fit spill over into the mutex protected overflow list. While the overflow list
+# is not empty, producers keep appending to it, which preserves the ordering of the events posted by a thread.
+cdef struct _core_event_ring:
+    _core_event *events
+    size_t mask
+    size_t enqueue_pos
+    size_t dequeue_pos
+    size_t spilled
+    size_t high_water_mark
+    size_t overflow_count
+
 cdef struct _handler:
     _handler *next
     _handler *prev
@@ -22,41 +47,125 @@ cdef struct _handler_queue:
 # callback functions
 
 cdef void _cb_log(int level, char_ptr_const data, int len) noexcept:
-    cdef _core_event *event
-    event = <_core_event *> malloc(sizeof(_core_event))
-    if event != NULL:
-        event.data = malloc(len)
-        if event.data == NULL:
-            free(event)
-            return
-        event.is_log = 1
-        event.level = level
-        memcpy(event.data, data, len)
-        event.len = len
-        if _event_queue_append(event) != 0:
-            free(event.data)
-            free(event)
+    cdef void *log_data
+    log_data = malloc(len)
+    if log_data == NULL:
+        return
+    memcpy(log_data, data, len)
+    if _event_queue_put(1, level, log_data, len) != 0:
+        free(log_data)
 
 # functions
 
 cdef int _add_event(object event_name, dict params) except -1:
     cdef tuple data
+    cdef int status
+    data = (event_name, params)
+    Py_INCREF(data)
+    status = _event_queue_put(0, 0, <void *> data, 0)
+    if status != 0:
+        Py_DECREF(data)
+        if status == -1:
+            raise MemoryError()
+        raise PJSIPError("Could not obtain lock", status)
+    return 0
+
+cdef int _event_ring_init(size_t capacity) except -1:
+    global _event_ring
+    cdef _core_event *events
+    cdef size_t size = 2
+    cdef size_t index
+    if _event_ring.events != NULL:
+        raise SIPCoreError("Event queue was already initialized")
+    while size < capacity:
+        size <<= 1
+    events = <_core_event *> malloc(size * sizeof(_core_event))
+    if events == NULL:
+        raise MemoryError()
+    for index in range(size):
+        events[index].sequence = index
+    _event_ring.mask = size - 1
+    _event_ring.enqueue_pos = 0
+    _event_ring.dequeue_pos = 0
+    _event_ring.spilled = 0
+    _event_ring.high_water_mark = 0
+    _event_ring.overflow_count = 0
+    _event_ring.events = events
+    return 0
+
+cdef int _event_ring_dealloc() except -1:
+    global _event_ring
+    cdef _core_event *events = _event_ring.events
+    _event_ring.events = NULL
+    free(events)
+    return 0
+
+cdef int _event_ring_put(int is_log, int level, void *data, int len) noexcept nogil:
+    global _event_ring
+    cdef _core_event *events = _event_ring.events
+    cdef _core_event *event
+    cdef size_t pos, sequence, depth, high_water_mark
+    if events == NULL or _event_ring_load(&_event_ring.spilled):
+        return -1
+    pos = _event_ring_load(&_event_ring.enqueue_pos)
+    while True:
+        event = &events[pos & _event_ring.mask]
+        sequence = _event_ring_load(&event.sequence)
+        if sequence == pos:
+            if _event_ring_cas(&_event_ring.enqueue_pos, &pos, pos + 1):
+                break
+        elif <Py_ssize_t> (sequence - pos) < 0:
+            # the consumer did not yet release this slot, so the ring is full
+            return -1
+        else:
+            pos = _event_ring_load(&_event_ring.enqueue_pos)
+    event.is_log = is_log
+    event.level = level
+    event.data = data
+    event.len = len
+    _event_ring_store(&event.sequence, pos + 1)
+    depth = pos + 1 - _event_ring_load(&_event_ring.dequeue_pos)
+    high_water_mark = _event_ring_load(&_event_ring.high_water_mark)
+    while depth > high_water_mark:
+        if _event_ring_cas(&_event_ring.high_water_mark, &high_water_mark, depth):
+            break
+    return 0
+
+cdef int _event_ring_get(_core_event *result) noexcept nogil:
+    global _event_ring
+    cdef _core_event *events = _event_ring.events
+    cdef _core_event *event
+    cdef size_t pos
+    if events == NULL:
+        return -1
+    pos = _event_ring.dequeue_pos
+    event = &events[pos & _event_ring.mask]
+    if _event_ring_load(&event.sequence) != pos + 1:
+        return -1
+    result[0] = event[0]
+    _event_ring_store(&_event_ring.dequeue_pos, pos + 1)
+    _event_ring_store(&event.sequence, pos + _event_ring.mask + 1)
+    return 0
+
+cdef int _event_queue_put(int is_log, int level, void *data, int len) noexcept:
     cdef _core_event *event
     cdef int status
+    if _event_ring_put(is_log, level, data, len) == 0:
+        return 0
     event = <_core_event *> malloc(sizeof(_core_event))
     if event == NULL:
-        raise MemoryError()
-    data = (event_name, params)
-    event.is_log = 0
-    event.data = <void *> data
+        return -1
+    event.is_log = is_log
+    event.level = level
+    event.data = data
+    event.len = len
     status = _event_queue_append(event)
     if status != 0:
-        raise PJSIPError("Could not obtain lock", status)
-    Py_INCREF(data)
-    return 0
+        free(event)
+    return status
 
-cdef int _event_queue_append(_core_event *event):
-    global _event_queue_head, _event_queue_tail, _event_queue_lock
+cdef int _event_queue_append(_core_event *event) noexcept:
+    global _event_queue_head, _event_queue_tail, _event_queue_lock, _event_ring
     cdef int locked = 0, status
     event.next = NULL
     if _event_queue_lock != NULL:
@@ -65,49 +174,74 @@ cdef int _event_queue_append(_core_event *event):
             return status
         locked = 1
     if _event_queue_head == NULL:
-        event.prev = NULL
         _event_queue_head = event
         _event_queue_tail = event
     else:
         _event_queue_tail.next = event
-        event.prev = _event_queue_tail
         _event_queue_tail = event
+    if _event_ring.events != NULL:
+        _event_ring_store(&_event_ring.spilled, 1)
+        _event_ring_inc(&_event_ring.overflow_count)
     if locked:
         pj_mutex_unlock(_event_queue_lock)
     return 0
 
+cdef object _event_to_tuple(_core_event *event):
+    cdef object event_tup
+    cdef object log_msg
+    if event.is_log:
+        log_msg = _pj_buf_len_to_str(<char *> event.data, event.len)
+        free(event.data)
+        return ("SIPEngineLog", dict(level=event.level, message=log_msg))
+    else:
+        event_tup = <object> event.data
+        Py_DECREF(event_tup)
+        return event_tup
+
 cdef list _get_clear_event_queue():
-    global _re_log, _event_queue_head, _event_queue_tail, _event_queue_lock
-    cdef object events = []
+    global _event_queue_head, _event_queue_tail, _event_queue_lock, _event_ring
+    cdef list events = []
+    cdef _core_event ring_event
     cdef _core_event *event
     cdef _core_event *event_free
-    cdef object event_tup
-    cdef object event_params, log_msg, log_match
     cdef int locked = 0
+    cdef int status
+    while _event_ring_get(&ring_event) == 0:
+        events.append(_event_to_tuple(&ring_event))
     if _event_queue_lock != NULL:
         status = pj_mutex_lock(_event_queue_lock)
         if status != 0:
-            return status
+            return events
         locked = 1
-    event = _event_queue_head
-    _event_queue_head = _event_queue_tail = NULL
+    # The overflow list may only be taken over once every event which was published in the ring before it has
+    # been consumed, otherwise the events posted by a thread could be delivered out of order.
+    if _event_ring.events == NULL or _event_ring_load(&_event_ring.enqueue_pos) == _event_ring.dequeue_pos:
+        event = _event_queue_head
+        _event_queue_head = _event_queue_tail = NULL
+        if _event_ring.events != NULL:
+            _event_ring_store(&_event_ring.spilled, 0)
+    else:
+        event = NULL
     if locked:
         pj_mutex_unlock(_event_queue_lock)
     while event != NULL:
-        if event.is_log:
-            log_msg = _pj_buf_len_to_str(<char *> event.data, event.len)
-            event_params = dict(level=event.level, message=log_msg)
-            events.append(("SIPEngineLog", event_params))
-        else:
-            event_tup = <object> event.data
-            Py_DECREF(event_tup)
-            events.append(event_tup)
+        events.append(_event_to_tuple(event))
         event_free = event
         event = event.next
         free(event_free)
     return events
 
+cdef dict _get_event_queue_statistics():
+    global _event_ring
+    if _event_ring.events == NULL:
+        return dict(capacity=0, pending=0, high_water_mark=0, overflow_count=0)
+    return dict(capacity=_event_ring.mask + 1,
+                pending=_event_ring_load(&_event_ring.enqueue_pos) - _event_ring_load(&_event_ring.dequeue_pos),
+                high_water_mark=_event_ring_load(&_event_ring.high_water_mark),
+                overflow_count=_event_ring_load(&_event_ring.overflow_count))
+
 cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue *queue) except -1:
+    global _handler_queue_lock
     cdef _handler *handler
     handler = <_handler *> malloc(sizeof(_handler))
     if handler == NULL:
@@ -115,6 +249,8 @@ cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue
     handler.func = func
     handler.obj = <void *> obj
     handler.next = NULL
+    if _handler_queue_lock != NULL:
+        pj_mutex_lock(_handler_queue_lock)
     if queue.head == NULL:
         handler.prev = NULL
         queue.head = handler
@@ -123,11 +259,16 @@ cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue
         queue.tail.next = handler
         handler.prev = queue.tail
         queue.tail = handler
+    if _handler_queue_lock != NULL:
+        pj_mutex_unlock(_handler_queue_lock)
     return 0
 
 cdef int _remove_handler(object obj, _handler_queue *queue) except -1:
+    global _handler_queue_lock
     cdef _handler *handler
     cdef _handler *handler_free
+    if _handler_queue_lock != NULL:
+        pj_mutex_lock(_handler_queue_lock)
     handler = queue.head
     while handler != NULL:
         if handler.obj == <void *> obj:
@@ -144,13 +285,24 @@ cdef int _remove_handler(object obj, _handler_queue *queue) except -1:
             free(handler_free)
         else:
             handler = handler.next
+    if _handler_queue_lock != NULL:
+        pj_mutex_unlock(_handler_queue_lock)
     return 0
 
 cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1:
+    # The queues can be modified by the callbacks running in the Engine worker threads, so they are only accessed
+    # with the handler queue lock held. The lock is never held while calling into Python code, so it is safe to
+    # acquire it while holding the GIL. Returns the number of handlers which were processed.
+    global _handler_queue_lock
     cdef _handler *handler
     cdef _handler *handler_free
+    cdef int count = 0
+    if _handler_queue_lock != NULL:
+        pj_mutex_lock(_handler_queue_lock)
     handler = queue.head
     queue.head = queue.tail = NULL
+    if _handler_queue_lock != NULL:
+        pj_mutex_unlock(_handler_queue_lock)
     while handler != NULL:
         try:
             handler.func(<object> handler.obj)
@@ -159,13 +311,17 @@ cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1:
         handler_free = handler
         handler = handler.next
         free(handler_free)
-    return 0
+        count += 1
+    return count
 
 # globals
 
 cdef pj_mutex_t *_event_queue_lock = NULL
+cdef pj_mutex_t *_handler_queue_lock = NULL
 cdef _core_event *_event_queue_head = NULL
 cdef _core_event *_event_queue_tail = NULL
+cdef _core_event_ring _event_ring
+_event_ring.events = NULL
 cdef _handler_queue _post_poll_handler_queue
 _post_poll_handler_queue.head = NULL
 _post_poll_handler_queue.tail = NULL
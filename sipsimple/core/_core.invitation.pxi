@@ -1609,14 +1609,14 @@ cdef void _Invitation_cb_state_impl(pjsip_inv_session *inv, pjsip_event *e) with
                     invitation.peer_address.ip = rdata.pkt_info.src_name
                     invitation.peer_address.port = rdata.pkt_info.src_port
                 rdata_dict = dict()
-                _pjsip_msg_to_dict(rdata.msg_info.msg, rdata_dict)
+                _pjsip_msg_to_lazy_dict(rdata.msg_info.msg, rdata_dict)
                 originator = "remote"
             if tdata != NULL:
                 tdata_dict = dict()
                 # for whatever reason, we cannot build a proper Replaces header
                 # for outgoing so we will make a generic one
                 tdata_dict['skip_replaces'] = True
-                _pjsip_msg_to_dict(tdata.msg, tdata_dict)
+                _pjsip_msg_to_lazy_dict(tdata.msg, tdata_dict)
                 originator = "local"
             try:
                 timer = StateCallbackTimer(state, sub_state, rdata_dict, tdata_dict, originator)
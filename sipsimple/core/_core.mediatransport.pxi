@@ -1,4 +1,5 @@
 
+import array
 import sys
 
 from errno import EADDRINUSE
@@ -1344,9 +1345,99 @@ cdef class RTPTransport:
         return 0
 
 
-cdef class MediaCheckTimer(Timer):
-    def __init__(self, media_check_interval):
-        self.media_check_interval = media_check_interval
+cdef class MediaCheckScanner:
+    """
+    Checks whether the started audio and video transports still receive RTP
+    packets. Rather than running a timer for every transport, the transports
+    are kept in buckets indexed by the second in which they are next due and
+    a single timer, which only runs while there are transports to check,
+    processes all the buckets that are due in one pass. Checking a transport
+    costs the same regardless of how many transports are being checked.
+    """
+
+    def __cinit__(self):
+        self._transports = dict()
+        self._buckets = dict()
+        self._next_tick = -1
+
+    property transport_count:
+
+        def __get__(self):
+            return len(self._transports)
+
+    cdef int add(self, object transport, int interval) except -1:
+        cdef long long tick
+        if interval < 1:
+            interval = 1
+        key = weakref.ref(transport)
+        tick = <long long> time.monotonic() + interval
+        self._transports[key] = (interval, tick)
+        self._buckets.setdefault(tick, []).append(key)
+        self._schedule(tick)
+        return 0
+
+    cdef int remove(self, object transport) except -1:
+        # The entry in the bucket is skipped when it comes up
+        self._transports.pop(weakref.ref(transport), None)
+        if not self._transports:
+            self.stop()
+        return 0
+
+    cdef int stop(self) except -1:
+        self._transports.clear()
+        self._buckets.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._next_tick = -1
+        return 0
+
+    cdef int _schedule(self, long long tick) except -1:
+        if self._timer is not None:
+            if self._next_tick <= tick:
+                return 0
+            self._timer.cancel()
+        self._timer = Timer()
+        self._timer.schedule(max(tick - time.monotonic(), 0), <timer_callback>self._cb_scan, self)
+        self._next_tick = tick
+        return 0
+
+    cdef int _cb_scan(self, timer) except -1:
+        cdef int active
+        cdef int interval
+        cdef long long tick
+        cdef long long due_tick
+        cdef long long now = <long long> time.monotonic()
+
+        self._timer = None
+        self._next_tick = -1
+        for tick in sorted(tick for tick in self._buckets if tick <= now):
+            for key in self._buckets.pop(tick):
+                try:
+                    interval, due_tick = self._transports[key]
+                except KeyError:
+                    continue
+                if due_tick != tick:
+                    continue
+                transport = key()
+                try:
+                    if isinstance(transport, AudioTransport):
+                        active = (<AudioTransport> transport)._check_rtp()
+                    elif isinstance(transport, VideoTransport):
+                        active = (<VideoTransport> transport)._check_rtp()
+                    else:
+                        active = 0
+                except PJSIPError:
+                    active = 1
+                if active:
+                    due_tick = now + interval
+                    self._transports[key] = (interval, due_tick)
+                    self._buckets.setdefault(due_tick, []).append(key)
+                else:
+                    del self._transports[key]
+        if self._buckets:
+            self._schedule(min(self._buckets))
+        return 0
 
 
 cdef class SDPInfo:
@@ -1408,7 +1499,6 @@ cdef class AudioTransport:
         pool = ua.create_memory_pool(pool_name, 4096, 4096)
         self._pool = pool
         self._slot = -1
-        self._timer = None
         self._volume = 100
 
     def __init__(self, AudioMixer mixer, RTPTransport transport,
@@ -1506,6 +1596,29 @@ cdef class AudioTransport:
             self._pool = NULL
             return None
 
+    cdef int _get_rtcp_stat(self, pjmedia_rtcp_stat *stat) except -1:
+        # Returns 1 if the statistics were retrieved and 0 if the transport is not active
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_stream *stream
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            stream = self._obj
+            if stream == NULL:
+                return 0
+            with nogil:
+                status = pjmedia_stream_get_stat(stream, stat)
+            if status != 0:
+                raise PJSIPError("Could not get RTP statistics", status)
+            return 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
     property is_active:
 
         def __get__(self):
@@ -1543,38 +1656,15 @@ cdef class AudioTransport:
     property statistics:
 
         def __get__(self):
-            cdef int status
-            cdef pj_mutex_t *lock = self._lock
             cdef pjmedia_rtcp_stat stat
-            cdef pjmedia_stream *stream
             cdef dict statistics = dict()
-            cdef PJSIPUA ua
 
-            ua = self._check_ua()
-            if ua is None:
+            if self._check_ua() is None or not self._get_rtcp_stat(&stat):
                 return None
-
-            with nogil:
-                status = pj_mutex_lock(lock)
-            if status != 0:
-                raise PJSIPError("failed to acquire lock", status)
-            try:
-                stream = self._obj
-
-                if stream == NULL:
-                    return None
-
-                with nogil:
-                    status = pjmedia_stream_get_stat(stream, &stat)
-                if status != 0:
-                    raise PJSIPError("Could not get RTP statistics", status)
-                statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
-                statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
-                statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
-                return statistics
-            finally:
-                with nogil:
-                    pj_mutex_unlock(lock)
+            statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
+            statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
+            statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
+            return statistics
 
     property volume:
 
@@ -1772,8 +1862,7 @@ cdef class AudioTransport:
             self._sdp_info.index = sdp_index
             self._is_started = 1
             if timeout > 0:
-                self._timer = MediaCheckTimer(timeout)
-                self._timer.schedule(timeout, <timer_callback>self._cb_check_rtp, self)
+                ua._media_check_scanner.add(self, timeout)
             self.mixer.reset_ec()
         finally:
             with nogil:
@@ -1795,9 +1884,8 @@ cdef class AudioTransport:
         try:
             stream = self._obj
 
-            if self._timer is not None:
-                self._timer.cancel()
-                self._timer = None
+            if ua is not None:
+                ua._media_check_scanner.remove(self)
             if self._obj == NULL:
                 return
             self._obj = NULL
@@ -1884,7 +1972,8 @@ cdef class AudioTransport:
             with nogil:
                 pj_mutex_unlock(lock)
 
-    cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1:
+    cdef int _check_rtp(self) except -1:
+        # Called by the MediaCheckScanner, returns 0 once the transport is no longer active
         cdef int status
         cdef pj_mutex_t *lock = self._lock
         cdef pjmedia_rtcp_stat stat
@@ -1898,19 +1987,13 @@ cdef class AudioTransport:
             stream = self._obj
             if stream == NULL:
                 return 0
-
-            if self._timer is None:
-                return 0
-            self._timer = None
             with nogil:
                 status = pjmedia_stream_get_stat(stream, &stat)
             if status == 0:
                 if self._packets_received == stat.rx.pkt and self.direction == "sendrecv":
                     _add_event("RTPAudioTransportDidTimeout", dict(obj=self))
                 self._packets_received = stat.rx.pkt
-                if timer.media_check_interval > 0:
-                    self._timer = MediaCheckTimer(timer.media_check_interval)
-                    self._timer.schedule(timer.media_check_interval, <timer_callback>self._cb_check_rtp, self)
+            return 1
         finally:
             with nogil:
                 pj_mutex_unlock(lock)
@@ -1938,8 +2021,6 @@ cdef class VideoTransport:
         if status != 0:
             raise PJSIPError("failed to create lock", status)
 
-        self._timer = None
-
     def __init__(self, RTPTransport transport, BaseSDPSession remote_sdp=None, int sdp_index=0, list codecs=None):
         cdef int status
         cdef pj_pool_t *pool
@@ -2032,6 +2113,29 @@ cdef class VideoTransport:
             self._pool = NULL
             return None
 
+    cdef int _get_rtcp_stat(self, pjmedia_rtcp_stat *stat) except -1:
+        # Returns 1 if the statistics were retrieved and 0 if the transport is not active
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_vid_stream *stream
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            stream = self._obj
+            if stream == NULL:
+                return 0
+            with nogil:
+                status = pjmedia_vid_stream_get_stat(stream, stat)
+            if status != 0:
+                raise PJSIPError("Could not get RTP statistics", status)
+            return 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
     property is_active:
 
         def __get__(self):
@@ -2064,38 +2168,15 @@ cdef class VideoTransport:
     property statistics:
 
         def __get__(self):
-            cdef int status
-            cdef pj_mutex_t *lock = self._lock
             cdef pjmedia_rtcp_stat stat
-            cdef pjmedia_vid_stream *stream
             cdef dict statistics = dict()
-            cdef PJSIPUA ua
 
-            ua = self._check_ua()
-            if ua is None:
+            if self._check_ua() is None or not self._get_rtcp_stat(&stat):
                 return None
-
-            with nogil:
-                status = pj_mutex_lock(lock)
-            if status != 0:
-                raise PJSIPError("failed to acquire lock", status)
-            try:
-                stream = self._obj
-
-                if stream == NULL:
-                    return None
-
-                with nogil:
-                    status = pjmedia_vid_stream_get_stat(stream, &stat)
-                if status != 0:
-                    raise PJSIPError("Could not get RTP statistics", status)
-                statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
-                statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
-                statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
-                return statistics
-            finally:
-                with nogil:
-                    pj_mutex_unlock(lock)
+            statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
+            statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
+            statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
+            return statistics
 
     def get_local_media(self, BaseSDPSession remote_sdp=None, int index=0, direction="sendrecv"):
         global valid_sdp_directions
@@ -2228,8 +2309,7 @@ cdef class VideoTransport:
             self._sdp_info.index = sdp_index
             self._is_started = 1
             if timeout > 0:
-                self._timer = MediaCheckTimer(timeout)
-                self._timer.schedule(timeout, <timer_callback>self._cb_check_rtp, self)
+                ua._media_check_scanner.add(self, timeout)
         finally:
             with nogil:
                 pj_mutex_unlock(lock)
@@ -2250,9 +2330,8 @@ cdef class VideoTransport:
         try:
             stream = self._obj
 
-            if self._timer is not None:
-                self._timer.cancel()
-                self._timer = None
+            if ua is not None:
+                ua._media_check_scanner.remove(self)
             if self._obj == NULL:
                 return
             self._obj = NULL
@@ -2422,7 +2501,8 @@ cdef class VideoTransport:
             with nogil:
                 pj_mutex_unlock(lock)
 
-    cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1:
+    cdef int _check_rtp(self) except -1:
+        # Called by the MediaCheckScanner, returns 0 once the transport is no longer active
         cdef int status
         cdef pj_mutex_t *lock = self._lock
         cdef pjmedia_rtcp_stat stat
@@ -2436,18 +2516,13 @@ cdef class VideoTransport:
             stream = self._obj
             if stream == NULL:
                 return 0
-            if self._timer is None:
-                return 0
-            self._timer = None
             with nogil:
                 status = pjmedia_vid_stream_get_stat(stream, &stat)
             if status == 0:
                 if self._packets_received == stat.rx.pkt and self.direction == "sendrecv":
                     _add_event("RTPVideoTransportDidTimeout", dict(obj=self))
                 self._packets_received = stat.rx.pkt
-                if timer.media_check_interval > 0:
-                    self._timer = MediaCheckTimer(timer.media_check_interval)
-                    self._timer.schedule(timer.media_check_interval, <timer_callback>self._cb_check_rtp, self)
+            return 1
         finally:
             with nogil:
                 pj_mutex_unlock(lock)
@@ -2464,6 +2539,148 @@ cdef class VideoTransport:
             _add_event("RTPVideoTransportRequestedKeyFrame", dict(obj=self))
 
 
+cdef class RTPStatisticsHistory:
+    """
+    The last samples of the RTCP statistics of a transport, stored in a ring
+    buffer with one array per field. read() returns the samples in the order
+    in which they were taken, as array.array objects which support the buffer
+    protocol (numpy.frombuffer can use them as they are). The jitter and the
+    round trip time are in microseconds.
+    """
+
+    fields = ('timestamp', 'rx_packets', 'rx_bytes', 'rx_lost', 'rx_discarded', 'rx_jitter',
+              'tx_packets', 'tx_bytes', 'tx_lost', 'tx_jitter', 'rtt')
+
+    def __init__(self, int size):
+        cdef array.array counters = array.array('I')
+        cdef array.array values = array.array('i')
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.count = 0
+        self._next = 0
+        self._timestamp = array.clone(array.array('d'), size, zero=True)
+        self._rx_packets = array.clone(counters, size, zero=True)
+        self._rx_bytes = array.clone(counters, size, zero=True)
+        self._rx_lost = array.clone(counters, size, zero=True)
+        self._rx_discarded = array.clone(counters, size, zero=True)
+        self._rx_jitter = array.clone(values, size, zero=True)
+        self._tx_packets = array.clone(counters, size, zero=True)
+        self._tx_bytes = array.clone(counters, size, zero=True)
+        self._tx_lost = array.clone(counters, size, zero=True)
+        self._tx_jitter = array.clone(values, size, zero=True)
+        self._rtt = array.clone(values, size, zero=True)
+
+    def read(self, count=None):
+        cdef int start
+        cdef int length = self.count if count is None else max(0, min(count, self.count))
+        cdef dict samples = dict()
+        start = (self._next - length + self.size) % self.size
+        for name, data in zip(self.fields, (self._timestamp, self._rx_packets, self._rx_bytes, self._rx_lost, self._rx_discarded, self._rx_jitter,
+                                            self._tx_packets, self._tx_bytes, self._tx_lost, self._tx_jitter, self._rtt)):
+            if start + length <= self.size:
+                samples[name] = data[start:start+length]
+            else:
+                samples[name] = data[start:] + data[:start+length-self.size]
+        return samples
+
+    cdef int _add(self, double timestamp, pjmedia_rtcp_stat *stat) except -1:
+        cdef int index = self._next
+        self._timestamp.data.as_doubles[index] = timestamp
+        self._rx_packets.data.as_uints[index] = stat.rx.pkt
+        self._rx_bytes.data.as_uints[index] = stat.rx.bytes
+        self._rx_lost.data.as_uints[index] = stat.rx.loss
+        self._rx_discarded.data.as_uints[index] = stat.rx.discard
+        self._rx_jitter.data.as_ints[index] = stat.rx.jitter.last
+        self._tx_packets.data.as_uints[index] = stat.tx.pkt
+        self._tx_bytes.data.as_uints[index] = stat.tx.bytes
+        self._tx_lost.data.as_uints[index] = stat.tx.loss
+        self._tx_jitter.data.as_ints[index] = stat.tx.jitter.last
+        self._rtt.data.as_ints[index] = stat.rtt.last
+        self._next = (index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        return 0
+
+
+cdef class RTPStatisticsSampler:
+    """
+    Takes a sample of the RTCP statistics of every transport that was added
+    to it once every interval seconds and keeps the last history_size samples
+    of each one in an RTPStatisticsHistory. The samples are taken in the SIP
+    core thread and transports that are no longer active are dropped.
+    """
+
+    def __init__(self, double interval=1.0, int history_size=60):
+        if interval <= 0:
+            raise ValueError("interval must be a positive number")
+        if history_size < 1:
+            raise ValueError("history_size must be at least 1")
+        self.interval = interval
+        self.history_size = history_size
+        self._transports = dict()
+
+    property transports:
+
+        def __get__(self):
+            return [transport for transport in (key() for key in list(self._transports)) if transport is not None]
+
+    def add(self, transport):
+        if not isinstance(transport, (AudioTransport, VideoTransport)):
+            raise TypeError("transport must be an AudioTransport or a VideoTransport")
+        key = weakref.ref(transport)
+        try:
+            return self._transports[key]
+        except KeyError:
+            history = self._transports[key] = RTPStatisticsHistory(self.history_size)
+            if self._timer is None:
+                self._schedule()
+            return history
+
+    def remove(self, transport):
+        self._transports.pop(weakref.ref(transport), None)
+
+    def read(self, count=None):
+        return {transport: history.read(count) for transport, history in ((key(), history) for key, history in list(self._transports.items())) if transport is not None}
+
+    def stop(self):
+        self._transports.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    cdef int _schedule(self) except -1:
+        self._timer = Timer()
+        self._timer.schedule(self.interval, <timer_callback>self._cb_sample, self)
+        return 0
+
+    cdef int _cb_sample(self, timer) except -1:
+        cdef int active
+        cdef double now = time.time()
+        cdef pjmedia_rtcp_stat stat
+        cdef RTPStatisticsHistory history
+
+        self._timer = None
+        for key, history in list(self._transports.items()):
+            transport = key()
+            try:
+                if isinstance(transport, AudioTransport):
+                    active = (<AudioTransport> transport)._get_rtcp_stat(&stat)
+                elif isinstance(transport, VideoTransport):
+                    active = (<VideoTransport> transport)._get_rtcp_stat(&stat)
+                else:
+                    active = 0
+            except PJSIPError:
+                continue
+            if active:
+                history._add(now, &stat)
+            else:
+                self._transports.pop(key, None)
+        if self._transports:
+            self._schedule()
+        return 0
+
+
 cdef class ICECandidate:
     def __init__(self, component, cand_type, address, port, priority, rel_addr=''):
         self.component = component
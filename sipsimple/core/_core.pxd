@@ -7,12 +7,14 @@ cdef extern from *:
 
 # system imports
 
+from libc.stdio cimport FILE, fopen, fclose, fwrite, fflush, rename, snprintf
 from libc.stdlib cimport malloc, free
-from libc.string cimport memcpy
+from libc.string cimport memcpy, strlen
 
 
 # Python C imports
 
+from cpython cimport array
 from cpython.float cimport PyFloat_AsDouble
 from cpython.ref cimport Py_INCREF, Py_DECREF
 from cpython.bytes cimport PyBytes_FromString, PyBytes_FromStringAndSize, PyBytes_AsString, PyBytes_Size
@@ -47,6 +49,8 @@ cdef extern from "pjlib.h":
         char *ptr
         int slen
     ctypedef pj_str_t *pj_str_ptr_const "const pj_str_t *"
+    pj_str_t pj_str(char *str) nogil
+    int pj_strcmp(pj_str_ptr_const str1, pj_str_ptr_const str2) nogil
 
     # errors
     pj_str_t pj_strerror(int statcode, char *buf, int bufsize) nogil
@@ -82,6 +86,7 @@ cdef extern from "pjlib.h":
     void pj_pool_reset(pj_pool_t *pool) nogil
     pj_pool_t *pj_pool_create_on_buf(char *name, void *buf, int size) nogil
     pj_str_t *pj_strdup2_with_null(pj_pool_t *pool, pj_str_t *dst, char *src) nogil
+    pj_str_t *pj_strdup(pj_pool_t *pool, pj_str_t *dst, pj_str_ptr_const src) nogil
     void pj_pool_release(pj_pool_t *pool) nogil
 
     # threads
@@ -542,6 +547,11 @@ cdef extern from "pjmedia.h":
     # conference bridge
     enum pjmedia_conf_option:
         PJMEDIA_CONF_NO_DEVICE
+    enum pjmedia_port_op:
+        PJMEDIA_PORT_NO_CHANGE
+        PJMEDIA_PORT_DISABLE
+        PJMEDIA_PORT_MUTE
+        PJMEDIA_PORT_ENABLE
     struct pjmedia_conf
     int pjmedia_conf_create(pj_pool_t *pool, int max_slots, int sampling_rate, int channel_count,
                             int samples_per_frame, int bits_per_sample, int options, pjmedia_conf **p_conf) nogil
@@ -550,6 +560,7 @@ cdef extern from "pjmedia.h":
     int pjmedia_conf_add_port(pjmedia_conf *conf, pj_pool_t *pool, pjmedia_port *strm_port,
                               pj_str_t *name, unsigned int *p_slot) nogil
     int pjmedia_conf_remove_port(pjmedia_conf *conf, unsigned int slot) nogil
+    int pjmedia_conf_configure_port(pjmedia_conf *conf, unsigned int slot, pjmedia_port_op tx, pjmedia_port_op rx) nogil
     int pjmedia_conf_connect_port(pjmedia_conf *conf, unsigned int src_slot, unsigned int sink_slot, int level) nogil
     int pjmedia_conf_disconnect_port(pjmedia_conf *conf, unsigned int src_slot, unsigned int sink_slot) nogil
     int pjmedia_conf_adjust_rx_level(pjmedia_conf *conf, unsigned slot, int adj_level) nogil
@@ -1046,6 +1057,8 @@ cdef extern from "pjsip.h":
         pj_str_t subtype
         pjsip_param param
     enum pjsip_method_e:
+        PJSIP_INVITE_METHOD
+        PJSIP_ACK_METHOD
         PJSIP_OPTIONS_METHOD
         PJSIP_CANCEL_METHOD
         PJSIP_OTHER_METHOD
@@ -1175,6 +1188,7 @@ cdef extern from "pjsip.h":
     pjsip_expires_hdr *pjsip_expires_hdr_create(pj_pool_t *pool, int value) nogil
     pjsip_msg_body *pjsip_msg_body_create(pj_pool_t *pool, pj_str_t *type, pj_str_t *subtype, pj_str_t *text) nogil
     pjsip_msg_body *pjsip_msg_body_clone(pj_pool_t *pool, const pjsip_msg_body *body) nogil
+    pjsip_msg *pjsip_msg_clone(pj_pool_t *pool, const pjsip_msg *msg) nogil
     pjsip_route_hdr *pjsip_route_hdr_init(pj_pool_t *pool, void *mem) nogil
     void pjsip_sip_uri_init(pjsip_sip_uri *url, int secure) nogil
     int pjsip_tx_data_dec_ref(pjsip_tx_data *tdata) nogil
@@ -1215,6 +1229,7 @@ cdef extern from "pjsip.h":
     pj_pool_t *pjsip_endpt_create_pool(pjsip_endpoint *endpt, char *pool_name, int initial, int increment) nogil
     void pjsip_endpt_release_pool(pjsip_endpoint *endpt, pj_pool_t *pool) nogil
     int pjsip_endpt_handle_events(pjsip_endpoint *endpt, pj_time_val *max_timeout) nogil
+    int pjsip_endpt_handle_events2(pjsip_endpoint *endpt, pj_time_val *max_timeout, unsigned int *count) nogil
     int pjsip_endpt_register_module(pjsip_endpoint *endpt, pjsip_module *module) nogil
     int pjsip_endpt_schedule_timer(pjsip_endpoint *endpt, pj_timer_entry *entry, pj_time_val *delay) nogil
     void pjsip_endpt_cancel_timer(pjsip_endpoint *endpt, pj_timer_entry *entry) nogil
@@ -1495,6 +1510,11 @@ cdef extern from "pjsip_ua.h":
 
 # declarations
 
+# forward declarations
+
+cdef class PJSIPUA
+cdef class MediaCheckScanner
+
 # core.util
 
 cdef class frozenlist(object):
@@ -1514,6 +1534,21 @@ cdef class PJSTR(object):
     cdef pj_str_t pj_str
     cdef object str
 
+cdef class SIPMessageHeaders(object):
+    # attributes
+    cdef object __weakref__
+    cdef object _lock
+    cdef pj_pool_t *_pool
+    cdef pjsip_msg *_msg
+    cdef dict _headers
+    cdef int _skip_replaces
+    cdef int _complete
+
+    # private methods
+    cdef object _lookup(self, object name)
+    cdef int _materialize(self) except -1
+    cdef int _release(self, PJSIPUA ua) except -1
+
 # core.lib
 
 cdef class PJLIB(object):
@@ -1891,7 +1926,16 @@ cdef object _str_as_size(object string)
 
 cdef dict _pjsip_param_to_dict(pjsip_param *param_list)
 cdef int _dict_to_pjsip_param(object params, pjsip_param *param_list, pj_pool_t *pool)
+cdef object _pjsip_hdr_to_object(pjsip_hdr *header, object header_name, int skip_replaces, bint *multi_header)
+cdef dict _pjsip_msg_headers_to_dict(pjsip_msg *msg, int skip_replaces)
 cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1
+cdef int _pjsip_msg_to_lazy_dict(pjsip_msg *msg, dict info_dict) except -1
+cdef int _pjsip_msg_line_to_dict(pjsip_msg *msg, dict info_dict) except -1
+cdef SIPMessageHeaders SIPMessageHeaders_create(pjsip_msg *msg, int skip_replaces)
+cdef int _materialize_message_headers() except -1
+cdef pj_pool_t *_message_headers_pool_get(PJSIPUA ua) except NULL
+cdef int _message_headers_pool_put(PJSIPUA ua, pj_pool_t *pool) except -1
+cdef int _release_message_headers_pools(PJSIPUA ua) except -1
 cdef int _is_valid_ip(int af, object ip) except -1
 cdef int _get_ip_version(object ip) except -1
 cdef int _add_headers_to_tdata(pjsip_tx_data *tdata, object headers) except -1
@@ -1905,6 +1949,7 @@ ctypedef int (*timer_callback)(object, object) except -1
 cdef class Timer(object):
     # attributes
     cdef int _scheduled
+    cdef list _entry
     cdef double schedule_time
     cdef timer_callback callback
     cdef object obj
@@ -1924,6 +1969,13 @@ cdef class PJSIPUA(object):
     cdef object _threads
     cdef object _event_handler
     cdef list _timers
+    cdef int _dead_timers
+    cdef long long _timer_sequence
+    cdef long long _timer_compactions
+    cdef double _min_poll_interval
+    cdef double _max_poll_interval
+    cdef double _poll_interval
+    cdef pj_mutex_t *_poll_lock
     cdef PJLIB _pjlib
     cdef PJCachingPool _caching_pool
     cdef PJSIPEndpoint _pjsip_endpoint
@@ -1938,7 +1990,10 @@ cdef class PJSIPUA(object):
     cdef PJSTR _ua_tag_module_name
     cdef pjsip_module _event_module
     cdef PJSTR _event_module_name
+    cdef int _enable_fast_path
+    cdef pj_pool_t *_fast_path_pool
     cdef int _trace_sip
+    cdef object _trace_sip_file
     cdef int _detect_sip_loops
     cdef int _enable_colorbar_device
     cdef PJSTR _user_agent
@@ -1958,6 +2013,7 @@ cdef class PJSIPUA(object):
     cdef list old_devices
     cdef list old_video_devices
     cdef object _zrtp_cache
+    cdef MediaCheckScanner _media_check_scanner
 
     # private methods
     cdef object _get_sound_devices(self, int is_output)
@@ -1965,11 +2021,17 @@ cdef class PJSIPUA(object):
     cdef object _get_video_devices(self)
     cdef object _get_default_video_device(self)
     cdef int _poll_log(self) except -1
+    cdef int _handle_pjsip_events(self, pj_time_val *timeout, unsigned int *count) except -1
     cdef int _handle_exception(self, int is_fatal) except -1
     cdef int _check_self(self) except -1
     cdef int _check_thread(self) except -1
+    cdef int _lock_poll_state(self) except -1
+    cdef int _unlock_poll_state(self) except -1
     cdef int _add_timer(self, Timer timer) except -1
     cdef int _remove_timer(self, Timer timer) except -1
+    cdef object _pop_expired_timer(self, double now)
+    cdef int _update_fast_path(self) except -1
+    cdef int _compact_timers(self) except -1
     cdef int _cb_rx_request(self, pjsip_rx_data *rdata) except 0
 
     cdef pj_pool_t* create_memory_pool(self, bytes name, int initial_size, int resize_size)
@@ -1981,8 +2043,8 @@ cdef void _cb_detect_nat_type(void *user_data, pj_stun_nat_detect_result_ptr_con
 cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) with gil
 cdef int _cb_trace_rx(pjsip_rx_data *rdata) with gil
 cdef int _cb_trace_tx(pjsip_tx_data *tdata) with gil
-cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) with gil
-cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) with gil
+cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) nogil
+cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) nogil
 cdef PJSIPUA _get_ua()
 cdef int deallocate_weakref(object weak_ref, object timer) except -1
 
@@ -1999,6 +2061,7 @@ cdef class AudioMixer(object):
     cdef pjmedia_conf *_obj
     cdef pjmedia_master_port *_master_port
     cdef pjmedia_port *_null_port
+    cdef pjmedia_port *_clock_port
     cdef pjmedia_snd_port *_snd
     cdef list _connected_slots
     cdef readonly int ec_tail_length
@@ -2086,7 +2149,22 @@ cdef class MixerPort(object):
     cdef PJSIPUA _check_ua(self)
     cdef int _stop(self, PJSIPUA ua) except -1
 
+cdef class AudioMixerLink(object):
+    cdef int _source_slot
+    cdef int _destination_slot
+    cdef int _was_started
+    cdef pj_mutex_t *_lock
+    cdef pj_pool_t *_pool
+    cdef pjmedia_port *_port
+    cdef readonly AudioMixer source_mixer
+    cdef readonly AudioMixer destination_mixer
+
+    # private methods
+    cdef PJSIPUA _check_ua(self)
+    cdef int _stop(self, PJSIPUA ua) except -1
+
 cdef int _AudioMixer_dealloc_handler(object obj) except -1
+cdef int _AudioMixerLink_cb_free_port(object obj, object timer) except -1
 cdef int cb_play_wav_eof(pjmedia_port *port, void *user_data) with gil
 
 # core.video
@@ -2166,6 +2244,15 @@ cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue
 cdef int _remove_handler(object obj, _handler_queue *queue) except -1
 cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1
 
+# core.trace
+
+cdef int _sip_trace_open(object path, size_t max_size, int max_files, pj_pool_t *pool) except -1
+cdef int _sip_trace_close() noexcept nogil
+cdef int _sip_trace_write(int received, const char *transport, pj_str_t *source_ip, int source_port,
+                          pj_str_t *destination_ip, int destination_port, const char *data, size_t data_len) noexcept nogil
+cdef int _sip_trace_flush() noexcept nogil
+cdef dict _get_sip_trace_statistics()
+
 # core.request
 
 cdef class EndpointAddress(object):
@@ -2706,9 +2793,19 @@ cdef class RTPTransport(object):
     cdef int _init_local_sdp(self, BaseSDPSession local_sdp, BaseSDPSession remote_sdp, int sdp_index)
     cdef int _ice_active(self)
 
-cdef class MediaCheckTimer(Timer):
+cdef class MediaCheckScanner(object):
     # attributes
-    cdef int media_check_interval
+    cdef dict _transports
+    cdef dict _buckets
+    cdef Timer _timer
+    cdef long long _next_tick
+
+    # private methods
+    cdef int add(self, object transport, int interval) except -1
+    cdef int remove(self, object transport) except -1
+    cdef int stop(self) except -1
+    cdef int _schedule(self, long long tick) except -1
+    cdef int _cb_scan(self, timer) except -1
 
 cdef class SDPInfo(object):
     # attributes
@@ -2731,7 +2828,6 @@ cdef class AudioTransport(object):
     cdef pj_pool_t *_pool
     cdef pjmedia_stream *_obj
     cdef pjmedia_stream_info _stream_info
-    cdef Timer _timer
     cdef readonly object direction
     cdef readonly AudioMixer mixer
     cdef readonly RTPTransport transport
@@ -2739,7 +2835,8 @@ cdef class AudioTransport(object):
 
     # private methods
     cdef PJSIPUA _check_ua(self)
-    cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1
+    cdef int _get_rtcp_stat(self, pjmedia_rtcp_stat *stat) except -1
+    cdef int _check_rtp(self) except -1
 
 cdef class VideoTransport(object):
     # attributes
@@ -2752,7 +2849,6 @@ cdef class VideoTransport(object):
     cdef pj_pool_t *_pool
     cdef pjmedia_vid_stream *_obj
     cdef pjmedia_vid_stream_info _stream_info
-    cdef Timer _timer
     cdef readonly object direction
     cdef readonly RTPTransport transport
     cdef SDPInfo _sdp_info
@@ -2761,7 +2857,39 @@ cdef class VideoTransport(object):
 
     # private methods
     cdef PJSIPUA _check_ua(self)
-    cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1
+    cdef int _get_rtcp_stat(self, pjmedia_rtcp_stat *stat) except -1
+    cdef int _check_rtp(self) except -1
+
+cdef class RTPStatisticsHistory(object):
+    # attributes
+    cdef readonly int size
+    cdef readonly int count
+    cdef int _next
+    cdef array.array _timestamp
+    cdef array.array _rx_packets
+    cdef array.array _rx_bytes
+    cdef array.array _rx_lost
+    cdef array.array _rx_discarded
+    cdef array.array _rx_jitter
+    cdef array.array _tx_packets
+    cdef array.array _tx_bytes
+    cdef array.array _tx_lost
+    cdef array.array _tx_jitter
+    cdef array.array _rtt
+
+    # private methods
+    cdef int _add(self, double timestamp, pjmedia_rtcp_stat *stat) except -1
+
+cdef class RTPStatisticsSampler(object):
+    # attributes
+    cdef dict _transports
+    cdef Timer _timer
+    cdef readonly double interval
+    cdef readonly int history_size
+
+    # private methods
+    cdef int _schedule(self) except -1
+    cdef int _cb_sample(self, timer) except -1
 
 cdef void _RTPTransport_cb_ice_complete(pjmedia_transport *tp, pj_ice_strans_op op, int status) noexcept nogil
 cdef void _RTPTransport_cb_ice_state(pjmedia_transport *tp, pj_ice_strans_state prev, pj_ice_strans_state curr) noexcept nogil
@@ -8,6 +8,7 @@ include "_core.util.pxi"
 include "_core.ua.pxi"
 
 include "_core.event.pxi"
+include "_core.trace.pxi"
 include "_core.request.pxi"
 include "_core.helper.pxi"
 include "_core.headers.pxi"
@@ -39,9 +40,9 @@ CYTHON_VERSION = cython.__version__
 
 __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION", "CORE_BUILD", "CYTHON_VERSION",
            "SIPCoreError", "PJSIPError", "PJSIPTLSError", "SIPCoreInvalidStateError",
-           "AudioMixer", "ToneGenerator", "RecordingWaveFile", "WaveFile", "MixerPort",
+           "AudioMixer", "ToneGenerator", "RecordingWaveFile", "WaveFile", "MixerPort", "AudioMixerLink",
            "VideoCamera", "FrameBufferVideoRenderer",
-           "sip_status_messages",
+           "sip_status_messages", "SIPMessageHeaders",
            "BaseCredentials", "Credentials", "FrozenCredentials", "BaseSIPURI", "SIPURI", "FrozenSIPURI",
            "BaseHeader", "Header", "FrozenHeader",
            "BaseContactHeader", "ContactHeader", "FrozenContactHeader",
@@ -61,6 +62,6 @@ __all__ = ["PJ_VERSION", "PJ_SVN_REVISION", "CORE_REVISION", "CORE_BUILD", "CYTH
            "Invitation",
            "DialogID",
            "SDPSession", "FrozenSDPSession", "SDPMediaStream", "FrozenSDPMediaStream", "SDPConnection", "FrozenSDPConnection", "SDPAttribute", "FrozenSDPAttribute", "SDPNegotiator",
-           "RTPTransport", "AudioTransport", "VideoTransport"]
+           "RTPTransport", "AudioTransport", "VideoTransport", "RTPStatisticsHistory", "RTPStatisticsSampler"]
 
 
@@ -20,7 +20,7 @@ import sys
 # flag from the callback, and reap (free port + pool) from the polling thread.
 
 cdef enum:
-    _MAX_TRACKED_MIXERS = 8
+    _MAX_TRACKED_MIXERS = 64
 
 cdef pjmedia_conf *_conf_op_confs[_MAX_TRACKED_MIXERS]
 cdef int *_conf_op_done_arrays[_MAX_TRACKED_MIXERS]
@@ -38,6 +38,64 @@ cdef extern from *:
     unsigned _sipsimple_conf_op_remove_slot(const pjmedia_conf_op_info *info) nogil
 
 
+# --- Mixer clock accounting --------------------------------------------------
+#
+# The conference bridge does all of its mixing inside get_frame() of its master
+# port, called from the clock thread of whatever drives the mixer (the sound
+# device or, without one, a master port fed by the null port). The clock port
+# sits between the two, forwards the frames to the bridge and keeps track of
+# how many frames were mixed and how long that took, which gives the CPU load
+# of every mixer.
+
+cdef extern from *:
+    """
+    #include <pjmedia/port.h>
+    #include <pj/os.h>
+    #include <pj/pool.h>
+    typedef struct _sipsimple_clock_port {
+        pjmedia_port base;
+        pjmedia_port *conf_port;
+        unsigned long long frames;
+        unsigned long long busy_usec;
+    } _sipsimple_clock_port;
+
+    static pj_status_t _sipsimple_clock_port_get_frame(pjmedia_port *this_port, pjmedia_frame *frame) {
+        _sipsimple_clock_port *port = (_sipsimple_clock_port *) this_port;
+        pj_timestamp start, end;
+        pj_status_t status;
+        pj_get_timestamp(&start);
+        status = pjmedia_port_get_frame(port->conf_port, frame);
+        pj_get_timestamp(&end);
+        port->busy_usec += pj_elapsed_usec(&start, &end);
+        port->frames++;
+        return status;
+    }
+
+    static pj_status_t _sipsimple_clock_port_put_frame(pjmedia_port *this_port, pjmedia_frame *frame) {
+        return pjmedia_port_put_frame(((_sipsimple_clock_port *) this_port)->conf_port, frame);
+    }
+
+    static pjmedia_port *_sipsimple_clock_port_create(pj_pool_t *pool, pjmedia_port *conf_port) {
+        _sipsimple_clock_port *port = PJ_POOL_ZALLOC_T(pool, _sipsimple_clock_port);
+        if (port == NULL)
+            return NULL;
+        port->base.info = conf_port->info;
+        port->base.get_frame = &_sipsimple_clock_port_get_frame;
+        port->base.put_frame = &_sipsimple_clock_port_put_frame;
+        port->conf_port = conf_port;
+        return &port->base;
+    }
+
+    static void _sipsimple_clock_port_get_stats(pjmedia_port *this_port, unsigned long long *frames, unsigned long long *busy_usec) {
+        _sipsimple_clock_port *port = (_sipsimple_clock_port *) this_port;
+        *frames = port->frames;
+        *busy_usec = port->busy_usec;
+    }
+    """
+    pjmedia_port *_sipsimple_clock_port_create(pj_pool_t *pool, pjmedia_port *conf_port) nogil
+    void _sipsimple_clock_port_get_stats(pjmedia_port *port, unsigned long long *frames, unsigned long long *busy_usec) nogil
+
+
 cdef void _AudioMixer_conf_op_cb(const pjmedia_conf_op_info *info) noexcept nogil:
     # Runs on the audio I/O thread. Keep it minimal and allocation-free: just
     # mark the completed slot done for the matching conf bridge.
@@ -77,6 +135,9 @@ cdef void _conf_op_unregister(pjmedia_conf *conf):
 
 cdef class AudioMixer:
 
+    # the number of mixers that can exist at the same time
+    max_instances = _MAX_TRACKED_MIXERS
+
     def __cinit__(self, *args, **kwargs):
         cdef int status
 
@@ -129,6 +190,9 @@ cdef class AudioMixer:
                                               <unsigned int>(sample_rate / 50), 16, null_port_address)
         if status != 0:
             raise PJSIPError("Could not create null audio port", status)
+        self._clock_port = _sipsimple_clock_port_create(conf_pool, pjmedia_conf_get_master_port(self._obj))
+        if self._clock_port == NULL:
+            raise SIPCoreError("Could not create audio mixer clock port")
 
         # Deferred port teardown: per-slot completion flags live in the conf
         # pool (freed last, in __dealloc__). Register the completion callback
@@ -272,6 +336,20 @@ cdef class AudioMixer:
         def __get__(self):
             return sorted(self._connected_slots)
 
+    property statistics:
+
+        def __get__(self):
+            cdef unsigned long long frames = 0
+            cdef unsigned long long busy_usec = 0
+            if self._clock_port != NULL:
+                _sipsimple_clock_port_get_stats(self._clock_port, &frames, &busy_usec)
+            # every frame covers 20ms of audio
+            return dict(slot_count=self.slot_count,
+                        used_slot_count=self.used_slot_count,
+                        frames=frames,
+                        busy_time=busy_usec / 1000000.0,
+                        load=busy_usec / (frames * 20000.0) if frames else 0.0)
+
     # public methods
 
     def set_sound_devices(self, unicode input_device, unicode output_device, int ec_tail_length):
@@ -438,6 +516,7 @@ cdef class AudioMixer:
         cdef pjmedia_conf *conf_bridge
         cdef pjmedia_master_port **master_port_address
         cdef pjmedia_port *null_port
+        cdef pjmedia_port *clock_port
         cdef pjmedia_aud_dev_info dev_info
         cdef pjmedia_snd_port **snd_port_address
         cdef pjmedia_aud_param aud_param
@@ -448,6 +527,7 @@ cdef class AudioMixer:
         snd_pool = self._snd_pool
         master_port_address = &self._master_port
         null_port = self._null_port
+        clock_port = self._clock_port
         sample_rate = self.sample_rate
         snd_port_address = &self._snd
 
@@ -484,7 +564,7 @@ cdef class AudioMixer:
                     output_device_i = PJMEDIA_AUD_DEFAULT_PLAYBACK_DEV
             if input_device is None and output_device is None:
                 with nogil:
-                    status = pjmedia_master_port_create(conf_pool, null_port, pjmedia_conf_get_master_port(conf_bridge), 0, master_port_address)
+                    status = pjmedia_master_port_create(conf_pool, null_port, clock_port, 0, master_port_address)
                 if status != 0:
                     raise PJSIPError("Could not create master port for dummy sound device", status)
                 with nogil:
@@ -526,7 +606,7 @@ cdef class AudioMixer:
                 elif status != 0:
                     raise PJSIPError("Could not create sound device", status)
                 with nogil:
-                    status = pjmedia_snd_port_connect(snd_port_address[0], pjmedia_conf_get_master_port(conf_bridge))
+                    status = pjmedia_snd_port_connect(snd_port_address[0], clock_port)
                 if status != 0:
                     self._stop_sound_device(ua)
                     raise PJSIPError("Could not connect sound device", status)
@@ -678,7 +758,7 @@ cdef class AudioMixer:
             self._connected_slots = [connection for connection in self._connected_slots if slot not in connection]
             self.used_slot_count -= 1
 
-            if self._snd == NULL:
+            if self._snd == NULL and self._master_port == NULL:
                 # No clock thread; the bridge cannot be touching the port.
                 if port != NULL:
                     with nogil:
@@ -713,7 +793,7 @@ cdef class AudioMixer:
 
         slots = list(self._pending_free.keys())
         for slot in slots:
-            if force or self._snd == NULL or (self._op_done != NULL and self._op_done[slot]):
+            if force or (self._snd == NULL and self._master_port == NULL) or (self._op_done != NULL and self._op_done[slot]):
                 entry = self._pending_free.pop(slot)
                 port = <pjmedia_port *> (<size_t> entry[0])
                 pool = <pj_pool_t *> (<size_t> entry[1])
@@ -788,6 +868,7 @@ cdef class AudioMixer:
             with nogil:
                 pjmedia_port_destroy(null_port)
             self._null_port = NULL
+        self._clock_port = NULL
         if self._obj != NULL:
             with nogil:
                 pjmedia_conf_destroy(conf_bridge)
@@ -1630,6 +1711,176 @@ cdef class MixerPort:
             pj_mutex_destroy(self._lock)
 
 
+cdef class AudioMixerLink:
+    """
+    Carries the audio of one slot of the source mixer to a slot of the
+    destination mixer, so that ports living on different mixers can be
+    connected. The link is a single port added to both mixers: the source
+    mixer writes into it and the destination mixer reads the last frame
+    written, so the two mixer clocks do not need to be in sync.
+    """
+
+    def __cinit__(self, *args, **kwargs):
+        cdef int status
+
+        status = pj_mutex_create_recursive(_get_ua()._pjsip_endpoint._pool, "audio_mixer_link_lock", &self._lock)
+        if status != 0:
+            raise PJSIPError("failed to create lock", status)
+
+        self._source_slot = -1
+        self._destination_slot = -1
+
+    def __init__(self, AudioMixer source_mixer, AudioMixer destination_mixer):
+        if self.source_mixer is not None:
+            raise SIPCoreError("AudioMixerLink.__init__() was already called")
+        if source_mixer is None or destination_mixer is None:
+            raise ValueError("mixer arguments may not be None")
+        if source_mixer is destination_mixer:
+            raise ValueError("source_mixer and destination_mixer must be different")
+        if source_mixer.sample_rate != destination_mixer.sample_rate:
+            raise ValueError("source_mixer and destination_mixer must use the same sample rate")
+        self.source_mixer = source_mixer
+        self.destination_mixer = destination_mixer
+
+    cdef PJSIPUA _check_ua(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+            return ua
+        except:
+            self._pool = NULL
+            self._port = NULL
+            self._source_slot = -1
+            self._destination_slot = -1
+            return None
+
+    property is_active:
+
+        def __get__(self):
+            self._check_ua()
+            return self._source_slot != -1
+
+    property source_slot:
+
+        def __get__(self):
+            self._check_ua()
+            if self._source_slot == -1:
+                return None
+            else:
+                return self._source_slot
+
+    property destination_slot:
+
+        def __get__(self):
+            self._check_ua()
+            if self._destination_slot == -1:
+                return None
+            else:
+                return self._destination_slot
+
+    def start(self):
+        cdef int sample_rate
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef pj_pool_t *pool
+        cdef pjmedia_port **port_address
+        cdef pjmedia_conf *conf_bridge
+        cdef unsigned int slot
+        cdef bytes pool_name
+        cdef PJSIPUA ua
+
+        ua = _get_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            pool_name = b"AudioMixerLink_%d" % id(self)
+            port_address = &self._port
+            sample_rate = self.source_mixer.sample_rate
+
+            if self._was_started:
+                raise SIPCoreError("This AudioMixerLink was already started once")
+            pool = ua.create_memory_pool(pool_name, 4096, 4096)
+            self._pool = pool
+            try:
+                with nogil:
+                    status = pjmedia_mixer_port_create(pool, sample_rate, 1, <unsigned int>(sample_rate / 50), 16, port_address)
+                if status != 0:
+                    raise PJSIPError("Could not create audio mixer link", status)
+                # the source mixer only writes to the link and the destination mixer only reads from it
+                self._source_slot = self.source_mixer._add_port(ua, self._pool, self._port)
+                conf_bridge = self.source_mixer._obj
+                slot = self._source_slot
+                with nogil:
+                    status = pjmedia_conf_configure_port(conf_bridge, slot, PJMEDIA_PORT_ENABLE, PJMEDIA_PORT_DISABLE)
+                if status != 0:
+                    raise PJSIPError("Could not configure audio mixer link", status)
+                self._destination_slot = self.destination_mixer._add_port(ua, self._pool, self._port)
+                conf_bridge = self.destination_mixer._obj
+                slot = self._destination_slot
+                with nogil:
+                    status = pjmedia_conf_configure_port(conf_bridge, slot, PJMEDIA_PORT_DISABLE, PJMEDIA_PORT_ENABLE)
+                if status != 0:
+                    raise PJSIPError("Could not configure audio mixer link", status)
+            except:
+                self._stop(ua)
+                raise
+            self._was_started = 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def stop(self):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef PJSIPUA ua
+
+        ua = self._check_ua()
+        if ua is None:
+            return
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._stop(ua)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    cdef int _stop(self, PJSIPUA ua) except -1:
+        cdef list pending = list()
+
+        # The port is in both mixers, so neither of them can take ownership of it. It is freed once
+        # both removals have been applied by the mixers' clock threads.
+        if self._destination_slot != -1:
+            self.destination_mixer._remove_port_deferred(ua, self._destination_slot, NULL, NULL)
+            pending.append((self.destination_mixer, self._destination_slot))
+            self._destination_slot = -1
+        if self._source_slot != -1:
+            self.source_mixer._remove_port_deferred(ua, self._source_slot, NULL, NULL)
+            pending.append((self.source_mixer, self._source_slot))
+            self._source_slot = -1
+        if self._port != NULL or self._pool != NULL:
+            _AudioMixerLink_cb_free_port((<size_t> self._port, <size_t> self._pool, pending), None)
+            self._port = NULL
+            self._pool = NULL
+        return 0
+
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+        except:
+            return
+        self._stop(ua)
+        if self._lock != NULL:
+            pj_mutex_destroy(self._lock)
+
+
 # callback functions
 
 cdef int _AudioMixer_dealloc_handler(object obj) except -1:
@@ -1649,6 +1900,29 @@ cdef int _AudioMixer_dealloc_handler(object obj) except -1:
     finally:
         pj_mutex_unlock(mixer._lock)
 
+cdef int _AudioMixerLink_cb_free_port(object obj, object timer) except -1:
+    cdef AudioMixer mixer
+    cdef PJSIPUA ua
+    cdef pjmedia_port *port = <pjmedia_port *> (<size_t> obj[0])
+    cdef pj_pool_t *pool = <pj_pool_t *> (<size_t> obj[1])
+    cdef Timer new_timer
+
+    try:
+        ua = _get_ua()
+    except:
+        return 0
+    for mixer, slot in obj[2]:
+        if slot in mixer._pending_free:
+            new_timer = Timer()
+            new_timer.schedule(0.020, <timer_callback>_AudioMixerLink_cb_free_port, obj)
+            return 0
+    if port != NULL:
+        with nogil:
+            pjmedia_port_destroy(port)
+    if pool != NULL:
+        ua.release_memory_pool(pool)
+    return 0
+
 cdef int cb_play_wav_eof_impl(pjmedia_port *port, void *user_data) with gil:
     cdef Timer timer
     cdef WaveFile wav_file
@@ -0,0 +1,216 @@
+
+import os
+
+
+# C types
+
+# Writer for the binary SIP trace file. The packets are written straight from the PJSIP callbacks without
+# taking the GIL. Every file starts with the magic string followed by a 16 bit version and contains records
+# made of a 32 bit length followed by the record itself, all numbers in network byte order:
+#
+#   timestamp (32 bit seconds, 32 bit microseconds), flags (8 bit, bit 0 set for received packets),
+#   transport, source ip, destination ip (each as 8 bit length and data, followed by a 16 bit port for the
+#   addresses) and the packet data, which makes up the rest of the record.
+#
+# When a file would grow beyond max_size it is rotated: the previous files are renamed to <path>.1 up to
+# <path>.<max_files - 1>, the oldest one is overwritten and writing continues in a new file at <path>.
+cdef struct _sip_trace_file:
+    FILE *file
+    pj_mutex_t *lock
+    char *path
+    char *rotate_path
+    char *rotate_next_path
+    size_t max_size
+    int max_files
+    size_t size
+    int enabled
+    int dirty
+    unsigned long long records
+    unsigned long long dropped
+    unsigned long long rotations
+
+cdef enum:
+    _SIP_TRACE_VERSION = 1
+    _SIP_TRACE_FILE_HEADER = 10
+    _SIP_TRACE_MAX_STR = 64
+    _SIP_TRACE_MAX_HEADER = 4 + 4 + 4 + 1 + 3 * (1 + _SIP_TRACE_MAX_STR) + 2 + 2
+
+# functions
+
+cdef int _sip_trace_open(object path, size_t max_size, int max_files, pj_pool_t *pool) except -1:
+    global _sip_trace
+    cdef int status
+    cdef size_t path_len
+    cdef bytes c_path = os.fsencode(path)
+    if max_files < 1:
+        raise ValueError("trace_sip_file_count must be at least 1")
+    if max_size < 1024:
+        raise ValueError("trace_sip_file_size must be at least 1024 bytes")
+    path_len = len(c_path)
+    _sip_trace.path = <char *> malloc(path_len + 1)
+    _sip_trace.rotate_path = <char *> malloc(path_len + 16)
+    _sip_trace.rotate_next_path = <char *> malloc(path_len + 16)
+    if _sip_trace.path == NULL or _sip_trace.rotate_path == NULL or _sip_trace.rotate_next_path == NULL:
+        _sip_trace_close()
+        raise MemoryError()
+    memcpy(_sip_trace.path, <char *> c_path, path_len + 1)
+    _sip_trace.max_size = max_size
+    _sip_trace.max_files = max_files
+    _sip_trace.records = 0
+    _sip_trace.dropped = 0
+    _sip_trace.rotations = 0
+    status = pj_mutex_create_simple(pool, "sip_trace_lock", &_sip_trace.lock)
+    if status != 0:
+        _sip_trace_close()
+        raise PJSIPError("Could not initialize SIP trace file mutex", status)
+    if _sip_trace_start_file() != 0:
+        _sip_trace_close()
+        raise SIPCoreError('Could not open SIP trace file "%s"' % c_path.decode(errors='replace'))
+    _sip_trace.enabled = 1
+    return 0
+
+cdef int _sip_trace_close() noexcept nogil:
+    global _sip_trace
+    if _sip_trace.lock != NULL:
+        pj_mutex_lock(_sip_trace.lock)
+    _sip_trace.enabled = 0
+    if _sip_trace.file != NULL:
+        fclose(_sip_trace.file)
+        _sip_trace.file = NULL
+    if _sip_trace.lock != NULL:
+        pj_mutex_unlock(_sip_trace.lock)
+        pj_mutex_destroy(_sip_trace.lock)
+        _sip_trace.lock = NULL
+    free(_sip_trace.path)
+    free(_sip_trace.rotate_path)
+    free(_sip_trace.rotate_next_path)
+    _sip_trace.path = NULL
+    _sip_trace.rotate_path = NULL
+    _sip_trace.rotate_next_path = NULL
+    return 0
+
+cdef int _sip_trace_start_file() noexcept nogil:
+    # Must be called with the lock held or before the trace file is enabled
+    cdef char header[_SIP_TRACE_FILE_HEADER]
+    memcpy(header, "SIPTRACE", 8)
+    _sip_trace_put_uint16(header + 8, _SIP_TRACE_VERSION)
+    _sip_trace.file = fopen(_sip_trace.path, "wb")
+    if _sip_trace.file == NULL:
+        return -1
+    if fwrite(header, 1, _SIP_TRACE_FILE_HEADER, _sip_trace.file) != _SIP_TRACE_FILE_HEADER:
+        fclose(_sip_trace.file)
+        _sip_trace.file = NULL
+        return -1
+    _sip_trace.size = _SIP_TRACE_FILE_HEADER
+    _sip_trace.dirty = 1
+    return 0
+
+cdef int _sip_trace_rotate() noexcept nogil:
+    # Must be called with the lock held
+    cdef int index
+    fclose(_sip_trace.file)
+    _sip_trace.file = NULL
+    if _sip_trace.max_files > 1:
+        for index from _sip_trace.max_files - 1 > index >= 1:
+            snprintf(_sip_trace.rotate_path, strlen(_sip_trace.path) + 16, "%s.%d", _sip_trace.path, index)
+            snprintf(_sip_trace.rotate_next_path, strlen(_sip_trace.path) + 16, "%s.%d", _sip_trace.path, index + 1)
+            rename(_sip_trace.rotate_path, _sip_trace.rotate_next_path)
+        snprintf(_sip_trace.rotate_next_path, strlen(_sip_trace.path) + 16, "%s.%d", _sip_trace.path, 1)
+        rename(_sip_trace.path, _sip_trace.rotate_next_path)
+    _sip_trace.rotations += 1
+    return _sip_trace_start_file()
+
+cdef inline void _sip_trace_put_uint16(char *buf, unsigned int value) noexcept nogil:
+    buf[0] = <char> ((value >> 8) & 0xff)
+    buf[1] = <char> (value & 0xff)
+
+cdef inline void _sip_trace_put_uint32(char *buf, unsigned long value) noexcept nogil:
+    buf[0] = <char> ((value >> 24) & 0xff)
+    buf[1] = <char> ((value >> 16) & 0xff)
+    buf[2] = <char> ((value >> 8) & 0xff)
+    buf[3] = <char> (value & 0xff)
+
+cdef inline size_t _sip_trace_put_str(char *buf, const char *value, size_t length) noexcept nogil:
+    if value == NULL:
+        length = 0
+    elif length > _SIP_TRACE_MAX_STR:
+        length = _SIP_TRACE_MAX_STR
+    buf[0] = <char> length
+    if length > 0:
+        memcpy(buf + 1, value, length)
+    return length + 1
+
+cdef int _sip_trace_write(int received, const char *transport, pj_str_t *source_ip, int source_port,
+                          pj_str_t *destination_ip, int destination_port, const char *data, size_t data_len) noexcept nogil:
+    global _sip_trace
+    cdef char header[_SIP_TRACE_MAX_HEADER]
+    cdef pj_time_val now
+    cdef size_t header_len = 4
+    cdef size_t record_len
+    if not _sip_trace.enabled:
+        return 0
+    pj_gettimeofday(&now)
+    _sip_trace_put_uint32(header + header_len, now.sec)
+    _sip_trace_put_uint32(header + header_len + 4, now.msec * 1000)
+    header_len += 8
+    header[header_len] = <char> (1 if received else 0)
+    header_len += 1
+    header_len += _sip_trace_put_str(header + header_len, transport, strlen(transport) if transport != NULL else 0)
+    header_len += _sip_trace_put_str(header + header_len, source_ip.ptr, source_ip.slen)
+    _sip_trace_put_uint16(header + header_len, source_port)
+    header_len += 2
+    header_len += _sip_trace_put_str(header + header_len, destination_ip.ptr, destination_ip.slen)
+    _sip_trace_put_uint16(header + header_len, destination_port)
+    header_len += 2
+    record_len = header_len + data_len
+    _sip_trace_put_uint32(header, record_len - 4)
+
+    pj_mutex_lock(_sip_trace.lock)
+    if _sip_trace.enabled and _sip_trace.size + record_len > _sip_trace.max_size and _sip_trace.size > _SIP_TRACE_FILE_HEADER:
+        if _sip_trace_rotate() != 0:
+            # Stop tracing if a new file cannot be started, rather than trying again for every packet
+            _sip_trace.enabled = 0
+    if not _sip_trace.enabled:
+        _sip_trace.dropped += 1
+    elif fwrite(header, 1, header_len, _sip_trace.file) != header_len or fwrite(data, 1, data_len, _sip_trace.file) != data_len:
+        _sip_trace.dropped += 1
+        _sip_trace.dirty = 1
+    else:
+        _sip_trace.size += record_len
+        _sip_trace.records += 1
+        _sip_trace.dirty = 1
+    pj_mutex_unlock(_sip_trace.lock)
+    return 0
+
+cdef int _sip_trace_flush() noexcept nogil:
+    global _sip_trace
+    if not _sip_trace.dirty or _sip_trace.lock == NULL:
+        return 0
+    pj_mutex_lock(_sip_trace.lock)
+    if _sip_trace.file != NULL:
+        fflush(_sip_trace.file)
+    _sip_trace.dirty = 0
+    pj_mutex_unlock(_sip_trace.lock)
+    return 0
+
+cdef dict _get_sip_trace_statistics():
+    return dict(enabled=bool(_sip_trace.enabled),
+                records=_sip_trace.records,
+                dropped=_sip_trace.dropped,
+                rotations=_sip_trace.rotations,
+                file_size=_sip_trace.size if _sip_trace.file != NULL else 0)
+
+# globals
+
+cdef _sip_trace_file _sip_trace
+_sip_trace.file = NULL
+_sip_trace.lock = NULL
+_sip_trace.path = NULL
+_sip_trace.rotate_path = NULL
+_sip_trace.rotate_next_path = NULL
+_sip_trace.enabled = 0
+_sip_trace.dirty = 0
+_sip_trace.size = 0
+_sip_trace.records = 0
+_sip_trace.dropped = 0
+_sip_trace.rotations = 0
@@ -10,6 +10,24 @@ import os
 import tempfile
 
 
+# C types
+
+# State which is needed by the PJSIP callbacks that run without the GIL. It mirrors the relevant PJSIPUA
+# attributes and is updated by PJSIPUA whenever they change. The string lists are protected by the lock.
+cdef struct _ua_fast_path_state:
+    pjsip_endpoint *endpoint
+    pj_mutex_t *lock
+    pj_pool_t *pool
+    int enabled
+    int trace_sip
+    int detect_sip_loops
+    pj_str_t user_agent
+    int incoming_request_count
+    pj_str_t incoming_requests[32]
+    int incoming_event_count
+    pj_str_t incoming_events[32]
+
+
 cdef class Timer:
     cdef int schedule(self, float delay, timer_callback callback, object obj) except -1:
         cdef PJSIPUA ua = _get_ua()
@@ -19,11 +37,10 @@ cdef class Timer:
             raise ValueError("callback must be non-NULL")
         if self._scheduled:
             raise RuntimeError("already scheduled")
-        self.schedule_time = PyFloat_AsDouble(time.time() + delay)
+        self.schedule_time = PyFloat_AsDouble(time.monotonic() + delay)
         self.callback = callback
         self.obj = obj
         ua._add_timer(self)
-        self._scheduled = 1
         return 0
 
     cdef int cancel(self) except -1:
@@ -31,32 +48,12 @@ cdef class Timer:
         if not self._scheduled:
             return 0
         ua._remove_timer(self)
-        self._scheduled = 0
         return 0
 
     cdef int call(self) except -1:
         self._scheduled = 0
         self.callback(self.obj, self)
 
-    def __richcmp__(self, other, op):
-        cdef double diff
-        if not isinstance(self, Timer) or not isinstance(other, Timer):
-            return NotImplemented
-        diff = (<Timer>self).schedule_time - (<Timer>other).schedule_time
-        if op == 0: # <
-            return diff < 0.0
-        elif op == 1: # <=
-            return diff <= 0.0
-        elif op == 2: # ==
-            return diff == 0.0
-        elif op == 3: # !=
-            return diff != 0.0
-        elif op == 4: # >
-            return diff > 0.0
-        elif op == 5: # >=
-            return diff >= 0.0
-        return
-
 
 cdef class PJSIPUA:
     def __cinit__(self, *args, **kwargs):
@@ -66,13 +63,14 @@ cdef class PJSIPUA:
         _ua = <void *> self
         self._threads = []
         self._timers = list()
+        self._media_check_scanner = MediaCheckScanner()
         self._events = {}
         self._incoming_events = set()
         self._incoming_requests = set()
         self._sent_messages = set()
 
     def __init__(self, event_handler, *args, **kwargs):
-        global _event_queue_lock
+        global _event_queue_lock, _handler_queue_lock
         cdef object event
         cdef object method
         cdef list accept_types
@@ -101,6 +99,12 @@ cdef class PJSIPUA:
         status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "event_queue_lock", &_event_queue_lock)
         if status != 0:
             raise PJSIPError("Could not initialize event queue mutex", status)
+        status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "handler_queue_lock", &_handler_queue_lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize handler queue mutex", status)
+        if kwargs["event_queue_size"] <= 0:
+            raise ValueError("Event queue size should be a positive number")
+        _event_ring_init(kwargs["event_queue_size"])
 
         self._ip_address = kwargs["ip_address"].encode() if kwargs["ip_address"] else None
         self.codecs = list(codec.encode() for codec in kwargs["codecs"] if codec in self.available_codecs)
@@ -175,7 +179,22 @@ cdef class PJSIPUA:
         if status != 0:
             raise PJSIPError("Could not load events module", status)
 
+        if not 0 < kwargs["min_poll_interval"] <= kwargs["max_poll_interval"]:
+            raise ValueError("Poll intervals should be positive numbers with min_poll_interval not larger than max_poll_interval")
+        self._min_poll_interval = kwargs["min_poll_interval"]
+        self._max_poll_interval = kwargs["max_poll_interval"]
+        self._poll_interval = self._min_poll_interval
+
+        status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "fast_path_lock", &_fast_path.lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize fast path mutex", status)
+        _fast_path.endpoint = self._pjsip_endpoint._obj
+
+        self._enable_fast_path = int(bool(kwargs["fast_path"]))
         self._trace_sip = int(bool(kwargs["trace_sip"]))
+        if kwargs["trace_sip_file"]:
+            _sip_trace_open(kwargs["trace_sip_file"], kwargs["trace_sip_file_size"], kwargs["trace_sip_file_count"], self._pjsip_endpoint._pool)
+            self._trace_sip_file = kwargs["trace_sip_file"]
         self._detect_sip_loops = int(bool(kwargs["detect_sip_loops"]))
         self._enable_colorbar_device = int(bool(kwargs["enable_colorbar_device"]))
         self._user_agent = PJSTR(kwargs["user_agent"].encode())
@@ -194,6 +213,10 @@ cdef class PJSIPUA:
         if status != 0:
             raise PJSIPError("Could not initialize video mutex", status)
 
+        status = pj_mutex_create_recursive(self._pjsip_endpoint._pool, "ua_poll_lock", &self._poll_lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize poll mutex", status)
+
         for event, accept_types in kwargs["events"].iteritems():
             self.add_event(event, accept_types)
 
@@ -206,6 +229,7 @@ cdef class PJSIPUA:
             if method in ("ACK", "BYE", "INVITE", "REFER", "SUBSCRIBE"):
                 raise ValueError('Handling incoming "%s" requests is not allowed' % method)
             self._incoming_requests.add(method.encode())
+        self._update_fast_path()
         pj_stun_config_init(&self._stun_cfg, &self._caching_pool._obj.factory, 0,
                             pjmedia_endpt_get_ioqueue(self._pjmedia_endpoint._obj),
                             pjsip_endpt_get_timer_heap(self._pjsip_endpoint._obj))
@@ -219,6 +243,19 @@ cdef class PJSIPUA:
         def __set__(self, value):
             self._check_self()
             self._trace_sip = int(bool(value))
+            self._update_fast_path()
+
+    property trace_sip_file:
+
+        def __get__(self):
+            self._check_self()
+            return self._trace_sip_file
+
+    property trace_sip_file_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return _get_sip_trace_statistics()
 
     property detect_sip_loops:
 
@@ -229,6 +266,18 @@ cdef class PJSIPUA:
         def __set__(self, value):
             self._check_self()
             self._detect_sip_loops = int(bool(value))
+            self._update_fast_path()
+
+    property fast_path:
+
+        def __get__(self):
+            self._check_self()
+            return bool(self._enable_fast_path)
+
+        def __set__(self, value):
+            self._check_self()
+            self._enable_fast_path = int(bool(value))
+            self._update_fast_path()
 
     property enable_colorbar_device:
 
@@ -247,6 +296,18 @@ cdef class PJSIPUA:
             self._check_self()
             return self._events.copy()
 
+    property event_queue_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return _get_event_queue_statistics()
+
+    property timer_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return dict(live=len(self._timers) - self._dead_timers, dead=self._dead_timers, compactions=self._timer_compactions)
+
     property ip_address:
 
         def __get__(self):
@@ -284,12 +345,14 @@ cdef class PJSIPUA:
         if event not in self._events.keys():
             raise ValueError('Event "%s" is not known' % event)
         self._incoming_events.add(event)
+        self._update_fast_path()
 
     def remove_incoming_event(self, object event):
         self._check_self()
         if event not in self._events.keys():
             raise ValueError('Event "%s" is not known' % event)
         self._incoming_events.discard(event)
+        self._update_fast_path()
 
     property incoming_requests:
 
@@ -302,12 +365,14 @@ cdef class PJSIPUA:
         if method in ("ACK", "BYE", "INVITE", "REFER", "SUBSCRIBE"):
             raise ValueError('Handling incoming "%s" requests is not allowed' % method)
         self._incoming_requests.add(method.encode())
+        self._update_fast_path()
 
     def remove_incoming_request(self, object method):
         self._check_self()
         if method in ("ACK", "BYE", "INVITE", "REFER", "SUBSCRIBE"):
             raise ValueError('Handling incoming "%s" requests is not allowed' % method)
         self._incoming_requests.discard(method.encode())
+        self._update_fast_path()
 
     cdef pj_pool_t* create_memory_pool(self, bytes name, int initial_size, int resize_size):
         cdef pj_pool_t *pool
@@ -630,7 +695,8 @@ cdef class PJSIPUA:
 
         def __set__(self, value):
             self._check_self()
-            self._user_agent = PJSTR(b"value")
+            self._user_agent = PJSTR(value.encode())
+            self._update_fast_path()
 
     property log_level:
 
@@ -767,7 +833,7 @@ cdef class PJSIPUA:
         self.dealloc()
 
     def dealloc(self):
-        global _ua, _dealloc_handler_queue, _event_queue_lock
+        global _ua, _dealloc_handler_queue, _event_queue_lock, _handler_queue_lock
         if _ua == NULL:
             return
         self._check_thread()
@@ -779,73 +845,147 @@ cdef class PJSIPUA:
             pj_mutex_destroy(self.video_lock)
             self.video_lock = NULL
         _process_handler_queue(self, &_dealloc_handler_queue)
+        _materialize_message_headers()
+        _release_message_headers_pools(self)
+        _sip_trace_close()
+        if _fast_path.lock != NULL:
+            pj_mutex_lock(_fast_path.lock)
+            _fast_path.enabled = 0
+            _fast_path.endpoint = NULL
+            _fast_path.pool = NULL
+            pj_mutex_unlock(_fast_path.lock)
+            pj_mutex_destroy(_fast_path.lock)
+            _fast_path.lock = NULL
+        if self._fast_path_pool != NULL:
+            self.release_memory_pool(self._fast_path_pool)
+            self._fast_path_pool = NULL
         if _event_queue_lock != NULL:
             pj_mutex_lock(_event_queue_lock)
             pj_mutex_destroy(_event_queue_lock)
             _event_queue_lock = NULL
+        if _handler_queue_lock != NULL:
+            pj_mutex_lock(_handler_queue_lock)
+            pj_mutex_destroy(_handler_queue_lock)
+            _handler_queue_lock = NULL
+        if self._poll_lock != NULL:
+            pj_mutex_destroy(self._poll_lock)
+            self._poll_lock = NULL
         self._pjsip_endpoint = None
         self._pjmedia_endpoint = None
         self._caching_pool = None
         self._pjlib = None
         _ua = NULL
         self._poll_log()
+        _event_ring_dealloc()
 
     cdef int _poll_log(self) except -1:
-        cdef object event_name
-        cdef dict event_params
         cdef list events
         events = _get_clear_event_queue()
-        for event_name, event_params in events:
-            self._event_handler(event_name, **event_params)
+        if events:
+            self._event_handler(events)
+        return len(events)
+
+    def handle_events(self, double timeout):
+        # Only handles the PJSIP events, while the timers, the post-poll handlers and the delivery of the core
+        # events are left to the thread which calls poll. This allows additional worker threads to take part in
+        # handling the network events, the callbacks into the core acquire the GIL and the threads register
+        # themselves with PJSIP on first use through _check_thread. Since the events produced by the callbacks which
+        # run in these threads are delivered by the polling thread, poll is kept from backing off while they see
+        # activity. The timer heap and the poll interval are shared with these threads and may only be accessed with
+        # the poll lock held.
+        cdef unsigned int count = 0
+        cdef pj_time_val pj_timeout
+        self._check_self()
+        if timeout < 0:
+            raise ValueError("timeout must be a non-negative number")
+        pj_timeout.sec = int(timeout)
+        pj_timeout.msec = int(timeout * 1000) % 1000
+        self._handle_pjsip_events(&pj_timeout, &count)
+        if count > 0:
+            self._lock_poll_state()
+            try:
+                self._poll_interval = self._min_poll_interval
+            finally:
+                self._unlock_poll_state()
+        return count
+
+    cdef int _handle_pjsip_events(self, pj_time_val *timeout, unsigned int *count) except -1:
+        cdef int status
+        with nogil:
+            status = pjsip_endpt_handle_events2(self._pjsip_endpoint._obj, timeout, count)
+        IF UNAME_SYSNAME == "Darwin":
+            if status not in [0, PJ_ERRNO_START_SYS + errno.EBADF]:
+                raise PJSIPError("Error while handling events", status)
+        ELSE:
+            if status != 0:
+                raise PJSIPError("Error while handling events", status)
+        return 0
 
     def poll(self):
         global _post_poll_handler_queue
-        cdef int status
+        cdef int activity
+        cdef unsigned int count = 0
         cdef double now
-        cdef object retval = None
-        cdef float max_timeout
+        cdef double max_timeout
         cdef pj_time_val pj_max_timeout
-        cdef list timers
-        cdef Timer timer
+        cdef int fired
+        cdef list entry
+        cdef object timer
 
         self._check_self()
 
-        max_timeout = 0.100
-        while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
-                # timer was cancelled
-                heapq.heappop(self._timers)
-            else:
-                max_timeout = min(max((<Timer>self._timers[0]).schedule_time - time.time(), 0.0), max_timeout)
-                break
+        # The timeout only bounds how long we wait when nothing happens, as pjsip_endpt_handle_events2 returns as
+        # soon as it processed network events and never sleeps past the earliest PJSIP timer. It is reset to the
+        # minimum poll interval whenever there was some activity and doubles on every idle iteration until it
+        # reaches the maximum poll interval. It is further capped by the earliest Python timer. Work queued by other
+        # threads, like post-poll handlers, does not interrupt the wait, so the maximum poll interval also bounds the
+        # delay with which it is processed and should not be set higher than what that work can tolerate.
+        self._lock_poll_state()
+        try:
+            max_timeout = self._poll_interval
+            while self._timers:
+                entry = self._timers[0]
+                if entry[2] is None:
+                    # timer was cancelled
+                    heapq.heappop(self._timers)
+                    self._dead_timers -= 1
+                else:
+                    max_timeout = min(max(<double>entry[0] - time.monotonic(), 0.0), max_timeout)
+                    break
+        finally:
+            self._unlock_poll_state()
         pj_max_timeout.sec = int(max_timeout)
         pj_max_timeout.msec = int(max_timeout * 1000) % 1000
-        with nogil:
-            status = pjsip_endpt_handle_events(self._pjsip_endpoint._obj, &pj_max_timeout)
-        IF UNAME_SYSNAME == "Darwin":
-            if status not in [0, PJ_ERRNO_START_SYS + errno.EBADF]:
-                raise PJSIPError("Error while handling events", status)
-        ELSE:
-            if status != 0:
-                raise PJSIPError("Error while handling events", status)
-        _process_handler_queue(self, &_post_poll_handler_queue)
-
-        timers = list()
-        now = time.time()
-        while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
-                # timer was cancelled
-                heapq.heappop(self._timers)
-            elif (<Timer>self._timers[0]).schedule_time <= now:
-                # timer needs to be processed
-                timer = heapq.heappop(self._timers)
-                timers.append(timer)
-            else:
+        self._handle_pjsip_events(&pj_max_timeout, &count)
+        activity = count > 0
+        if _process_handler_queue(self, &_post_poll_handler_queue) > 0:
+            activity = 1
+
+        # Timers are popped and fired one at a time, so that a timer cancelled or rescheduled by the callback of
+        # an earlier one is handled through its heap entry like any other. Timers scheduled by a callback are due
+        # after now and will not be fired before the next iteration. The callbacks run without the poll lock held.
+        fired = 0
+        now = time.monotonic()
+        while True:
+            timer = self._pop_expired_timer(now)
+            if timer is None:
                 break
-        for timer in timers:
+            fired += 1
             timer.call()
 
-        self._poll_log()
+        if self._poll_log() > 0 or fired:
+            activity = 1
+        if _sip_trace.dirty:
+            with nogil:
+                _sip_trace_flush()
+        self._lock_poll_state()
+        try:
+            if activity:
+                self._poll_interval = self._min_poll_interval
+            else:
+                self._poll_interval = min(2 * self._poll_interval, self._max_poll_interval)
+        finally:
+            self._unlock_poll_state()
         if self._fatal_error:
             return True
         else:
@@ -874,13 +1014,130 @@ cdef class PJSIPUA:
             self._threads.append(PJSIPThread())
         return 0
 
+    cdef int _lock_poll_state(self) except -1:
+        # The lock is acquired without holding the GIL, as the code which runs while holding it may release the GIL
+        cdef int status
+        cdef pj_mutex_t *lock = self._poll_lock
+        if lock == NULL:
+            return 0
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        return 0
+
+    cdef int _unlock_poll_state(self) except -1:
+        cdef pj_mutex_t *lock = self._poll_lock
+        if lock != NULL:
+            with nogil:
+                pj_mutex_unlock(lock)
+        return 0
+
     cdef int _add_timer(self, Timer timer) except -1:
-        heapq.heappush(self._timers, timer)
+        # The heap holds [schedule_time, sequence, timer] entries, the sequence keeps the ordering of timers
+        # scheduled for the same time stable and the timer is replaced with None when the timer is cancelled.
+        self._lock_poll_state()
+        try:
+            self._timer_sequence += 1
+            timer._entry = [timer.schedule_time, self._timer_sequence, timer]
+            heapq.heappush(self._timers, timer._entry)
+            timer._scheduled = 1
+        finally:
+            self._unlock_poll_state()
         return 0
 
     cdef int _remove_timer(self, Timer timer) except -1:
-        # Don't remove it from the heap, just mark it as not scheduled
-        timer._scheduled = 0
+        # Mark the heap entry as dead and compact the heap once the dead entries make up most of it
+        self._lock_poll_state()
+        try:
+            if timer._entry is not None:
+                timer._entry[2] = None
+                timer._entry = None
+                self._dead_timers += 1
+                if self._dead_timers > 1024 and 2 * self._dead_timers > len(self._timers):
+                    self._compact_timers()
+            timer._scheduled = 0
+        finally:
+            self._unlock_poll_state()
+        return 0
+
+    cdef object _pop_expired_timer(self, double now):
+        # Return the next timer which expired at the given time, after removing it from the heap, or None
+        cdef list entry
+        cdef Timer timer
+        self._lock_poll_state()
+        try:
+            while self._timers:
+                entry = self._timers[0]
+                if entry[2] is None:
+                    # timer was cancelled
+                    heapq.heappop(self._timers)
+                    self._dead_timers -= 1
+                elif <double>entry[0] <= now:
+                    heapq.heappop(self._timers)
+                    timer = entry[2]
+                    if entry is timer._entry:
+                        timer._entry = None
+                        timer._scheduled = 0
+                        return timer
+                else:
+                    break
+            return None
+        finally:
+            self._unlock_poll_state()
+
+    cdef int _compact_timers(self) except -1:
+        # Must be called with the poll lock held
+        self._timers = [entry for entry in self._timers if entry[2] is not None]
+        heapq.heapify(self._timers)
+        self._dead_timers = 0
+        self._timer_compactions += 1
+        return 0
+
+    cdef int _update_fast_path(self) except -1:
+        global _fast_path
+        cdef pj_str_t value
+        cdef pj_pool_t *pool
+        cdef pj_pool_t *old_pool = NULL
+        cdef object item
+        cdef int index
+        cdef int status
+        if _fast_path.lock == NULL:
+            return 0
+        # The strings are copied to a new pool on every update, which replaces the previous one while holding the
+        # lock. The previous pool is released afterwards, as the callbacks only use the strings with the lock held.
+        pool = self.create_memory_pool(b"fast_path", 1024, 1024)
+        with nogil:
+            status = pj_mutex_lock(_fast_path.lock)
+        if status != 0:
+            self.release_memory_pool(pool)
+            raise PJSIPError("Could not acquire fast path mutex", status)
+        try:
+            old_pool = _fast_path.pool
+            _fast_path.pool = self._fast_path_pool = pool
+            # The lists are marked as unknown until they are completely copied, so that the callbacks never use
+            # strings from the previous pool
+            _fast_path.incoming_request_count = -1
+            _fast_path.incoming_event_count = -1
+            _fast_path.enabled = self._enable_fast_path
+            _fast_path.trace_sip = self._trace_sip
+            _fast_path.detect_sip_loops = self._detect_sip_loops
+            pj_strdup(pool, &_fast_path.user_agent, &self._user_agent.pj_str)
+            if len(self._incoming_requests) <= 32:
+                for index, item in enumerate(self._incoming_requests):
+                    _str_to_pj_str(item, &value)
+                    pj_strdup(pool, &_fast_path.incoming_requests[index], &value)
+                _fast_path.incoming_request_count = len(self._incoming_requests)
+            if len(self._incoming_events) <= 32:
+                for index, item in enumerate(self._incoming_events):
+                    _str_to_pj_str(item, &value)
+                    pj_strdup(pool, &_fast_path.incoming_events[index], &value)
+                _fast_path.incoming_event_count = len(self._incoming_events)
+        finally:
+            with nogil:
+                pj_mutex_unlock(_fast_path.lock)
+            if old_pool != NULL:
+                self.release_memory_pool(old_pool)
         return 0
 
     cdef int _cb_rx_request(self, pjsip_rx_data *rdata) except 0:
@@ -896,28 +1153,15 @@ cdef class PJSIPUA:
         cdef list extra_headers
         cdef dict event_dict
         cdef dict message_params
-        cdef pj_str_t tsx_key
-        cdef pjsip_via_hdr *top_via
-        cdef pjsip_via_hdr *via
         cdef pjsip_transaction *tsx = NULL
         cdef unsigned int options = PJSIP_INV_SUPPORT_100REL
         cdef pjsip_event_hdr *event_hdr
         cdef object method_name = _pj_str_to_bytes(rdata.msg_info.msg.line.req.method.name)
         if method_name != b"ACK":
             if self._detect_sip_loops:
-                # Temporarily trick PJSIP into believing the last Via header is actually the first
-                top_via = via = rdata.msg_info.via
-                while True:
-                    rdata.msg_info.via = via
-                    via = <pjsip_via_hdr *> pjsip_msg_find_hdr(rdata.msg_info.msg, PJSIP_H_VIA, (<pj_list *> via).next)
-                    if via == NULL:
-                        break
-                status = pjsip_tsx_create_key(rdata.tp_info.pool, &tsx_key,
-                                              PJSIP_ROLE_UAC, &rdata.msg_info.msg.line.req.method, rdata)
-                rdata.msg_info.via = top_via
+                status = _find_looped_transaction(rdata, &tsx)
                 if status != 0:
                     raise PJSIPError("Could not generate transaction key for incoming request", status)
-                tsx = pjsip_tsx_layer_find_tsx(&tsx_key, 0)
         if tsx != NULL:
             status = pjsip_endpt_create_response(self._pjsip_endpoint._obj, rdata, 482, NULL, &tdata)
             if status != 0:
@@ -955,7 +1199,7 @@ cdef class PJSIPUA:
             extra_headers = list()
             message_params = dict()
             event_dict = dict()
-            _pjsip_msg_to_dict(rdata.msg_info.msg, event_dict)
+            _pjsip_msg_to_lazy_dict(rdata.msg_info.msg, event_dict)
             message_params["request_uri"] = event_dict["request_uri"]
             message_params["from_header"] = event_dict["headers"].get("From", None)
             message_params["to_header"] = event_dict["headers"].get("To", None)
@@ -1077,10 +1321,67 @@ cdef int _PJSIPUA_cb_rx_request_impl(pjsip_rx_data *rdata) with gil:
 
 cdef int _PJSIPUA_cb_rx_request(pjsip_rx_data *rdata) noexcept nogil:
     cdef int result
+    if _fast_path_rx_request(rdata):
+        return 1
     with gil:
         result = _PJSIPUA_cb_rx_request_impl(rdata)
     return result
 
+cdef int _fast_path_rx_request(pjsip_rx_data *rdata) noexcept nogil:
+    # Answers the requests which don't need to reach Python (OPTIONS queries and the requests which are rejected
+    # because nobody handles them) without acquiring the GIL. The responses are the same ones _cb_rx_request
+    # would send. Returns 1 if the request was answered and 0 if it has to go through _cb_rx_request.
+    global _fast_path
+    cdef pjsip_method *method = &rdata.msg_info.msg.line.req.method
+    cdef pjsip_event_hdr *event_hdr
+    cdef pjsip_transaction *tsx = NULL
+    cdef pjsip_tx_data *tdata = NULL
+    cdef pjsip_hdr_ptr_const hdr_add
+    cdef int hdr_types[3]
+    cdef int code = 0
+    cdef int index
+    cdef int status
+    if not _fast_path.enabled or _fast_path.lock == NULL or method.id == PJSIP_ACK_METHOD or method.id == PJSIP_INVITE_METHOD:
+        return 0
+    if pj_mutex_lock(_fast_path.lock) != 0:
+        return 0
+    if _fast_path.enabled and _fast_path.incoming_request_count >= 0 and _fast_path.incoming_event_count >= 0:
+        if _pj_str_in_array(&method.name, _fast_path.incoming_requests, _fast_path.incoming_request_count):
+            code = 0
+        elif method.id == PJSIP_OPTIONS_METHOD:
+            code = 200
+        elif pj_strcmp(&method.name, &_subscribe_method_str) == 0:
+            event_hdr = <pjsip_event_hdr *> pjsip_msg_find_hdr_by_name(rdata.msg_info.msg, &_event_hdr_str, NULL)
+            if event_hdr == NULL or not _pj_str_in_array(&event_hdr.event_type, _fast_path.incoming_events, _fast_path.incoming_event_count):
+                code = 489
+        elif pj_strcmp(&method.name, &_refer_method_str) != 0 and pj_strcmp(&method.name, &_message_method_str) != 0:
+            code = 405
+        if code != 0 and _fast_path.detect_sip_loops:
+            status = _find_looped_transaction(rdata, &tsx)
+            if status != 0:
+                code = 0
+            elif tsx != NULL:
+                code = 482
+    pj_mutex_unlock(_fast_path.lock)
+    if code == 0:
+        return 0
+    status = pjsip_endpt_create_response(_fast_path.endpoint, rdata, code, NULL, &tdata)
+    if status != 0:
+        return 0
+    if code == 200:
+        hdr_types[0] = PJSIP_H_ALLOW
+        hdr_types[1] = PJSIP_H_ACCEPT
+        hdr_types[2] = PJSIP_H_SUPPORTED
+        for index in range(3):
+            hdr_add = pjsip_endpt_get_capability(_fast_path.endpoint, hdr_types[index], NULL)
+            if hdr_add != NULL:
+                pjsip_msg_add_hdr(tdata.msg, <pjsip_hdr *> pjsip_hdr_clone(tdata.pool, hdr_add))
+    status = pjsip_endpt_send_response2(_fast_path.endpoint, rdata, tdata, NULL, NULL)
+    if status != 0:
+        pjsip_tx_data_dec_ref(tdata)
+        return 0
+    return 1
+
 cdef int _cb_opus_fix_tx_impl(pjsip_tx_data *tdata) with gil:
     cdef PJSIPUA ua
     cdef pjsip_msg_body *body
@@ -1126,6 +1427,8 @@ cdef int _cb_opus_fix_tx_impl(pjsip_tx_data *tdata) with gil:
 
 cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) noexcept nogil:
     cdef int result
+    if tdata == NULL or tdata.msg == NULL or tdata.msg.body == NULL:
+        return 0
     with gil:
         result = _cb_opus_fix_tx_impl(tdata)
     return result
@@ -1160,6 +1463,8 @@ cdef int _cb_opus_fix_rx_impl(pjsip_rx_data *rdata) with gil:
 
 cdef int _cb_opus_fix_rx(pjsip_rx_data *rdata) noexcept nogil:
     cdef int result
+    if rdata == NULL or rdata.msg_info.msg == NULL or rdata.msg_info.msg.body == NULL:
+        return 0
     with gil:
         result = _cb_opus_fix_rx_impl(rdata)
     return result
@@ -1186,6 +1491,14 @@ cdef int _cb_trace_rx_impl(pjsip_rx_data *rdata) with gil:
 
 cdef int _cb_trace_rx(pjsip_rx_data *rdata) noexcept nogil:
     cdef int result
+    cdef pj_str_t source_ip
+    if _sip_trace.enabled:
+        source_ip = pj_str(rdata.pkt_info.src_name)
+        _sip_trace_write(1, rdata.tp_info.transport.type_name, &source_ip, rdata.pkt_info.src_port,
+                         &rdata.tp_info.transport.local_name.host, rdata.tp_info.transport.local_name.port,
+                         rdata.pkt_info.packet, rdata.pkt_info.len)
+    if not _fast_path.trace_sip:
+        return 0
     with gil:
         result = _cb_trace_rx_impl(rdata)
     return result
@@ -1212,61 +1525,23 @@ cdef int _cb_trace_tx_impl(pjsip_tx_data *tdata) with gil:
 
 cdef int _cb_trace_tx(pjsip_tx_data *tdata) noexcept nogil:
     cdef int result
+    cdef pj_str_t destination_ip
+    if _sip_trace.enabled:
+        destination_ip = pj_str(tdata.tp_info.dst_name)
+        _sip_trace_write(0, tdata.tp_info.transport.type_name, &tdata.tp_info.transport.local_name.host,
+                         tdata.tp_info.transport.local_name.port, &destination_ip, tdata.tp_info.dst_port,
+                         tdata.buf.start, tdata.buf.cur - tdata.buf.start)
+    if not _fast_path.trace_sip:
+        return 0
     with gil:
         result = _cb_trace_tx_impl(tdata)
     return result
 
-cdef int _cb_add_user_agent_hdr_impl(pjsip_tx_data *tdata) with gil:
-    cdef PJSIPUA ua
-    cdef pjsip_hdr *hdr
-    cdef void *found_hdr
-    try:
-        ua = _get_ua()
-    except:
-        return 0
-    try:
-        found_hdr = pjsip_msg_find_hdr_by_name(tdata.msg, &_user_agent_hdr_name.pj_str, NULL)
-        if found_hdr == NULL:
-            hdr = <pjsip_hdr *> pjsip_generic_string_hdr_create(tdata.pool, &_user_agent_hdr_name.pj_str,
-                                                                &ua._user_agent.pj_str)
-            if hdr == NULL:
-                raise SIPCoreError('Could not add "User-Agent" header to outgoing request')
-            pjsip_msg_add_hdr(tdata.msg, hdr)
-    except:
-        ua._handle_exception(0)
-    return 0
-
 cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) noexcept nogil:
-    cdef int result
-    with gil:
-        result = _cb_add_user_agent_hdr_impl(tdata)
-    return result
-
-cdef int _cb_add_server_hdr_impl(pjsip_tx_data *tdata) with gil:
-    cdef PJSIPUA ua
-    cdef pjsip_hdr *hdr
-    cdef void *found_hdr
-    try:
-        ua = _get_ua()
-    except:
-        return 0
-    try:
-        found_hdr = pjsip_msg_find_hdr_by_name(tdata.msg, &_server_hdr_name.pj_str, NULL)
-        if found_hdr == NULL:
-            hdr = <pjsip_hdr *> pjsip_generic_string_hdr_create(tdata.pool, &_server_hdr_name.pj_str,
-                                                                &ua._user_agent.pj_str)
-            if hdr == NULL:
-                raise SIPCoreError('Could not add "Server" header to outgoing response')
-            pjsip_msg_add_hdr(tdata.msg, hdr)
-    except:
-        ua._handle_exception(0)
-    return 0
+    return _add_user_agent_hdr(tdata, &_user_agent_hdr_str)
 
 cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) noexcept nogil:
-    cdef int result
-    with gil:
-        result = _cb_add_server_hdr_impl(tdata)
-    return result
+    return _add_user_agent_hdr(tdata, &_server_hdr_str)
 
 # functions
 
@@ -1282,11 +1557,62 @@ cdef PJSIPUA _get_ua():
 cdef int deallocate_weakref(object weak_ref, object timer) except -1:
     Py_DECREF(weak_ref)
 
+cdef int _add_user_agent_hdr(pjsip_tx_data *tdata, pj_str_t *hdr_name) noexcept nogil:
+    global _fast_path
+    cdef pjsip_hdr *hdr = NULL
+    if _fast_path.lock == NULL or pjsip_msg_find_hdr_by_name(tdata.msg, hdr_name, NULL) != NULL:
+        return 0
+    if pj_mutex_lock(_fast_path.lock) != 0:
+        return 0
+    # the header copies the value, which is only valid while holding the lock
+    if _fast_path.user_agent.ptr != NULL:
+        hdr = <pjsip_hdr *> pjsip_generic_string_hdr_create(tdata.pool, hdr_name, &_fast_path.user_agent)
+    pj_mutex_unlock(_fast_path.lock)
+    if hdr != NULL:
+        pjsip_msg_add_hdr(tdata.msg, hdr)
+    return 0
+
+cdef int _find_looped_transaction(pjsip_rx_data *rdata, pjsip_transaction **tsx) noexcept nogil:
+    cdef pj_str_t tsx_key
+    cdef pjsip_via_hdr *top_via
+    cdef pjsip_via_hdr *via
+    cdef int status
+    # Temporarily trick PJSIP into believing the last Via header is actually the first
+    top_via = via = rdata.msg_info.via
+    while True:
+        rdata.msg_info.via = via
+        via = <pjsip_via_hdr *> pjsip_msg_find_hdr(rdata.msg_info.msg, PJSIP_H_VIA, (<pj_list *> via).next)
+        if via == NULL:
+            break
+    status = pjsip_tsx_create_key(rdata.tp_info.pool, &tsx_key,
+                                  PJSIP_ROLE_UAC, &rdata.msg_info.msg.line.req.method, rdata)
+    rdata.msg_info.via = top_via
+    if status != 0:
+        return status
+    tsx[0] = pjsip_tsx_layer_find_tsx(&tsx_key, 0)
+    return 0
+
+cdef int _pj_str_in_array(pj_str_t *value, pj_str_t *array, int count) noexcept nogil:
+    cdef int index
+    for index in range(count):
+        if pj_strcmp(value, &array[index]) == 0:
+            return 1
+    return 0
+
 
 # globals
 
 cdef void *_ua = NULL
-cdef PJSTR _user_agent_hdr_name = PJSTR(b"User-Agent")
-cdef PJSTR _server_hdr_name = PJSTR(b"Server")
 cdef PJSTR _event_hdr_name = PJSTR(b"Event")
+cdef pj_str_t _user_agent_hdr_str = pj_str("User-Agent")
+cdef pj_str_t _server_hdr_str = pj_str("Server")
+cdef pj_str_t _event_hdr_str = pj_str("Event")
+cdef pj_str_t _subscribe_method_str = pj_str("SUBSCRIBE")
+cdef pj_str_t _refer_method_str = pj_str("REFER")
+cdef pj_str_t _message_method_str = pj_str("MESSAGE")
+cdef _ua_fast_path_state _fast_path
+_fast_path.lock = NULL
+_fast_path.enabled = 0
+_fast_path.trace_sip = 0
+_fast_path.user_agent.ptr = NULL
 cdef object _re_ipv4 = re.compile(r"^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})$")
@@ -2,6 +2,10 @@
 import platform
 import re
 import sys
+import weakref
+
+from collections.abc import Mapping
+from threading import Lock
 
 from application.version import Version
 
@@ -153,6 +157,156 @@ cdef class frozendict:
         return list(self.dict.values())
 
 
+cdef class SIPMessageHeaders:
+    # A read-only mapping of the headers of a SIP message which are converted into
+    # header objects on first access, as most observers only look at a few of them.
+    # The message is cloned as the rdata/tdata it came from does not outlive the
+    # callback. The clone lives in a pool which is taken from a small set of reused
+    # pools and given back once every header has been converted. As the mapping is
+    # delivered to observers in other threads, the clone is only accessed with the
+    # lock held.
+
+    def __cinit__(self, *args, **kwargs):
+        self._lock = Lock()
+        self._pool = NULL
+        self._msg = NULL
+        self._headers = dict()
+        self._complete = 0
+
+    def __init__(self, *args, **kwargs):
+        raise TypeError("SIPMessageHeaders cannot be instantiated directly")
+
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+        if self._pool == NULL:
+            return
+        try:
+            ua = _get_ua()
+        except SIPCoreError:
+            return
+        self._release(ua)
+
+    def __getitem__(self, name):
+        cdef object header_data
+        try:
+            return self._headers[name]
+        except KeyError:
+            if self._complete:
+                raise
+        with self._lock:
+            try:
+                return self._headers[name]
+            except KeyError:
+                if self._complete:
+                    raise
+            header_data = self._lookup(name)
+            if header_data is None:
+                raise KeyError(name)
+            self._headers[name] = header_data
+        return header_data
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        self._materialize()
+        return iter(self._headers)
+
+    def __len__(self):
+        self._materialize()
+        return len(self._headers)
+
+    def __repr__(self):
+        self._materialize()
+        return "%s(%r)" % (self.__class__.__name__, self._headers)
+
+    def __eq__(self, other):
+        self._materialize()
+        if isinstance(other, SIPMessageHeaders):
+            other = other.copy()
+        return self._headers == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (dict, (self.copy(),))
+
+    def copy(self):
+        self._materialize()
+        return dict(self._headers)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def items(self):
+        self._materialize()
+        return list(self._headers.items())
+
+    def keys(self):
+        self._materialize()
+        return list(self._headers.keys())
+
+    def values(self):
+        self._materialize()
+        return list(self._headers.values())
+
+    cdef object _lookup(self, object name):
+        # Must be called with the lock held
+        cdef pjsip_hdr *header
+        cdef bint multi_header
+        cdef object header_data
+        cdef object result = None
+        if self._msg == NULL:
+            return None
+        header = <pjsip_hdr *> (<pj_list *> &self._msg.hdr).next
+        while header != &self._msg.hdr:
+            if _pj_str_to_str(header.name) == name:
+                header_data = _pjsip_hdr_to_object(header, name, self._skip_replaces, &multi_header)
+                if header_data is not None:
+                    if not multi_header:
+                        return header_data
+                    if result is None:
+                        result = []
+                    result.append(header_data)
+            header = <pjsip_hdr *> (<pj_list *> header).next
+        return result
+
+    cdef int _materialize(self) except -1:
+        cdef dict headers
+        with self._lock:
+            if self._complete:
+                return 0
+            if self._msg != NULL:
+                headers = _pjsip_msg_headers_to_dict(self._msg, self._skip_replaces)
+                headers.update(self._headers)
+            else:
+                headers = self._headers
+            self._headers = headers
+            self._complete = 1
+            if self._pool != NULL:
+                self._release(_get_ua())
+        return 0
+
+    cdef int _release(self, PJSIPUA ua) except -1:
+        cdef pj_pool_t *pool = self._pool
+        self._msg = NULL
+        self._pool = NULL
+        _message_headers_pool_put(ua, pool)
+        return 0
+
+Mapping.register(SIPMessageHeaders)
+
+
 # functions
 
 cdef int _str_to_pj_str(object string, pj_str_t *pj_str) except -1:
@@ -235,86 +389,81 @@ cdef int _dict_to_pjsip_param(object params, pjsip_param *param_list, pj_pool_t
         pj_list_insert_after(<pj_list *> param_list, <pj_list *> param)
     return 0
 
-cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
-    cdef pjsip_msg_body *body
-    cdef pjsip_hdr *header
+cdef object _pjsip_hdr_to_object(pjsip_hdr *header, object header_name, int skip_replaces, bint *multi_header):
     cdef pjsip_generic_array_hdr *array_header
-    cdef pjsip_ctype_hdr *ctype_header
     cdef pjsip_cseq_hdr *cseq_header
-    cdef char *buf
-    cdef int buf_len, status
-    headers = {}
+    header_data = None
+    multi_header[0] = 0
+    if header_name in ("Accept", "Allow", "Require", "Supported", "Unsupported", "Allow-Events"):
+        array_header = <pjsip_generic_array_hdr *> header
+        header_data = []
+        if array_header.count < 128:
+            for i from 0 <= i < array_header.count:
+                header_data.append(_pj_str_to_bytes(array_header.values[i]))
+    elif header_name == "Contact":
+        multi_header[0] = 1
+        header_data = FrozenContactHeader_create(<pjsip_contact_hdr *> header)
+    elif header_name == "Content-Length":
+        header_data = (<pjsip_clen_hdr *> header).len
+    elif header_name == "Content-Type":
+        header_data = FrozenContentTypeHeader_create(<pjsip_ctype_hdr *> header)
+    elif header_name == "CSeq":
+        cseq_header = <pjsip_cseq_hdr *> header
+        hvalue = _pj_str_to_str(cseq_header.method.name)
+        header_data = (cseq_header.cseq, hvalue)
+    elif header_name in ("Expires", "Max-Forwards", "Min-Expires"):
+        header_data = (<pjsip_generic_int_hdr *> header).ivalue
+    elif header_name == "From":
+        header_data = FrozenFromHeader_create(<pjsip_fromto_hdr *> header)
+    elif header_name == "To":
+        header_data = FrozenToHeader_create(<pjsip_fromto_hdr *> header)
+    elif header_name == "Route":
+        multi_header[0] = 1
+        header_data = FrozenRouteHeader_create(<pjsip_routing_hdr *> header)
+    elif header_name == "Reason":
+        value = _pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue)
+        protocol, sep, params_str = value.partition(';')
+        params = frozendict([(name, value or None) for name, sep, value in [param.partition('=') for param in params_str.split(';')]])
+        header_data = FrozenReasonHeader(protocol, params)
+    elif header_name == "Record-Route":
+        multi_header[0] = 1
+        header_data = FrozenRecordRouteHeader_create(<pjsip_routing_hdr *> header)
+    elif header_name == "Retry-After":
+        header_data = FrozenRetryAfterHeader_create(<pjsip_retry_after_hdr *> header)
+    elif header_name == "Via":
+        multi_header[0] = 1
+        header_data = FrozenViaHeader_create(<pjsip_via_hdr *> header)
+    elif header_name == "Warning":
+        match = _re_warning_hdr.match(_pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue))
+        if match is not None:
+            warning_params = match.groupdict()
+            warning_params['code'] = int(warning_params['code'])
+            header_data = FrozenWarningHeader(**warning_params)
+    elif header_name == "Event":
+        header_data = FrozenEventHeader_create(<pjsip_event_hdr *> header)
+    elif header_name == "Subscription-State":
+        header_data = FrozenSubscriptionStateHeader_create(<pjsip_sub_state_hdr *> header)
+    elif header_name == "Refer-To":
+        header_data = FrozenReferToHeader_create(<pjsip_generic_string_hdr *> header)
+    elif header_name == "Subject":
+        header_data = FrozenSubjectHeader_create(<pjsip_generic_string_hdr *> header)
+    elif header_name == "Replaces" and not skip_replaces:
+        header_data = FrozenReplacesHeader_create(<pjsip_replaces_hdr *> header)
+    # skip the following headers:
+    elif header_name not in ("Authorization", "Proxy-Authenticate", "Proxy-Authorization", "WWW-Authenticate"):
+        header_value = _pj_str_to_str((<pjsip_generic_string_hdr *> header).hvalue)
+        header_data = FrozenHeader(header_name, header_value)
+    return header_data
+
+cdef dict _pjsip_msg_headers_to_dict(pjsip_msg *msg, int skip_replaces):
+    cdef pjsip_hdr *header
+    cdef bint multi_header
+    cdef dict headers = {}
     header = <pjsip_hdr *> (<pj_list *> &msg.hdr).next
 
-    try:
-        skip_replaces = info_dict['skip_replaces']
-    except KeyError:
-        skip_replaces = False
-
     while header != &msg.hdr:
         header_name = _pj_str_to_str(header.name)
-        header_data = None
-        multi_header = False
-        if header_name in ("Accept", "Allow", "Require", "Supported", "Unsupported", "Allow-Events"):
-            array_header = <pjsip_generic_array_hdr *> header
-            header_data = []
-            if array_header.count < 128:
-                for i from 0 <= i < array_header.count:
-                    header_data.append(_pj_str_to_bytes(array_header.values[i]))
-        elif header_name == "Contact":
-            multi_header = True
-            header_data = FrozenContactHeader_create(<pjsip_contact_hdr *> header)
-        elif header_name == "Content-Length":
-            header_data = (<pjsip_clen_hdr *> header).len
-        elif header_name == "Content-Type":
-            header_data = FrozenContentTypeHeader_create(<pjsip_ctype_hdr *> header)
-        elif header_name == "CSeq":
-            cseq_header = <pjsip_cseq_hdr *> header
-            hvalue = _pj_str_to_str(cseq_header.method.name)
-            header_data = (cseq_header.cseq, hvalue)
-        elif header_name in ("Expires", "Max-Forwards", "Min-Expires"):
-            header_data = (<pjsip_generic_int_hdr *> header).ivalue
-        elif header_name == "From":
-            header_data = FrozenFromHeader_create(<pjsip_fromto_hdr *> header)
-        elif header_name == "To":
-            header_data = FrozenToHeader_create(<pjsip_fromto_hdr *> header)
-        elif header_name == "Route":
-            multi_header = True
-            header_data = FrozenRouteHeader_create(<pjsip_routing_hdr *> header)
-        elif header_name == "Reason":
-            value = _pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue)
-            protocol, sep, params_str = value.partition(';')
-            params = frozendict([(name, value or None) for name, sep, value in [param.partition('=') for param in params_str.split(';')]])
-            header_data = FrozenReasonHeader(protocol, params)
-        elif header_name == "Record-Route":
-            multi_header = True
-            header_data = FrozenRecordRouteHeader_create(<pjsip_routing_hdr *> header)
-        elif header_name == "Retry-After":
-            header_data = FrozenRetryAfterHeader_create(<pjsip_retry_after_hdr *> header)
-        elif header_name == "Via":
-            multi_header = True
-            header_data = FrozenViaHeader_create(<pjsip_via_hdr *> header)
-        elif header_name == "Warning":
-            match = _re_warning_hdr.match(_pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue))
-            if match is not None:
-                warning_params = match.groupdict()
-                warning_params['code'] = int(warning_params['code'])
-                header_data = FrozenWarningHeader(**warning_params)
-        elif header_name == "Event":
-            header_data = FrozenEventHeader_create(<pjsip_event_hdr *> header)
-        elif header_name == "Subscription-State":
-            header_data = FrozenSubscriptionStateHeader_create(<pjsip_sub_state_hdr *> header)
-        elif header_name == "Refer-To":
-            header_data = FrozenReferToHeader_create(<pjsip_generic_string_hdr *> header)
-        elif header_name == "Subject":
-            header_data = FrozenSubjectHeader_create(<pjsip_generic_string_hdr *> header)
-        elif header_name == "Replaces" and not skip_replaces:
-            header_data = FrozenReplacesHeader_create(<pjsip_replaces_hdr *> header)
-        # skip the following headers:
-        elif header_name not in ("Authorization", "Proxy-Authenticate", "Proxy-Authorization", "WWW-Authenticate"):
-            header_value = _pj_str_to_str((<pjsip_generic_string_hdr *> header).hvalue)
-            header_data = FrozenHeader(header_name, header_value)
-
+        header_data = _pjsip_hdr_to_object(header, header_name, skip_replaces, &multi_header)
         if header_data is not None:
             if multi_header:
                 headers.setdefault(header_name, []).append(header_data)
@@ -322,7 +471,22 @@ cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
                 if header_name not in headers:
                     headers[header_name] = header_data
         header = <pjsip_hdr *> (<pj_list *> header).next
-    info_dict["headers"] = headers
+    return headers
+
+cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
+    info_dict["headers"] = _pjsip_msg_headers_to_dict(msg, info_dict.get('skip_replaces', False))
+    _pjsip_msg_line_to_dict(msg, info_dict)
+    return 0
+
+cdef int _pjsip_msg_to_lazy_dict(pjsip_msg *msg, dict info_dict) except -1:
+    info_dict["headers"] = SIPMessageHeaders_create(msg, info_dict.get('skip_replaces', False))
+    _pjsip_msg_line_to_dict(msg, info_dict)
+    return 0
+
+cdef int _pjsip_msg_line_to_dict(pjsip_msg *msg, dict info_dict) except -1:
+    cdef pjsip_msg_body *body
+    cdef char *buf
+    cdef int buf_len, status
     body = msg.body
 
     if body == NULL:
@@ -344,6 +508,55 @@ cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
         info_dict["reason"] = _pj_str_to_str(msg.line.status.reason)
     return 0
 
+cdef SIPMessageHeaders SIPMessageHeaders_create(pjsip_msg *msg, int skip_replaces):
+    cdef SIPMessageHeaders headers
+    cdef PJSIPUA ua = _get_ua()
+    cdef pj_pool_t *pool
+    headers = SIPMessageHeaders.__new__(SIPMessageHeaders)
+    headers._skip_replaces = skip_replaces
+    pool = _message_headers_pool_get(ua)
+    with nogil:
+        headers._msg = pjsip_msg_clone(pool, msg)
+    headers._pool = pool
+    _message_headers.add(headers)
+    return headers
+
+cdef pj_pool_t *_message_headers_pool_get(PJSIPUA ua) except NULL:
+    # The pools are only taken and given back with the GIL held and without calling into Python code in between,
+    # so the list of reused pools is never accessed by more than one thread at a time
+    global _message_headers_pool_count
+    if _message_headers_pool_count > 0:
+        _message_headers_pool_count -= 1
+        return _message_headers_pools[_message_headers_pool_count]
+    return ua.create_memory_pool(b"message_headers", 4096, 4096)
+
+cdef int _message_headers_pool_put(PJSIPUA ua, pj_pool_t *pool) except -1:
+    global _message_headers_pool_count
+    if pool == NULL:
+        return 0
+    ua.reset_memory_pool(pool)
+    if _message_headers_pool_count < 32:
+        _message_headers_pools[_message_headers_pool_count] = pool
+        _message_headers_pool_count += 1
+    else:
+        ua.release_memory_pool(pool)
+    return 0
+
+cdef int _release_message_headers_pools(PJSIPUA ua) except -1:
+    global _message_headers_pool_count
+    while _message_headers_pool_count > 0:
+        _message_headers_pool_count -= 1
+        ua.release_memory_pool(_message_headers_pools[_message_headers_pool_count])
+    return 0
+
+cdef int _materialize_message_headers() except -1:
+    # The cloned messages live in pools of the endpoint, so they need to be converted before it goes away
+    cdef SIPMessageHeaders headers
+    for headers in list(_message_headers):
+        if not headers._complete:
+            headers._materialize()
+    return 0
+
 cdef int _is_valid_ip(int af, object ip) except -1:
     cdef char buf[16]
     cdef pj_str_t src
@@ -454,5 +667,7 @@ def decode_device_name(device_name):
 
 cdef object _re_pj_status_str_def = re.compile("^.*\((.*)\)$")
 cdef object _re_warning_hdr = re.compile('(?P<code>[0-9]{3}) (?P<agent>.*?) "(?P<text>.*?)"')
+cdef object _message_headers = weakref.WeakSet()
+cdef pj_pool_t *_message_headers_pools[32]
+cdef int _message_headers_pool_count = 0
 sip_status_messages = SIPStatusMessages()
-
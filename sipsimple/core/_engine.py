@@ -10,9 +10,9 @@ import sys
 import traceback
 import atexit
 
-from application.notification import NotificationCenter, NotificationData
+from application.notification import Notification, NotificationCenter, NotificationData
 from application.python.types import Singleton
-from threading import Thread, RLock
+from threading import Event, Thread, RLock
 
 from sipsimple import log, __version__
 from sipsimple.core._core import PJSIPUA, PJ_VERSION, PJ_SVN_REVISION, SIPCoreError
@@ -30,7 +30,15 @@ class Engine(Thread, metaclass=Singleton):
                              "tls_timeout": 3000,
                              "user_agent":  "sipsimple-%s-pjsip-%s-r%s" % (__version__, PJ_VERSION, PJ_SVN_REVISION),
                              "log_level": 0,
+                             "event_queue_size": 8192,
+                             "min_poll_interval": 0.020,
+                             "max_poll_interval": 0.100,
+                             "worker_threads": 0,
                              "trace_sip": False,
+                             "trace_sip_file": None,
+                             "trace_sip_file_size": 16*1024*1024,
+                             "trace_sip_file_count": 4,
+                             "fast_path": True,
                              "detect_sip_loops": True,
                              "rtp_port_range": (50000, 50500),
                              "zrtp_cache": None,
@@ -46,7 +54,8 @@ class Engine(Thread, metaclass=Singleton):
                                         "refer":           ["message/sipfrag;version=2.0"],
                                         "xcap-diff":       ["application/xcap-diff+xml"]},
                              "incoming_events": set(),
-                             "incoming_requests": set()}
+                             "incoming_requests": set(),
+                             "batched_events": set()}
 
     def __init__(self):
         self.notification_center = NotificationCenter()
@@ -54,6 +63,7 @@ class Engine(Thread, metaclass=Singleton):
         self._thread_stopping = False
         self._lock = RLock()
         self._options = None
+        self._batched_events = frozenset()
         atexit.register(self.stop)
         super(Engine, self).__init__()
         self.daemon = True
@@ -65,18 +75,18 @@ class Engine(Thread, metaclass=Singleton):
 
     def __dir__(self):
         if hasattr(self, '_ua'):
-            ua_attributes = [attr for attr in dir(self._ua) if not attr.startswith('__') and attr != 'poll']
+            ua_attributes = [attr for attr in dir(self._ua) if not attr.startswith('__') and attr not in ('poll', 'handle_events')]
         else:
             ua_attributes = []
         return sorted(set(dir(self.__class__) + list(self.__dict__.keys()) + ua_attributes))
 
     def __getattr__(self, attr):
-        if attr not in ["_ua", "poll"] and hasattr(self, "_ua") and attr in dir(self._ua):
+        if attr not in ["_ua", "poll", "handle_events"] and hasattr(self, "_ua") and attr in dir(self._ua):
             return getattr(self._ua, attr)
         raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, attr))
 
     def __setattr__(self, attr, value):
-        if attr not in ["_ua", "poll"] and hasattr(self, "_ua") and attr in dir(self._ua):
+        if attr not in ["_ua", "poll", "handle_events"] and hasattr(self, "_ua") and attr in dir(self._ua):
             setattr(self._ua, attr, value)
             return
         object.__setattr__(self, attr, value)
@@ -109,8 +119,10 @@ class Engine(Thread, metaclass=Singleton):
         for k in list(init_options['events'].keys()):
             init_options['events'][k] = list(v.encode() if isinstance(v, str) else v for v in init_options['events'][k])
 
+        self._batched_events = frozenset(init_options['batched_events'])
+
         try:
-            self._ua = PJSIPUA(self._handle_event, **init_options)
+            self._ua = PJSIPUA(self._handle_events, **init_options)
         except Exception:
             log.exception('Exception occurred while starting the Engine')
             exc_type, exc_val, exc_tb = sys.exc_info()
@@ -120,6 +132,11 @@ class Engine(Thread, metaclass=Singleton):
             return
         else:
             self.notification_center.post_notification('SIPEngineDidStart', sender=self)
+        workers_stopping = Event()
+        workers = [Thread(target=self._run_worker, args=(workers_stopping, init_options['max_poll_interval']), name='SIPEngineWorker-%d' % index, daemon=True)
+                   for index in range(init_options['worker_threads'])]
+        for worker in workers:
+            worker.start()
         failed = False
         while not self._thread_stopping:
             try:
@@ -133,15 +150,40 @@ class Engine(Thread, metaclass=Singleton):
             if failed:
                 self.notification_center.post_notification('SIPEngineDidFail', sender=self)
                 break
+        workers_stopping.set()
+        for worker in workers:
+            worker.join()
         if not failed:
             self.notification_center.post_notification('SIPEngineWillEnd', sender=self)
         self._ua.dealloc()
         del self._ua
         self.notification_center.post_notification('SIPEngineDidEnd', sender=self)
 
-    def _handle_event(self, event_name, **kwargs):
-        sender = kwargs.pop("obj", None)
-        if sender is None:
-            sender = self
-        self.notification_center.post_notification(event_name, sender, NotificationData(**kwargs))
+    def _run_worker(self, stopping, timeout):
+        while not stopping.is_set():
+            try:
+                self._ua.handle_events(timeout)
+            except Exception:
+                log.exception('Exception occurred while handling events in an Engine worker thread')
+                exc_type, exc_val, exc_tb = sys.exc_info()
+                self.notification_center.post_notification('SIPEngineGotException', sender=self, data=NotificationData(type=exc_type, value=exc_val, traceback="".join(traceback.format_exception(exc_type, exc_val, exc_tb))))
+                break
+
+    def _handle_events(self, events):
+        # Events listed in the batched_events start option are not posted individually, instead all of them which
+        # were collected during one poll iteration are delivered as a list of Notification objects in a single
+        # SIPEngineDidProcessEvents notification.
+        batched_events = self._batched_events
+        post_notification = self.notification_center.post_notification
+        batch = []
+        for event_name, kwargs in events:
+            sender = kwargs.pop("obj", None)
+            if sender is None:
+                sender = self
+            if event_name in batched_events:
+                batch.append(Notification(event_name, sender, NotificationData(**kwargs)))
+            else:
+                post_notification(event_name, sender, NotificationData(**kwargs))
+        if batch:
+            post_notification('SIPEngineDidProcessEvents', sender=self, data=NotificationData(notifications=batch))
 
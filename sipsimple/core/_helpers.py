@@ -1,10 +1,14 @@
 
 """Miscellaneous SIP related helpers"""
 
+import os
 import random
 import socket
 import string
+import struct
 
+from collections import namedtuple
+from datetime import datetime, timezone
 from application.python.types import MarkerType
 from application.system import host
 
@@ -12,7 +16,8 @@ from sipsimple.core._core import SIPURI
 from sipsimple.core._engine import Engine
 
 
-__all__ = ['Route', 'ContactURIFactory', 'NoGRUU', 'PublicGRUU', 'TemporaryGRUU', 'PublicGRUUIfAvailable', 'TemporaryGRUUIfAvailable']
+__all__ = ['Route', 'ContactURIFactory', 'NoGRUU', 'PublicGRUU', 'TemporaryGRUU', 'PublicGRUUIfAvailable', 'TemporaryGRUUIfAvailable',
+           'SIPTraceRecord', 'SIPTraceReader', 'SIPTraceFileError']
 
 
 class Route(object):
@@ -33,7 +38,10 @@ class Route(object):
         try:
             socket.inet_aton(address)
         except:
-            raise ValueError('illegal address: %s' % address)
+            try:
+                socket.inet_pton(socket.AF_INET6, address)
+            except:
+                raise ValueError('illegal address: %s' % address)
         self._address = address
 
     @property
@@ -130,3 +138,91 @@ class ContactURIFactory(object):
         return uri
 
 
+class SIPTraceFileError(Exception): pass
+
+
+SIPTraceRecord = namedtuple('SIPTraceRecord', ('timestamp', 'received', 'transport', 'source_ip', 'source_port', 'destination_ip', 'destination_port', 'data'))
+
+
+class SIPTraceReader(object):
+    """
+    Iterates over the packets written by the engine to the binary SIP trace
+    file configured with the trace_sip_file start option. The records hold
+    the same information as the SIPEngineSIPTrace notifications along with
+    the time the packet was sent or received. When include_rotated is True,
+    the rotated files are read first, oldest to newest.
+    """
+
+    magic = b'SIPTRACE'
+    version = 1
+
+    _file_header = struct.Struct('!8sH')
+    _record_length = struct.Struct('!I')
+    _record_header = struct.Struct('!IIB')
+    _port = struct.Struct('!H')
+
+    def __init__(self, filename, include_rotated=False):
+        self.filename = filename
+        self.include_rotated = include_rotated
+
+    def __repr__(self):
+        return '{0.__class__.__name__}({0.filename!r}, include_rotated={0.include_rotated!r})'.format(self)
+
+    def __iter__(self):
+        for filename in self.filenames:
+            yield from self._read_file(filename)
+
+    @property
+    def filenames(self):
+        filenames = [self.filename]
+        if self.include_rotated:
+            index = 1
+            while os.path.exists('%s.%d' % (self.filename, index)):
+                filenames.insert(0, '%s.%d' % (self.filename, index))
+                index += 1
+        return filenames
+
+    def _read_file(self, filename):
+        with open(filename, 'rb') as f:
+            header = f.read(self._file_header.size)
+            if len(header) < self._file_header.size:
+                raise SIPTraceFileError('%s: not a SIP trace file' % filename)
+            magic, version = self._file_header.unpack(header)
+            if magic != self.magic:
+                raise SIPTraceFileError('%s: not a SIP trace file' % filename)
+            if version != self.version:
+                raise SIPTraceFileError('%s: unsupported SIP trace file version %d' % (filename, version))
+            while True:
+                length = f.read(self._record_length.size)
+                if len(length) < self._record_length.size:
+                    break
+                length, = self._record_length.unpack(length)
+                record = f.read(length)
+                if len(record) < length:
+                    # the last record was not completely written out yet
+                    break
+                yield self._parse_record(filename, record)
+
+    def _parse_record(self, filename, record):
+        try:
+            seconds, microseconds, flags = self._record_header.unpack_from(record)
+            offset = self._record_header.size
+            transport, offset = self._parse_string(record, offset)
+            source_ip, offset = self._parse_string(record, offset)
+            source_port, = self._port.unpack_from(record, offset)
+            offset += self._port.size
+            destination_ip, offset = self._parse_string(record, offset)
+            destination_port, = self._port.unpack_from(record, offset)
+            offset += self._port.size
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise SIPTraceFileError('%s: corrupted record' % filename)
+        timestamp = datetime.fromtimestamp(seconds + microseconds / 1000000, timezone.utc)
+        return SIPTraceRecord(timestamp, bool(flags & 1), transport, source_ip, source_port, destination_ip, destination_port, record[offset:])
+
+    @staticmethod
+    def _parse_string(record, offset):
+        length = record[offset]
+        offset += 1
+        if offset + length > len(record):
+            raise struct.error('string exceeds record')
+        return record[offset:offset+length].decode(), offset + length
@@ -9,6 +9,7 @@ resources prior the starting of a SIP session.
 
 
 import re
+from collections import OrderedDict
 from itertools import chain
 from time import time
 from urllib.parse import urlparse
@@ -86,28 +87,103 @@ class DNSLookupError(Exception):
     """
 
 
+class NegativeAnswer(object):
+    """
+    Internal object used to cache a NXDOMAIN or NODATA answer in the DNSCache
+    for the negative caching TTL taken from the SOA record in the authority
+    section of the response (RFC 2308).
+    """
+    def __init__(self, error, expiration):
+        self.error = error
+        self.expiration = expiration
+
+    @classmethod
+    def from_exception(cls, error):
+        kwargs = getattr(error, 'kwargs', None) or {}
+        if isinstance(error, dns.resolver.NXDOMAIN):
+            responses = list((kwargs.get('responses') or {}).values())
+        else:
+            responses = [kwargs.get('response')]
+        ttls = [min(rrset.ttl, rrset[0].minimum) for response in responses if response is not None for rrset in response.authority if rrset.rdtype == rdatatype.SOA]
+        if not ttls:
+            # Without a SOA record the answer must not be cached
+            return None
+        return cls(error, time() + min(ttls))
+
+
 class DNSCache(object):
     """
-    A simple DNS cache which uses twisted's timers to invalidate its expired
-    data.
+    A size bounded DNS cache which evicts the least recently used answers
+    once it is full. Answers are kept for their TTL, but at most for an hour.
+    Expired answers are dropped when they are looked up and by a periodic
+    sweep which only runs while the cache holds any data.
+    Besides the answers cached by the resolver, it also holds the negative
+    answers, keyed by ('negative', name, rdtype).
     """
-    def __init__(self):
-        self.data = {}
+
+    def __init__(self, max_size=10000, sweep_interval=60):
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._sweep_timer = None
+
+    @property
+    def statistics(self):
+        return dict(size=len(self.data), hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations)
 
     def get(self, key):
-        return self.data.get(key, None)
+        value = self.peek(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, key):
+        """
+        Like get, but the lookup doesn't count towards the hits and misses.
+        """
+        try:
+            value, expiration = self.data[key]
+        except KeyError:
+            return None
+        if expiration <= time():
+            del self.data[key]
+            self.expirations += 1
+            return None
+        self.data.move_to_end(key)
+        return value
 
     def put(self, key, value):
-        expiration = value.expiration-time()
-        if expiration > 0:
-            self.data[key] = value
-            reactor.callLater(limit(expiration, max=3600), self.data.pop, key, None)
+        now = time()
+        if value.expiration - now > 0:
+            self.data[key] = value, now + limit(value.expiration - now, max=3600)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+            if self._sweep_timer is None:
+                self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep)
 
     def flush(self, key=None):
         if key is not None:
             self.data.pop(key, None)
         else:
-            self.data = {}
+            self.data = OrderedDict()
+
+    def _sweep(self):
+        self._sweep_timer = None
+        now = time()
+        expired_keys = [key for key, (value, expiration) in self.data.items() if expiration <= now]
+        for key in expired_keys:
+            del self.data[key]
+        self.expirations += len(expired_keys)
+        if self.data:
+            self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep)
 
 
 class InternalResolver(dns.resolver.Resolver):
@@ -133,13 +209,28 @@ class DNSResolver(dns.resolver.Resolver):
         self.search = dns_manager.search
         self.domain = dns_manager.domain
         self.nameservers = dns_manager.nameservers
-
-    def query(self, *args, **kw):
-        start_time = time()
+        self._start_time = None
+        self._total_lifetime = None
+
+    def query(self, qname, rdtype=rdatatype.A, *args, **kw):
+        # Queries may run concurrently, so the lifetime is accounted against the wall clock time since the first query
+        if self._start_time is None:
+            self._start_time = time()
+            self._total_lifetime = self.lifetime
+        self.lifetime = max(self._total_lifetime - (time() - self._start_time), 0)
+        negative_key = ('negative', str(qname).lower().rstrip('.'), rdtype)
+        if self.cache is not None:
+            negative_answer = self.cache.peek(negative_key)
+            if negative_answer is not None:
+                raise negative_answer.error.with_traceback(None)
         try:
-            return dns.resolver.Resolver.query(self, *args, **kw)
-        finally:
-            self.lifetime -= min(self.lifetime, time()-start_time)
+            return dns.resolver.Resolver.query(self, qname, rdtype, *args, **kw)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+            if self.cache is not None:
+                negative_answer = NegativeAnswer.from_exception(e)
+                if negative_answer is not None:
+                    self.cache.put(negative_key, negative_answer)
+            raise
 
 
 class SRVResult(object):
@@ -171,6 +262,13 @@ class DNSLookup(object):
 
     cache = DNSCache()
 
+    def __init__(self, ipv6=False):
+        """
+        When ipv6 is True, AAAA records are looked up along with the A records
+        and the IPv6 addresses are returned after the IPv4 ones.
+        """
+        self.ipv6 = ipv6
+
     @run_in_waitable_green_thread
     @post_dns_lookup_notifications
     def lookup_service(self, uri, service, timeout=3.0, lifetime=15.0):
@@ -323,22 +421,20 @@ class DNSLookup(object):
                         NotificationCenter().post_notification('DNSLookupDidFail', sender=self, data=NotificationData(error=reason, originator='local'))
                         raise DNSLookupError(reason)
                     supported_transports = ['tls']
-                # First try NAPTR lookup
+                # First try NAPTR lookup. The SRV lookups it would fall back to are done at the same time, so that
+                # a missing NAPTR record does not cost another round of queries.
                 naptr_services = [service for service, transport in list(naptr_service_transport_map.items()) if transport in supported_transports]
-                try:
-                    pointers = self._lookup_naptr_record(resolver, uri.host.decode(), naptr_services, log_context=log_context)
-                except dns.resolver.Timeout:
-                    pointers = []
+                record_names = ['%s.%s' % (transport_service_map[transport], uri.host.decode()) for transport in supported_transports]
+                calls = [(self._ignore_timeout, self._lookup_naptr_record, resolver, uri.host.decode(), naptr_services, log_context)]
+                calls.extend((self._ignore_timeout, self._lookup_srv_records, resolver, [record_name], [], log_context) for record_name in record_names)
+                pointers, *transport_services = self._run_concurrently(calls)
                 if pointers:
                     return [Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service], tls_name=tls_name or uri.host) for result in pointers]
                 else:
                     # If that fails, try SRV lookup
                     routes = []
-                    for transport in supported_transports:
-                        record_name = '%s.%s' % (transport_service_map[transport], uri.host.decode())
-                        try:
-                            services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
-                        except dns.resolver.Timeout:
+                    for transport, record_name, services in zip(supported_transports, record_names, transport_services):
+                        if services is None:
                             continue
                         if services[record_name]:
                             routes.extend(Route(address=result.address, port=result.port, transport=transport, tls_name=tls_name or uri.host) for result in services[record_name])
@@ -405,53 +501,100 @@ class DNSLookup(object):
 
 
     def _lookup_a_records(self, resolver, hostnames, additional_records=[], log_context={}):
-        notification_center = NotificationCenter()
-        additional_addresses = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.A)
+        address_types = (rdatatype.A, rdatatype.AAAA) if self.ipv6 else (rdatatype.A,)
+        additional_addresses = dict(((rset.name.to_text(), rset.rdtype), rset) for rset in additional_records if rset.rdtype in address_types)
+        queries = list(dict.fromkeys((hostname, rdtype) for hostname in hostnames for rdtype in address_types if (hostname, rdtype) not in additional_addresses))
+        results = dict(zip(queries, self._run_concurrently([(self._query_addresses, resolver, hostname, rdtype, log_context) for hostname, rdtype in queries])))
         addresses = {}
         for hostname in hostnames:
-            if hostname in additional_addresses:
-                addresses[hostname] = [r.address for r in additional_addresses[hostname]]
-            else:
-                try:
-                    answer = resolver.query(hostname, rdatatype.A)
-                except dns.resolver.Timeout as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    addresses[hostname] = []
+            addresses[hostname] = []
+            for rdtype in address_types:
+                if (hostname, rdtype) in additional_addresses:
+                    addresses[hostname].extend(r.address for r in additional_addresses[hostname, rdtype])
                 else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses[hostname] = [r.address for r in answer.rrset]
+                    addresses[hostname].extend(results[hostname, rdtype])
         return addresses
 
+    def _query_addresses(self, resolver, hostname, rdtype, log_context={}):
+        notification_center = NotificationCenter()
+        query_type = rdatatype.to_text(rdtype)
+        try:
+            answer = resolver.query(hostname, rdtype)
+        except dns.resolver.Timeout as e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type=query_type, query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            raise
+        except exception.DNSException as e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type=query_type, query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            return []
+        else:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type=query_type, query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+            return [r.address for r in answer.rrset]
 
     def _lookup_srv_records(self, resolver, srv_names, additional_records=[], log_context={}):
-        notification_center = NotificationCenter()
         additional_services = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.SRV)
-        services = {}
+        queried_names = [srv_name for srv_name in srv_names if srv_name not in additional_services]
+        answers = dict(zip(queried_names, self._run_concurrently([(self._query_srv_record, resolver, srv_name, log_context) for srv_name in queried_names])))
+        # The targets of all the SRV records are resolved together
+        records = {}
+        additional_records = list(additional_records)
         for srv_name in srv_names:
-            services[srv_name] = []
             if srv_name in additional_services:
-                addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in additional_services[srv_name]], additional_records)
-                for record in additional_services[srv_name]:
-                    services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+                records[srv_name] = list(additional_services[srv_name])
+            elif answers[srv_name] is not None:
+                records[srv_name] = list(answers[srv_name].rrset)
+                additional_records.extend(answers[srv_name].response.additional)
             else:
-                try:
-                    answer = resolver.query(srv_name, rdatatype.SRV)
-                except dns.resolver.Timeout as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException as e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in answer.rrset], answer.response.additional, log_context)
-                    for record in answer.rrset:
-                        services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+                records[srv_name] = []
+        targets = list(dict.fromkeys(record.target.to_text() for srv_records in records.values() for record in srv_records))
+        addresses = self._lookup_a_records(resolver, targets, additional_records, log_context)
+        services = {}
+        for srv_name in srv_names:
+            services[srv_name] = []
+            for record in records[srv_name]:
+                services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
             services[srv_name].sort(key=lambda result: (result.priority, -result.weight))
         return services
 
+    def _query_srv_record(self, resolver, srv_name, log_context={}):
+        notification_center = NotificationCenter()
+        try:
+            answer = resolver.query(srv_name, rdatatype.SRV)
+        except dns.resolver.Timeout as e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            raise
+        except exception.DNSException as e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            return None
+        else:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+            return answer
+
+    @staticmethod
+    def _ignore_timeout(function, *args):
+        try:
+            return function(*args)
+        except dns.resolver.Timeout:
+            return None
+
+    @staticmethod
+    def _run_concurrently(calls):
+        """
+        Runs each (function, *args) call in its own green thread and returns
+        their results in order. If any of them raises an exception, the others
+        are killed and the exception is propagated.
+        """
+        if not calls:
+            return []
+        elif len(calls) == 1:
+            function, *args = calls[0]
+            return [function(*args)]
+        procs = [proc.spawn(*call) for call in calls]
+        try:
+            return proc.waitall(procs)
+        except:
+            for p in procs:
+                p.kill()
+            raise
 
     def _lookup_naptr_record(self, resolver, domain, services, log_context={}):
         notification_center = NotificationCenter()
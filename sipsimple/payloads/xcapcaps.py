@@ -86,7 +86,7 @@ class Extensions(XMLListElement):
 
 
 class Namespace(XMLStringElement):
-    _xml_tag = 'extension'
+    _xml_tag = 'namespace'
     _xml_namespace = namespace
     _xml_document = XCAPCapabilitiesDocument
 
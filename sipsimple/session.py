@@ -989,27 +989,32 @@ class Session(object):
         self._lock = RLock()
 
     def init_incoming(self, invitation, data):
+        from sipsimple.streams.rtp import RTPStream, stream_creation_context
         notification_center = NotificationCenter()
         remote_sdp = invitation.sdp.proposed_remote
         self.proposed_streams = []
         if remote_sdp:
-            for index, media_stream in enumerate(remote_sdp.media):
-                if media_stream.port != 0:
-                    for stream_type in MediaStreamRegistry:
-                        try:
-                            stream = stream_type.new_from_sdp(self, remote_sdp, index)
-                        except UnknownStreamError as e:
-                            continue
-                        except InvalidStreamError as e:
-                            log.error("Invalid stream: {}".format(e))
-                            break
-                        except Exception as e:
-                            log.exception("Exception occurred while setting up stream from SDP: {}".format(e))
-                            break
-                        else:
-                            stream.index = index
-                            self.proposed_streams.append(stream)
-                            break
+            stream_creation_context.mixer = RTPStream.mixer_factory(invitation.request_uri) if RTPStream.mixer_factory is not None else None
+            try:
+                for index, media_stream in enumerate(remote_sdp.media):
+                    if media_stream.port != 0:
+                        for stream_type in MediaStreamRegistry:
+                            try:
+                                stream = stream_type.new_from_sdp(self, remote_sdp, index)
+                            except UnknownStreamError as e:
+                                continue
+                            except InvalidStreamError as e:
+                                log.error("Invalid stream: {}".format(e))
+                                break
+                            except Exception as e:
+                                log.exception("Exception occurred while setting up stream from SDP: {}".format(e))
+                                break
+                            else:
+                                stream.index = index
+                                self.proposed_streams.append(stream)
+                                break
+            finally:
+                stream_creation_context.mixer = None
         self.direction = 'incoming'
         self.state = 'incoming'
         self.transport = invitation.transport.lower()
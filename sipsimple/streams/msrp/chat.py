@@ -9,6 +9,7 @@ import codecs
 import os
 import random
 import re
+import time
 from email import charset as _charset
 Charset = _charset.Charset
 
@@ -17,10 +18,10 @@ from application.notification import IObserver, NotificationCenter, Notification
 from application.python import Null
 from application.python.types import Singleton
 from application.system import openfile
-from collections import defaultdict
+from collections import OrderedDict, deque
 from email.message import Message as EmailMessage
 from email.parser import Parser as EmailParser
-from eventlib.coros import queue
+from eventlib.coros import event, queue
 from eventlib.proc import spawn, ProcExit
 from functools import partial
 from msrplib.protocol import FailureReportHeader, SuccessReportHeader, UseNicknameHeader
@@ -331,6 +332,80 @@ class OTREncryption(object):
         notification.center.post_notification('ChatStreamSMPVerificationDidEnd', sender=self.stream, data=notification.data)
 
 
+class ChunkReassemblyBuffer(object):
+    """
+    Reassembles the chunks of the incoming messages that are split over
+    multiple SEND requests. When the total size of a message is known, its
+    chunks are copied straight into a bytearray of that size. Messages larger
+    than max_message_size, or that would take the buffer beyond max_size, are
+    refused and messages that did not receive a chunk in max_age seconds are
+    discarded.
+    """
+
+    def __init__(self, max_message_size, max_size, max_age):
+        self.max_message_size = max_message_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.size = 0
+        self.messages = OrderedDict()  # message_id -> [data, length, last_update], ordered by last_update
+
+    def __contains__(self, message_id):
+        return message_id in self.messages
+
+    def add(self, chunk):
+        """Add a chunk to its message and return whether the message could be accepted"""
+        now = time.time()
+        self._discard_stale(now)
+        start = chunk.byte_range.start - 1
+        end = start + len(chunk.data)
+        try:
+            entry = self.messages[chunk.message_id]
+        except KeyError:
+            total = chunk.byte_range.total
+            if start > 0 or total is not None and (total > self.max_message_size or self.size + total > self.max_size):
+                return False  # the beginning of the message was refused or discarded, or the message does not fit
+            entry = [bytearray(total or 0), 0, now]
+            self.messages[chunk.message_id] = entry
+            self.size += len(entry[0])
+        data = entry[0]
+        if end > self.max_message_size or self.size + max(end - len(data), 0) > self.max_size:
+            self.discard(chunk.message_id)
+            return False
+        if end > len(data):
+            self.size += end - len(data)
+            data.extend(bytes(end - len(data)))
+        data[start:end] = chunk.data
+        entry[1] = max(entry[1], end)
+        entry[2] = now
+        self.messages.move_to_end(chunk.message_id)
+        return True
+
+    def complete(self, chunk):
+        """Add the last chunk of a message and return the whole message, or None if it could not be accepted"""
+        if not self.add(chunk):
+            return None
+        data, length, last_update = self.messages.pop(chunk.message_id)
+        self.size -= len(data)
+        del data[length:]
+        return data
+
+    def discard(self, message_id):
+        entry = self.messages.pop(message_id, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def clear(self):
+        self.messages.clear()
+        self.size = 0
+
+    def _discard_stale(self, now):
+        while self.messages:
+            message_id, entry = next(iter(self.messages.items()))
+            if now - entry[2] < self.max_age:
+                break
+            self.discard(message_id)
+
+
 class ChatStreamError(MSRPStreamError): pass
 
 
@@ -346,11 +421,23 @@ class ChatStream(MSRPStreamBase):
     prefer_cpim = True
     start_otr = True
 
+    send_window = 32                        # maximum number of messages waiting for a transaction response (None means unlimited)
+    send_queue_limit = None                 # maximum number of messages waiting to be sent before send_message refuses new ones
+    coalesce_composing_indications = True   # only send the last of the queued composing indications for the same recipients
+
+    max_incoming_message_size = 16*1024*1024  # maximum size of an incoming message that is split over multiple chunks
+    max_incoming_buffer_size = 64*1024*1024   # maximum amount of memory used for reassembling the incoming messages
+    incoming_message_timeout = 120            # how long to wait for the next chunk of an incoming message before discarding it
+
     def __init__(self):
         super(ChatStream, self).__init__(direction='sendrecv')
         self.message_queue = queue()
         self.sent_messages = set()
-        self.incoming_queue = defaultdict(list)
+        self._send_batch = deque()
+        self._pending_responses = {}
+        self._send_window_event = None
+        self._send_statistics = dict(sent=0, coalesced=0, responses=0, total_latency=0.0, max_latency=0.0)
+        self.incoming_queue = ChunkReassemblyBuffer(self.max_incoming_message_size, self.max_incoming_buffer_size, self.incoming_message_timeout)
         self.message_queue_thread = None
         self.encryption = OTREncryption(self)
 
@@ -409,6 +496,21 @@ class ChatStream(MSRPStreamBase):
             pass
         return []
 
+    @property
+    def send_queue_size(self):
+        return len(self.message_queue) + len(self._send_batch)
+
+    @property
+    def send_statistics(self):
+        statistics = self._send_statistics
+        responses = statistics['responses']
+        return dict(queued=self.send_queue_size,
+                    outstanding=len(self._pending_responses),
+                    sent=statistics['sent'],
+                    coalesced=statistics['coalesced'],
+                    average_latency=statistics['total_latency'] / responses if responses else 0.0,
+                    max_latency=statistics['max_latency'])
+
     def _NH_MediaStreamDidStart(self, notification):
         self.message_queue_thread = spawn(self._message_queue_handler)
 
@@ -421,6 +523,7 @@ class ChatStream(MSRPStreamBase):
                 notification.center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
 
     def _NH_MediaStreamDidEnd(self, notification):
+        self.incoming_queue.clear()
         if self.message_queue_thread is not None:
             self.message_queue_thread.kill()
         else:
@@ -451,16 +554,25 @@ class ChatStream(MSRPStreamBase):
             self.msrp_session.send_report(chunk, 413, 'Unwanted Message')
             return
         if chunk.contflag == '#':
-            self.incoming_queue.pop(chunk.message_id, None)
+            self.incoming_queue.discard(chunk.message_id)
             self.msrp_session.send_report(chunk, 200, 'OK')
             return
         elif chunk.contflag == '+':
-            self.incoming_queue[chunk.message_id].append(chunk.data)
-            self.msrp_session.send_report(chunk, 200, 'OK')
+            if self.incoming_queue.add(chunk):
+                self.msrp_session.send_report(chunk, 200, 'OK')
+            else:
+                self.msrp_session.send_report(chunk, 413, 'Message Too Large')
             return
+        elif chunk.message_id in self.incoming_queue or chunk.byte_range.start != 1:
+            # the last chunk of a message whose beginning was refused or discarded is refused as well
+            data = self.incoming_queue.complete(chunk)
+            if data is None:
+                self.msrp_session.send_report(chunk, 413, 'Message Too Large')
+                return
+            data = data.decode()
         else:
-            data = ''.join(self.incoming_queue.pop(chunk.message_id, [])) + chunk.data.decode()
-            
+            data = chunk.data.decode()
+
         if content_type == 'message/cpim':
             try:
                 payload = CPIMPayload.decode(data)
@@ -532,6 +644,16 @@ class ChatStream(MSRPStreamBase):
             notification_center.post_notification('ChatStreamGotMessage', sender=self, data=data)
 
     def _on_transaction_response(self, message_id, response):
+        send_time = self._pending_responses.pop(message_id, None)
+        if send_time is not None:
+            latency = time.time() - send_time
+            statistics = self._send_statistics
+            statistics['responses'] += 1
+            statistics['total_latency'] += latency
+            statistics['max_latency'] = max(statistics['max_latency'], latency)
+            if self._send_window_event is not None:
+                window_event, self._send_window_event = self._send_window_event, None
+                window_event.send()
         if message_id in self.sent_messages and response.code != 200:
             self.sent_messages.remove(message_id)
             data = NotificationData(message_id=message_id, message=response, code=response.code, reason=response.comment)
@@ -544,11 +666,36 @@ class ChatStream(MSRPStreamBase):
         else:
             notification_center.post_notification('ChatStreamDidNotSetNickname', sender=self, data=NotificationData(message_id=message_id, message=response, code=response.code, reason=response.comment))
 
+    def _wait_for_send_window(self):
+        while self.send_window is not None and len(self._pending_responses) >= self.send_window:
+            self._send_window_event = event()
+            self._send_window_event.wait()
+
+    def _fill_send_batch(self):
+        # take all the messages that are already queued in one go, so that superseded composing indications can be dropped
+        self._send_batch.append(self.message_queue.wait())
+        while self.message_queue:
+            self._send_batch.append(self.message_queue.wait())
+        if self.coalesce_composing_indications and len(self._send_batch) > 1:
+            batch = deque()
+            seen_recipients = set()
+            for message in reversed(self._send_batch):
+                if message.content_type == IsComposingDocument.content_type and not message.notify_progress:
+                    recipients = tuple(str(recipient) for recipient in message.recipients)
+                    if recipients in seen_recipients:
+                        self._send_statistics['coalesced'] += 1
+                        continue
+                    seen_recipients.add(recipients)
+                batch.appendleft(message)
+            self._send_batch = batch
+
     def _message_queue_handler(self):
         notification_center = NotificationCenter()
         try:
             while True:
-                message = self.message_queue.wait()
+                if not self._send_batch:
+                    self._fill_send_batch()
+                message = self._send_batch.popleft()
                 if self.msrp_session is None:
                     if message.notify_progress:
                         data = NotificationData(message_id=message.id, message=None, code=0, reason='Stream ended')
@@ -608,6 +755,8 @@ class ChatStream(MSRPStreamBase):
                 chunk.add_header(SuccessReportHeader(report))
 
                 try:
+                    if notify_progress:
+                        self._wait_for_send_window()
                     self.msrp_session.send_chunk(chunk, response_cb=partial(self._on_transaction_response, message_id))
                 except Exception as e:
                     if notify_progress:
@@ -619,11 +768,20 @@ class ChatStream(MSRPStreamBase):
                         notification_center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
                     raise
                 else:
+                    self._send_statistics['sent'] += 1
                     if notify_progress:
                         self.sent_messages.add(message_id)
+                        self._pending_responses[message_id] = time.time()
                         notification_center.post_notification('ChatStreamDidSendMessage', sender=self, data=NotificationData(message=chunk))
         finally:
             self.message_queue_thread = None
+            self._pending_responses.clear()
+            self._send_window_event = None
+            while self._send_batch:
+                message = self._send_batch.popleft()
+                if message.notify_progress:
+                    data = NotificationData(message_id=message.id, message=None, code=0, reason='Stream ended')
+                    notification_center.post_notification('ChatStreamDidNotDeliverMessage', sender=self, data=data)
             while self.sent_messages:
                 message_id = self.sent_messages.pop()
                 data = NotificationData(message_id=message_id, message=None, code=0, reason='Stream ended')
@@ -662,6 +820,8 @@ class ChatStream(MSRPStreamBase):
         self._enqueue_message(message)
 
     def send_message(self, content, content_type='text/plain', recipients=None, courtesy_recipients=None, subject=None, timestamp=None, required=None, additional_headers=None):
+        if self.send_queue_limit is not None and self.send_queue_size >= self.send_queue_limit:
+            raise ChatStreamError('The send queue is full')
         message = QueuedMessage(content, content_type, recipients=recipients, courtesy_recipients=courtesy_recipients, subject=subject, timestamp=timestamp, required=required, additional_headers=additional_headers, notify_progress=True)
         self._enqueue_message(message)
         return message.id
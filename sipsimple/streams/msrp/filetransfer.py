@@ -8,24 +8,29 @@ __all__ = ['FileTransferStream', 'FileSelector']
 import pickle as pickle
 import hashlib
 import mimetypes
+import mmap
 import os
 import random
 import re
+import sqlite3
 import time
 import uuid
 import traceback
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, deque
 from application.notification import NotificationCenter, NotificationData, IObserver
 from application.python.threadpool import ThreadPool, run_in_threadpool
 from application.python.types import MarkerType
 from application.system import FileExistsError, makedirs, openfile, unlink
+from eventlib import coros
+from functools import partial
 from itertools import count
 from msrplib.protocol import FailureReportHeader, SuccessReportHeader, ContentTypeHeader, IntegerHeaderType, MSRPNamedHeader, HeaderParsingError
 from msrplib.session import MSRPSession
 from msrplib.transport import make_response
 from queue import Queue
-from threading import Event, Lock
+from threading import Event, Lock, Thread
 from zope.interface import implementer
 
 from sipsimple.configuration.settings import SIPSimpleSettings
@@ -33,7 +38,7 @@ from sipsimple.core import SDPAttribute
 from sipsimple.storage import ISIPSimpleApplicationDataStorage
 from sipsimple.streams import InvalidStreamError, UnknownStreamError
 from sipsimple.streams.msrp import MSRPStreamBase
-from sipsimple.threading import run_in_twisted_thread, run_in_thread
+from sipsimple.threading import run_in_twisted_thread
 
 #sha1 is much faster on large file than python native implementation 
 from sipsimple.util import sha1
@@ -149,10 +154,10 @@ class UniqueFilenameGenerator(object):
 
 
 class FileMetadataEntry(object):
-    def __init__(self, hash, filename, partial_hash=None):
+    def __init__(self, hash, filename, partial_hash=None, mtime=None):
         self.hash = hash
         self.filename = filename
-        self.mtime = os.path.getmtime(self.filename)
+        self.mtime = mtime if mtime is not None else os.path.getmtime(self.filename)
         self.partial_hash = partial_hash
 
     @classmethod
@@ -160,15 +165,108 @@ class FileMetadataEntry(object):
         return cls(file_selector.hash.lower(), file_selector.name)
 
 
+class FileHashCache(object):
+    """
+    A size bounded cache of the hashes of the files that were sent, keyed by
+    (path, size, mtime), so that sending the same file again does not need
+    to read it all just to calculate its hash.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def key_for(filename, fd):
+        if filename is None:
+            return None
+        try:
+            stat = os.fstat(fd.fileno())
+        except (EnvironmentError, ValueError):
+            return None
+        return os.path.realpath(filename), stat.st_size, stat.st_mtime_ns
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return None
+            return self.data[key]
+
+    def put(self, key, file_hash):
+        if key is None:
+            return
+        with self.lock:
+            self.data[key] = file_hash
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+
+class ProgressThrottle(object):
+    """
+    Decides which progress updates get posted, so that observers are not
+    flooded with one notification per chunk. An update is posted when at
+    least interval seconds passed and the progress advanced by at least step
+    percent since the last posted one, ignoring the limits that are None.
+    The first update and the final one are always posted.
+    """
+
+    def __init__(self, interval=None, step=None):
+        self.interval = interval
+        self.step = step
+        self._last_time = None
+        self._last_percentage = None
+
+    def __call__(self, processed, total):
+        now = time.monotonic()
+        percentage = 100.0 * processed / total if total else 100.0
+        if self._last_time is not None and (not total or processed < total):
+            if self.interval is not None and now - self._last_time < self.interval:
+                return False
+            if self.step is not None and percentage - self._last_percentage < self.step:
+                return False
+        self._last_time = now
+        self._last_percentage = percentage
+        return True
+
+
 class FileTransfersMetadata(object):
+    """
+    Keeps the metadata of the incomplete incoming transfers, so that they can
+    be resumed, in an SQLite database in the application data directory (in
+    memory if there is none). Every change only touches the affected entry.
+    Expired entries are ignored when they are looked up and deleted using the
+    index on their expiration time, at most once every __cleanup_interval__
+    seconds. Used as a context manager, it holds a lock and returns itself,
+    supporting pop() and item assignment of FileMetadataEntry objects keyed
+    by their hash.
+    """
+
     __filename__ = 'transfer_metadata'
+    __database__ = 'transfer_metadata.db'
     __lifetime__ = 60*60*24*7
+    __cleanup_interval__ = 60*60
+
+    _schema = """CREATE TABLE IF NOT EXISTS transfers (
+                     hash TEXT PRIMARY KEY,
+                     filename TEXT NOT NULL,
+                     mtime REAL NOT NULL,
+                     partial_hash BLOB,
+                     expires REAL NOT NULL
+                 )"""
+    _index = "CREATE INDEX IF NOT EXISTS transfers_expires ON transfers (expires)"
 
     def __init__(self):
-        self.data = {}
         self.lock = Lock()
         self.loaded = False
         self.directory = None
+        self.connection = None
+        self.last_cleanup = 0
 
     def _load(self):
         if self.loaded:
@@ -177,37 +275,72 @@ class FileTransfersMetadata(object):
         if ISIPSimpleApplicationDataStorage.providedBy(SIPApplication.storage):
             self.directory = SIPApplication.storage.directory
         if self.directory is not None:
-            try:
-                with open(os.path.join(self.directory, self.__filename__), 'rb') as f:
-                    data = pickle.loads(f.read())
-            except Exception:
-                data = {}
-            now = time.time()
-            for hash, entry in list(data.items()):
-                try:
-                    mtime = os.path.getmtime(entry.filename)
-                except OSError:
-                    data.pop(hash)
-                else:
-                    if mtime != entry.mtime or now - mtime > self.__lifetime__:
-                        data.pop(hash)
-            self.data.update(data)
+            self.connection = sqlite3.connect(os.path.join(self.directory, self.__database__), check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        else:
+            self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        with self.connection:
+            self.connection.execute(self._schema)
+            self.connection.execute(self._index)
+        if self.directory is not None:
+            self._import_legacy_data()
         self.loaded = True
 
-    @run_in_thread('file-io')
-    def _save(self, data):
-        if self.directory is not None:
-            with open(os.path.join(self.directory, self.__filename__), 'wb') as f:
-                f.write(data)
+    def _import_legacy_data(self):
+        # entries from the pickled dictionary used by older versions are moved into the database once
+        filename = os.path.join(self.directory, self.__filename__)
+        try:
+            with open(filename, 'rb') as f:
+                data = pickle.loads(f.read())
+        except FileNotFoundError:
+            return
+        except Exception:
+            data = {}
+        with self.connection:
+            for entry in data.values():
+                self._store(entry, replace=False)
+        unlink(filename)
+
+    def _store(self, entry, replace=True):
+        partial_hash = pickle.dumps(entry.partial_hash) if entry.partial_hash is not None else None
+        self.connection.execute('INSERT OR %s INTO transfers (hash, filename, mtime, partial_hash, expires) VALUES (?, ?, ?, ?, ?)' % ('REPLACE' if replace else 'IGNORE'),
+                                (entry.hash, entry.filename, entry.mtime, partial_hash, entry.mtime + self.__lifetime__))
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self.last_cleanup >= self.__cleanup_interval__:
+            self.connection.execute('DELETE FROM transfers WHERE expires < ?', (now,))
+            self.last_cleanup = now
+
+    def pop(self, hash):
+        with self.connection:
+            row = self.connection.execute('SELECT filename, mtime, partial_hash, expires FROM transfers WHERE hash = ?', (hash,)).fetchone()
+            if row is None:
+                raise KeyError(hash)
+            self.connection.execute('DELETE FROM transfers WHERE hash = ?', (hash,))
+        filename, mtime, partial_hash, expires = row
+        if expires < time.time():
+            raise KeyError(hash)
+        return FileMetadataEntry(hash, filename, pickle.loads(partial_hash) if partial_hash is not None else None, mtime=mtime)
+
+    def __setitem__(self, hash, entry):
+        if hash != entry.hash:
+            raise KeyError('the key must be the hash of the entry')
+        with self.connection:
+            self._store(entry)
+            self._cleanup()
 
     def __enter__(self):
         self.lock.acquire()
-        self._load()
-        return self.data
+        try:
+            self._load()
+        except:
+            self.lock.release()
+            raise
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if None is exc_type is exc_val is exc_tb:
-            self._save(pickle.dumps(self.data))
         self.lock.release()
 
 
@@ -217,6 +350,10 @@ class FileTransferHandler(object, metaclass=ABCMeta):
     threadpool = ThreadPool(name='FileTransfers', min_threads=0, max_threads=100)
     threadpool.start()
 
+    # limits for the rate of the progress notifications, see ProgressThrottle
+    progress_interval = 0.5
+    progress_step = None
+
     def __init__(self):
         self.stream = None
         self.session = None
@@ -315,15 +452,204 @@ class OffsetHeader(MSRPNamedHeader):
 class EndTransfer(metaclass=MarkerType): pass
 
 
+class FileTransferBufferLimit(object):
+    """
+    Limits the memory held by the received chunks that were not yet written
+    and hashed, for all the incoming transfers together and per transfer.
+    The memory is reserved from the green thread which reads the chunks from
+    the MSRP connection. It blocks while a limit would be exceeded, so no
+    more data is read from the connection and the sender has to slow down.
+    A single chunk is always accepted when nothing is reserved, no matter
+    its size. All the accounting is done in the twisted thread.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.waiters = deque()
+
+    def reserve(self, handler, size):
+        while not handler.buffer_closed and (0 < self.size and self.size + size > self.max_size or 0 < handler.buffered_size and handler.buffered_size + size > handler.max_buffered_size):
+            waiter = coros.event()
+            self.waiters.append(waiter)
+            waiter.wait()
+        if not handler.buffer_closed:
+            self.size += size
+            handler.buffered_size += size
+
+    @run_in_twisted_thread
+    def release(self, handler, size=None):
+        if size is None:
+            size = handler.buffered_size
+            handler.buffer_closed = True
+        self.size -= size
+        handler.buffered_size -= size
+        waiters, self.waiters = self.waiters, deque()
+        for waiter in waiters:
+            waiter.send()
+
+
+class FileWriteBehindBuffer(object):
+    """
+    Writes the data of the received chunks to the file, collecting contiguous
+    chunks into writes of up to write_size bytes at their position in the
+    file, so chunks which arrive out of order end up in the right place. The
+    written data is hashed from a dedicated thread, so hashing overlaps with
+    the writing without holding a second thread of the file transfers pool
+    for the whole transfer. If the data was not written in order the file is
+    hashed again when the buffer is closed.
+    """
+
+    write_size = 1024*1024
+
+    def __init__(self, filename, offset, file_hash, release_callback):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        self.hash = file_hash
+        self.hash_position = offset
+        self.hash_valid = True
+        self.hash_queue = Queue()
+        self.hash_done = Event()
+        self.release_callback = release_callback
+        self.preallocated = False
+        self.ranges = [(0, offset)]
+        self.buffers = []
+        self.buffer_offset = None
+        self.buffer_size = 0
+        self.closed = False
+        self.hasher = Thread(target=self._run_hasher, name='FileTransferHasher', daemon=True)
+        self.hasher.start()
+
+    @property
+    def contiguous_size(self):
+        size = 0
+        for start, end in sorted(self.ranges):
+            if start > size:
+                break
+            size = max(size, end)
+        return size
+
+    def write(self, offset, data, total):
+        if not self.preallocated and total:
+            self.preallocated = True
+            try:
+                os.posix_fallocate(self.fd, 0, total)
+            except (AttributeError, EnvironmentError):
+                pass
+        if self.buffers and (offset != self.buffer_offset + self.buffer_size or self.buffer_size >= self.write_size):
+            self.flush()
+        if not self.buffers:
+            self.buffer_offset = offset
+        self.buffers.append(data)
+        self.buffer_size += len(data)
+
+    def flush(self):
+        if not self.buffers:
+            return
+        buffers, offset, size = self.buffers, self.buffer_offset, self.buffer_size
+        self.buffers = []
+        self.buffer_offset = None
+        self.buffer_size = 0
+        try:
+            self._write(buffers, offset)
+        except:
+            self.hash_queue.put((None, None, size))
+            raise
+        else:
+            self.hash_queue.put((offset, buffers, size))
+            self.ranges.append((offset, offset + size))
+
+    def close(self):
+        """
+        Writes out the buffered data and waits for all of it to be hashed.
+        Returns the hash and the size of the file, which only counts the data
+        up to the first gap. Anything after it, including the space which was
+        preallocated, is truncated, so that the transfer can be resumed.
+        The file is closed even if this fails and the buffer cannot be closed
+        again, as the file descriptor may be reused by then.
+        """
+        if self.closed:
+            raise ValueError('the buffer is already closed')
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.hash_queue.put(None)
+            self.hash_done.wait()
+            size = self.contiguous_size
+            fd, self.fd = self.fd, -1
+            try:
+                os.ftruncate(fd, size)
+                if not self.hash_valid:
+                    self.hash = self._calculate_hash(size)
+            finally:
+                os.close(fd)
+        return self.hash, size
+
+    def _write(self, buffers, offset):
+        if hasattr(os, 'pwritev'):
+            buffers = [memoryview(buffer) for buffer in buffers]
+            while buffers:
+                written = os.pwritev(self.fd, buffers, offset)
+                offset += written
+                while buffers and written >= len(buffers[0]):
+                    written -= len(buffers.pop(0))
+                if written:
+                    buffers[0] = buffers[0][written:]
+        else:
+            data = memoryview(b''.join(buffers))
+            while data:
+                if hasattr(os, 'pwrite'):
+                    written = os.pwrite(self.fd, data, offset)
+                else:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, data)
+                offset += written
+                data = data[written:]
+
+    def _calculate_hash(self, size):
+        file_hash = sha1()
+        buffer = memoryview(bytearray(self.write_size))
+        with open(self.filename, 'rb') as f:
+            while size > 0:
+                length = f.readinto(buffer[:min(size, len(buffer))])
+                if not length:
+                    break
+                file_hash.update(buffer[:length])
+                size -= length
+        return file_hash
+
+    def _run_hasher(self):
+        while True:
+            item = self.hash_queue.get()
+            if item is None:
+                break
+            offset, buffers, size = item
+            if self.hash_valid and offset == self.hash_position:
+                for buffer in buffers:
+                    self.hash.update(buffer)
+                self.hash_position += size
+            else:
+                self.hash_valid = False
+            self.release_callback(size)
+        self.hash_done.set()
+
+
 class IncomingFileTransferHandler(FileTransferHandler):
     metadata = FileTransfersMetadata()
 
+    # limits for the memory held by the chunks which were not yet written to disk
+    buffer_limit = FileTransferBufferLimit(max_size=128*1024*1024)
+    max_buffered_size = 16*1024*1024
+
     def __init__(self):
         super(IncomingFileTransferHandler, self).__init__()
         self.hash = sha1()
         self.queue = Queue()
         self.offset = 0
         self.received_chunks = 0
+        self.buffered_size = 0
+        self.buffer_closed = False
 
     @property
     def save_directory(self):
@@ -383,6 +709,7 @@ class IncomingFileTransferHandler(FileTransferHandler):
                 self.hash = sha1()
                 self.offset = 0
             self.received_chunks += 1
+            self.buffer_limit.reserve(self, chunk.size)
             self.queue.put(chunk)
         elif chunk.method == 'FILE_OFFSET':
             if self.received_chunks > 0:
@@ -399,28 +726,42 @@ class IncomingFileTransferHandler(FileTransferHandler):
         notification_center.post_notification('FileTransferHandlerDidStart', sender=self)
         file_selector = self.stream.file_selector
         fd = file_selector.fd
+        progress_throttle = ProgressThrottle(self.progress_interval, self.progress_step)
+        writer = None
 
-        while True:
-            chunk = self.queue.get()
-            if chunk is EndTransfer:
-                break
-            data = chunk.data
-            try:
-                fd.write(data)
-            except EnvironmentError as e:
-                fd.close()
-                notification_center.post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=str(e)))
-                notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason=str(e)))
-                return
-            self.hash.update(data)
-            self.offset += chunk.size
-            transferred_bytes = chunk.byte_range.start + chunk.size - 1
-            total_bytes = file_selector.size = chunk.byte_range.total
-            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
-            if transferred_bytes == total_bytes:
-                break
-
-        fd.close()
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is EndTransfer:
+                    break
+                if writer is None:
+                    # created with the first chunk, as receiving it from the start resets the file and the hash
+                    fd.flush()
+                    writer = FileWriteBehindBuffer(file_selector.name, self.offset, self.hash, partial(self.buffer_limit.release, self))
+                writer.write(chunk.byte_range.start - 1, chunk.data, chunk.byte_range.total)
+                if self.queue.empty():
+                    writer.flush()
+                transferred_bytes = chunk.byte_range.start + chunk.size - 1
+                total_bytes = file_selector.size = chunk.byte_range.total
+                if progress_throttle(transferred_bytes, total_bytes):
+                    notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
+                if transferred_bytes == total_bytes:
+                    break
+            if writer is not None:
+                self.hash, self.offset = writer.close()
+                writer = None
+        except EnvironmentError as e:
+            if writer is not None and not writer.closed:
+                try:
+                    self.hash, self.offset = writer.close()
+                except EnvironmentError:
+                    pass
+            notification_center.post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=str(e)))
+            notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason=str(e)))
+            return
+        finally:
+            fd.close()
+            self.buffer_limit.release(self)
 
         # Transfer is finished
 
@@ -456,6 +797,10 @@ class IncomingFileTransferHandler(FileTransferHandler):
 
 class OutgoingFileTransferHandler(FileTransferHandler):
     file_part_size = 64*1024
+    hash_part_size = 1024*1024
+    use_mmap = False  # only enable it for files which are not modified while sent, a file which is truncated while it is mapped crashes the process with SIGBUS
+
+    hash_cache = FileHashCache()
 
     def __init__(self):
         super(OutgoingFileTransferHandler, self).__init__()
@@ -464,6 +809,7 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         self.file_offset_event = Event()
         self.message_id = '%x' % random.getrandbits(64)
         self.offset = 0
+        self.progress_throttle = ProgressThrottle(self.progress_interval, self.progress_step)
 
     def initialize(self, stream, session):
         super(OutgoingFileTransferHandler, self).initialize(stream, session)
@@ -483,26 +829,40 @@ class OutgoingFileTransferHandler(FileTransferHandler):
     def _calculate_file_hash(self):
         file_hash = hashlib.sha1()
         processed = 0
+        progress_throttle = ProgressThrottle(self.progress_interval, self.progress_step)
 
         notification_center = NotificationCenter()
-        notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=0, total=self.stream.file_selector.size))
+        if progress_throttle(0, self.stream.file_selector.size):
+            notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=0, total=self.stream.file_selector.size))
 
         file_selector = self.stream.file_selector
         fd = file_selector.fd
+        cache_key = self.hash_cache.key_for(file_selector.name, fd)
+        cached_hash = self.hash_cache.get(cache_key)
+        if cached_hash is not None:
+            file_selector.hash = cached_hash
+            notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=file_selector.size, total=file_selector.size))
+            notification_center.post_notification('FileTransferHandlerDidInitialize', sender=self)
+            return
+
+        # read into the same buffer over and over, hashlib releases the GIL while hashing it
+        buffer = memoryview(bytearray(self.hash_part_size))
         while not self.stop_event.is_set():
             try:
-                content = fd.read(self.file_part_size)
+                length = fd.readinto(buffer)
             except EnvironmentError as e:
                 fd.close()
                 notification_center.post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason=str(e)))
                 return
-            if not content:
+            if not length:
                 file_selector.hash = file_hash
+                self.hash_cache.put(cache_key, file_selector.hash)
                 notification_center.post_notification('FileTransferHandlerDidInitialize', sender=self)
                 break
-            file_hash.update(content)
-            processed += len(content)
-            notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size))
+            file_hash.update(buffer[:length])
+            processed += length
+            if progress_throttle(processed, file_selector.size):
+                notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size))
         else:
             fd.close()
             notification_center.post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason='Interrupted transfer'))
@@ -525,18 +885,31 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         fd = self.stream.file_selector.fd
         fd.seek(self.offset)
 
+        # With use_mmap the chunks are sent as slices of the memory mapped file, so the data is not copied until it
+        # is written to the transport. The mapping is not closed explicitly, it goes away once the last chunk was sent.
+        try:
+            file_view = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)) if self.use_mmap else None
+        except (EnvironmentError, ValueError):
+            file_view = None
+        position = self.offset
+
         try:
             while not self.stop_event.is_set():
                 try:
-                    data = fd.read(self.file_part_size)
+                    if file_view is not None:
+                        data = file_view[position:position+self.file_part_size]
+                    else:
+                        data = fd.read(self.file_part_size)
                 except EnvironmentError as e:
                     failure_reason = str(e)
                     break
                 if not data:
                     finished = True
                     break
+                position += len(data)
                 self._send_chunk(data)
         finally:
+            file_view = None
             fd.close()
 
         if not finished:
@@ -605,7 +978,8 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         if chunk.status.code == 200:
             transferred_bytes = chunk.byte_range.end
             total_bytes = chunk.byte_range.total
-            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
+            if self.progress_throttle(transferred_bytes, total_bytes):
+                notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
             if transferred_bytes == total_bytes:
                 self.finished_event.set()
                 self.end()
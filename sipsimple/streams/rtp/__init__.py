@@ -365,6 +365,10 @@ class RTPStream(object, metaclass=RTPStreamType):
     # Consulted in Session.init_incoming when streams are created.
     mixer_factory = None
 
+    # Optional RTPStatisticsSampler. When set, the statistics of the stream are
+    # sampled periodically once it starts and kept in statistics_history.
+    statistics_sampler = None
+
     def __init__(self):
         self.notification_center = NotificationCenter()
         self.on_hold_by_local = False
@@ -379,6 +383,7 @@ class RTPStream(object, metaclass=RTPStreamType):
         self._ice_state = "NULL"
         self._lock = RLock()
         self._rtp_transport = None
+        self._statistics_history = None
 
         self._try_ice = False
         self._srtp_encryption = None
@@ -401,6 +406,53 @@ class RTPStream(object, metaclass=RTPStreamType):
     def statistics(self):
         return self._transport.statistics if self._transport else None
 
+    @property
+    def statistics_history(self):
+        return self._statistics_history
+
+    @property
+    def jitter(self):
+        """The last jitter of the received stream, in milliseconds"""
+        samples = self._get_statistics_samples()
+        return samples['rx_jitter'][-1] / 1000.0 if samples else None
+
+    @property
+    def packet_loss(self):
+        """The percentage of the received packets that were lost, over the sampled history if there is one"""
+        samples = self._get_statistics_samples()
+        if not samples:
+            return None
+        lost = samples['rx_lost'][-1] - (samples['rx_lost'][0] if len(samples['rx_lost']) > 1 else 0)
+        received = samples['rx_packets'][-1] - (samples['rx_packets'][0] if len(samples['rx_packets']) > 1 else 0)
+        return 100.0 * lost / (lost + received) if lost + received > 0 else 0.0
+
+    @property
+    def mos(self):
+        """An estimate of the mean opinion score (1 to 4.5), based on the ITU-T G.107 E-model"""
+        samples = self._get_statistics_samples()
+        if not samples:
+            return None
+        effective_latency = samples['rtt'][-1] / 2000.0 + 2 * samples['rx_jitter'][-1] / 1000.0 + 10
+        if effective_latency < 160:
+            r = 93.2 - effective_latency / 40
+        else:
+            r = 93.2 - (effective_latency - 120) / 10
+        r = max(0.0, min(100.0, r - 2.5 * self.packet_loss))
+        return 1 + 0.035 * r + 0.000007 * r * (r - 60) * (100 - r)
+
+    def _get_statistics_samples(self):
+        if self._statistics_history is not None and self._statistics_history.count > 0:
+            return self._statistics_history.read()
+        statistics = self.statistics
+        if statistics is None:
+            return None
+        return dict(rx_packets=[statistics['rx']['packets']], rx_lost=[statistics['rx']['packets_lost']],
+                    rx_jitter=[statistics['rx']['jitter']['last']], rtt=[statistics['rtt']['last']])
+
+    def _start_statistics_sampling(self):
+        if self.statistics_sampler is not None and self._transport is not None:
+            self._statistics_history = self.statistics_sampler.add(self._transport)
+
     @property
     def local_rtp_address(self):
         return self._rtp_transport.local_rtp_address.decode() if (self._rtp_transport and self._rtp_transport.local_rtp_address) else None
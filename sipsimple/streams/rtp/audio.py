@@ -81,6 +81,7 @@ class AudioStream(RTPStream):
                 raise RuntimeError("AudioStream.start() may only be called in the INITIALIZED state")
             settings = SIPSimpleSettings()
             self._transport.start(local_sdp, remote_sdp, stream_index, timeout=settings.rtp.timeout)
+            self._start_statistics_sampling()
             self._save_remote_sdp_rtp_info(remote_sdp, stream_index)
             self._check_hold(self._transport.direction.decode(), True)
             if self._try_ice and self._ice_state == "NULL":
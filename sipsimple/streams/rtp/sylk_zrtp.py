@@ -88,7 +88,7 @@ import sqlite3
 import threading
 import time
 import uuid
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 
 from application import log
 from application.notification import NotificationCenter, NotificationData
@@ -319,12 +319,22 @@ _RS_LEN = 32  # bytes
 class SylkZrtpSecretStore(object):
     """SQLite-backed map: peer_aor -> (rs1, rotated_at).
 
-    One module-level instance, lazily opened on first use. Thread-safe via
-    a single lock around the connection so the per-call threads can hammer
-    it concurrently. The DB file path is taken from
-    sipsimple.application.SIPApplication().engine.zrtp_cache — same file
-    libzrtpcpp uses for its RFC 6189 ZID cache. Separate table, no schema
-    overlap.
+    One module-level instance, lazily opened on first use. The DB file path
+    is taken from sipsimple.application.SIPApplication().engine.zrtp_cache —
+    same file libzrtpcpp uses for its RFC 6189 ZID cache. Separate table, no
+    schema overlap.
+
+    Lookups happen on the call setup path, so they are answered from an
+    in-memory LRU cache whenever possible and writes never wait for the
+    disk: put/delete update the cache, queue the change and return. A
+    dedicated writer thread applies everything that was queued in one
+    transaction on its own connection, with the file in WAL mode so the
+    readers are not blocked by it. Changes that are queued but not yet
+    committed take precedence over what is read from the DB. A batch which
+    could not be written stays queued and is retried after a growing delay.
+    flush() waits for the queue to drain and close() also stops the writer
+    thread; it is called from SIPApplication when it shuts down. Both of
+    them return False when the changes could not be written.
     """
 
     _SCHEMA = (
@@ -335,11 +345,36 @@ class SylkZrtpSecretStore(object):
         ")"
     )
 
+    cache_size = 1024
+    retry_interval = 1.0
+    max_retry_interval = 60.0
+
     def __init__(self):
-        self._lock = threading.Lock()
+        self._lock = threading.Condition()
         self._conn = None
+        self._path = None
+        self._cache = OrderedDict()    # peer_aor -> rs1 or None when there is no entry
+        self._pending = {}             # peer_aor -> the last queued change for it
+        self._queue = []
+        self._writing = False
+        self._writer = None
+        self._stopping = False
+        self._last_error = None
+        self._stats = dict(reads=0, cache_hits=0, read_time=0.0, max_read_time=0.0, writes=0, commits=0, failed_commits=0, max_queue_depth=0)
+
+    @property
+    def statistics(self):
+        """Read latency, cache and write queue counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['cache_entries'] = len(self._cache)
+            stats['last_error'] = self._last_error
+        stats['average_read_time'] = stats['read_time'] / stats['reads'] if stats['reads'] else 0.0
+        return stats
 
     def _ensure_open(self):
+        # Must be called with the lock held
         if self._conn is not None:
             return self._conn
         try:
@@ -358,54 +393,195 @@ class SylkZrtpSecretStore(object):
             d = os.path.dirname(path)
             if d and not os.path.exists(d):
                 os.makedirs(d)
-            self._conn = sqlite3.connect(path, check_same_thread=False)
-            self._conn.execute(self._SCHEMA)
-            self._conn.commit()
+            self._conn = self._connect(path)
         except Exception as e:
             log.warning('[sylk-zrtp] secret store: cannot open %s: %s' % (path, e))
             self._conn = None
+        else:
+            self._path = path
         return self._conn
 
+    def _connect(self, path):
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(self._SCHEMA)
+        conn.commit()
+        return conn
+
+    def _cache_set(self, peer_aor, rs1):
+        # Must be called with the lock held
+        self._cache[peer_aor] = rs1
+        self._cache.move_to_end(peer_aor)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _enqueue(self, peer_aor, rs1):
+        # Must be called with the lock held
+        change = (peer_aor, rs1, int(time.time()))
+        self._pending[peer_aor] = change
+        self._queue.append(change)
+        self._cache_set(peer_aor, rs1)
+        self._stats['writes'] += 1
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._queue))
+        if self._writer is None:
+            self._stopping = False
+            self._writer = threading.Thread(target=self._run_writer, name='Sylk-ZRTP secret store writer')
+            self._writer.daemon = True
+            self._writer.start()
+        self._lock.notify_all()
+
+    def _run_writer(self):
+        conn = None
+        retry_delay = 0
+        retry_time = None
+        while True:
+            with self._lock:
+                while not self._stopping:
+                    if retry_time is None:
+                        if self._queue:
+                            break
+                        self._lock.wait()
+                    else:
+                        remaining = retry_time - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._lock.wait(remaining)
+                if not self._queue:
+                    self._writer = None
+                    break
+                batch, self._queue = self._queue, []
+                self._writing = True
+                path = self._path
+            try:
+                if conn is None:
+                    conn = self._connect(path)
+                with conn:
+                    for peer_aor, rs1, rotated_at in batch:
+                        if rs1 is None:
+                            conn.execute("DELETE FROM sylk_zrtp_secrets WHERE peer_aor = ?", (peer_aor,))
+                        else:
+                            conn.execute(
+                                "INSERT OR REPLACE INTO sylk_zrtp_secrets "
+                                "(peer_aor, rs1, rotated_at) VALUES (?, ?, ?)",
+                                (peer_aor, rs1, rotated_at))
+            except Exception as e:
+                log.warning('[sylk-zrtp] secret store: failed to write %d change(s): %s' % (len(batch), e))
+                error = e
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            else:
+                error = None
+            with self._lock:
+                self._writing = False
+                self._lock.notify_all()
+                if error is None:
+                    for change in batch:
+                        peer_aor = change[0]
+                        if self._pending.get(peer_aor) is change:
+                            del self._pending[peer_aor]
+                    self._last_error = None
+                    self._stats['commits'] += 1
+                    retry_delay = 0
+                    retry_time = None
+                else:
+                    # Put the batch back in front of what was queued meanwhile. Its changes stay pending, so they
+                    # are still returned by the lookups, and they are written when the retry succeeds.
+                    self._queue[:0] = batch
+                    self._last_error = error
+                    self._stats['failed_commits'] += 1
+                    if self._stopping:
+                        self._writer = None
+                        break
+                    retry_delay = min(2 * retry_delay or self.retry_interval, self.max_retry_interval)
+                    retry_time = time.monotonic() + retry_delay
+        if conn is not None:
+            conn.close()
+
+    def flush(self, timeout=None):
+        """Wait until all queued changes are written. Returns False if that
+        did not happen within timeout seconds or if writing them failed, in
+        which case they are retried in the background."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._queue or self._writing:
+                if self._last_error is not None and not self._writing:
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Write the queued changes, stop the writer thread and close the DB.
+        Returns False if some of the changes could not be written."""
+        with self._lock:
+            writer = self._writer
+            self._stopping = True
+            self._lock.notify_all()
+        if writer is not None:
+            writer.join(timeout)
+        with self._lock:
+            if self._conn is not None and self._writer is None:
+                self._conn.close()
+                self._conn = None
+            self._cache.clear()
+            unwritten = len(self._queue)
+            error = self._last_error
+        if unwritten:
+            log.error('[sylk-zrtp] secret store: %d change(s) could not be written: %s' % (unwritten, error or 'timeout'))
+            return False
+        return True
+
     def get(self, peer_aor):
         """Return the stored 32-byte rs1 for peer_aor, or None."""
         if not peer_aor:
             return None
+        start_time = time.perf_counter()
         with self._lock:
-            conn = self._ensure_open()
-            if conn is None:
-                return None
             try:
-                row = conn.execute(
-                    "SELECT rs1 FROM sylk_zrtp_secrets WHERE peer_aor = ?",
-                    (peer_aor,)).fetchone()
-            except Exception as e:
-                log.warning('[sylk-zrtp] secret store get(%s) failed: %s' % (peer_aor, e))
-                return None
-        if row is None:
-            return None
-        rs1 = row[0]
-        if isinstance(rs1, (bytes, bytearray)) and len(rs1) == _RS_LEN:
-            return bytes(rs1)
-        return None
+                if peer_aor in self._pending:
+                    rs1 = self._pending[peer_aor][1]
+                    self._stats['cache_hits'] += 1
+                elif peer_aor in self._cache:
+                    rs1 = self._cache[peer_aor]
+                    self._cache.move_to_end(peer_aor)
+                    self._stats['cache_hits'] += 1
+                else:
+                    conn = self._ensure_open()
+                    if conn is None:
+                        return None
+                    try:
+                        row = conn.execute(
+                            "SELECT rs1 FROM sylk_zrtp_secrets WHERE peer_aor = ?",
+                            (peer_aor,)).fetchone()
+                    except Exception as e:
+                        log.warning('[sylk-zrtp] secret store get(%s) failed: %s' % (peer_aor, e))
+                        return None
+                    rs1 = row[0] if row is not None else None
+                    if isinstance(rs1, (bytes, bytearray)) and len(rs1) == _RS_LEN:
+                        rs1 = bytes(rs1)
+                    else:
+                        rs1 = None
+                    self._cache_set(peer_aor, rs1)
+            finally:
+                read_time = time.perf_counter() - start_time
+                self._stats['reads'] += 1
+                self._stats['read_time'] += read_time
+                self._stats['max_read_time'] = max(self._stats['max_read_time'], read_time)
+        return rs1
 
     def put(self, peer_aor, rs1):
         """Store/replace rs1 for peer_aor. rs1 must be exactly 32 bytes."""
         if not peer_aor or not isinstance(rs1, (bytes, bytearray)) or len(rs1) != _RS_LEN:
             return False
         with self._lock:
-            conn = self._ensure_open()
-            if conn is None:
-                return False
-            try:
-                conn.execute(
-                    "INSERT OR REPLACE INTO sylk_zrtp_secrets "
-                    "(peer_aor, rs1, rotated_at) VALUES (?, ?, ?)",
-                    (peer_aor, bytes(rs1), int(time.time())))
-                conn.commit()
-                return True
-            except Exception as e:
-                log.warning('[sylk-zrtp] secret store put(%s) failed: %s' % (peer_aor, e))
+            if self._ensure_open() is None:
                 return False
+            self._enqueue(peer_aor, bytes(rs1))
+        return True
 
     def delete(self, peer_aor):
         """Forget the stored rs1 for peer_aor (e.g. user chose Continue past
@@ -413,18 +589,10 @@ class SylkZrtpSecretStore(object):
         if not peer_aor:
             return False
         with self._lock:
-            conn = self._ensure_open()
-            if conn is None:
-                return False
-            try:
-                conn.execute(
-                    "DELETE FROM sylk_zrtp_secrets WHERE peer_aor = ?",
-                    (peer_aor,))
-                conn.commit()
-                return True
-            except Exception as e:
-                log.warning('[sylk-zrtp] secret store delete(%s) failed: %s' % (peer_aor, e))
+            if self._ensure_open() is None:
                 return False
+            self._enqueue(peer_aor, None)
+        return True
 
     def list_for_aor(self, peer_aor):
         """Return every (peer_device_id, rs1) tuple stored for peer_aor.
@@ -463,11 +631,22 @@ class SylkZrtpSecretStore(object):
                 log.warning('[sylk-zrtp] secret store list_for_aor(%s) failed: %s'
                             % (peer_aor, e))
                 return out
-        if exact is not None:
-            rs1 = exact[0]
+            # Overlay the changes that are not committed yet. This is done
+            # while still holding the lock, as the writer only drops them
+            # from _pending (with the lock held) after they were committed.
+            entries = dict(rows)
+            if exact is not None:
+                entries[peer_aor] = exact[0]
+            for key, (_, rs1, _) in self._pending.items():
+                if key == peer_aor or key.startswith(peer_aor + '#'):
+                    entries[key] = rs1
+        if entries.get(peer_aor) is not None:
+            rs1 = entries[peer_aor]
             if isinstance(rs1, (bytes, bytearray)) and len(rs1) == _RS_LEN:
                 out.append((None, bytes(rs1)))
-        for key, rs1 in rows:
+        for key, rs1 in entries.items():
+            if key == peer_aor:
+                continue
             if not isinstance(rs1, (bytes, bytearray)) or len(rs1) != _RS_LEN:
                 continue
             # key looks like 'peer_aor#device_id'; split on the FIRST '#'.
@@ -483,6 +662,12 @@ class SylkZrtpSecretStore(object):
 _secret_store = SylkZrtpSecretStore()
 
 
+def close_secret_store(timeout=None):
+    """Write the pending retained-secret changes to disk and close the store.
+    Returns False if some of them could not be written."""
+    return _secret_store.close(timeout)
+
+
 # ----- v3 signing-keys auto-plumbing hook -------------------------------
 #
 # Problem: SylkZRTPSession.set_signing_keys() lives on the instance and